@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+"""
+Benchmarks of the accounting files processing
+
+Each module can be launched as a script, e.g :
+
+    python -m autonomie_celery.benchmarks.sylk_reader --lines 200000
+
+Results are printed as json
+"""
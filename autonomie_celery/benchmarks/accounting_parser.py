@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+"""
+Time the accounting parsers on synthetic files
+
+    python -m autonomie_celery.benchmarks.accounting_parser \
+        --filetype general_ledger --format csv --lines 200000 \
+        --output results.json
+
+Each stage is timed on its own :
+
+    hash : md5sum of the file
+    stream : reading the file's lines
+    build : building the operations' datas (stream excluded)
+    insert : storing the operations in the database (stream and build
+    excluded)
+    cleanup : removing the operations of the previous upload
+
+By default an in-memory SQLite database is used, --url allows to use a MySQL
+stand-in (the needed tables are created if they don't exist and emptied before
+each run).
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+import transaction
+
+from sqlalchemy import create_engine
+from zope.sqlalchemy import mark_changed
+
+from autonomie_base.models.base import (
+    DBBASE,
+    DBSESSION,
+)
+from autonomie.models.company import Company
+from autonomie.models.accounting.operations import (
+    AccountingOperationUpload,
+    AccountingOperation,
+)
+from autonomie_celery.benchmarks.generators import (
+    analytical_balance_rows,
+    general_ledger_rows,
+    write_csv_file,
+    write_sylk_file,
+)
+from autonomie_celery.tasks.accounting_parser import (
+    _clean_old_operations,
+    _get_parser_factory,
+)
+
+
+YEAR = 2018
+MONTH = 6
+FILENAMES = {
+    'general_ledger': u"general_ledger_{0}_{1:02d}_bench.{2}",
+    'analytical_balance': u"analytical_balance_{0}_{1:02d}_30_bench.{2}",
+}
+BENCHMARK_TABLES = [
+    Company.__table__,
+    AccountingOperationUpload.__table__,
+    AccountingOperation.__table__,
+]
+
+
+def generate_file(directory, filetype, file_format, num_lines, num_companies,
+                  seed=1):
+    """
+    Generate an accounting file named the way _get_parser_factory expects
+
+    :param str directory: The destination directory
+    :param str filetype: general_ledger/analytical_balance
+    :param str file_format: csv/slk
+    :returns: The path to the generated file
+    """
+    path = os.path.join(
+        directory, FILENAMES[filetype].format(YEAR, MONTH, file_format)
+    )
+    if filetype == 'general_ledger':
+        rows = general_ledger_rows(
+            num_lines, num_companies, YEAR, MONTH, seed=seed
+        )
+    else:
+        rows = analytical_balance_rows(num_lines, num_companies, seed=seed)
+
+    if file_format == 'csv':
+        write_csv_file(path, rows)
+    else:
+        write_sylk_file(path, rows)
+    return path
+
+
+def setup_database(url, num_companies, tables=()):
+    """
+    Bind the session to the given database, empty the benchmark's tables and
+    create the companies the generated analytical accounts refer to
+
+    The rows left by previous runs (on a MySQL stand-in) are removed so that
+    each run starts from the same database
+
+    :param str url: A sqlalchemy url
+    :param int num_companies: The number of companies to create
+    :param list tables: Additional tables to create and empty
+    """
+    engine = create_engine(url)
+    DBSESSION.configure(bind=engine)
+    tables = BENCHMARK_TABLES + list(tables)
+    DBBASE.metadata.create_all(engine, tables=tables, checkfirst=True)
+
+    table_names = set(table.name for table in tables)
+    transaction.begin()
+    session = DBSESSION()
+    # The tables referring to the other ones are emptied first
+    for table in reversed(DBBASE.metadata.sorted_tables):
+        if table.name in table_names:
+            session.execute(table.delete())
+    session.execute(
+        Company.__table__.insert(),
+        [
+            dict(
+                name=u"Entreprise %s" % index,
+                email=u"entreprise%s@example.com" % index,
+                code_compta=u"ANA%05d" % index,
+            )
+            for index in range(1, num_companies + 1)
+        ]
+    )
+    mark_changed(session)
+    transaction.commit()
+    return engine
+
+
+def _timed(func, *args):
+    """
+    Call func and return its duration and result
+    """
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+
+def _consume(iterator):
+    """
+    Consume an iterator and return the number of items it yielded
+    """
+    count = 0
+    for _ in iterator:
+        count += 1
+    return count
+
+
+def _hash_file(path):
+    result = hashlib.md5()
+    with open(path, 'rb') as fbuf:
+        for block in iter(lambda: fbuf.read(65536), b''):
+            result.update(block)
+    return result.hexdigest()
+
+
+def _store(parser):
+    """
+    Store the file's operations in their own transaction
+
+    :returns: The id of the new upload
+    """
+    transaction.begin()
+    try:
+        upload_id = parser.process_file()[0]
+        transaction.commit()
+    except:
+        transaction.abort()
+        raise
+    return upload_id
+
+
+def run(filetype, file_format, num_lines, num_companies, url, bulk=False):
+    """
+    Generate a file and time each stage of its parsing
+
+    :rtype: dict
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        path = generate_file(
+            directory, filetype, file_format, num_lines, num_companies
+        )
+        parser_factory = _get_parser_factory(os.path.basename(path))
+        setup_database(url, num_companies)
+
+        def new_parser():
+            # Each file is stored twice, the duplicate check is skipped
+            parser = parser_factory(path, force=True, bulk=bulk)
+            transaction.begin()
+            parser._load_company_id_cache()
+            transaction.commit()
+            return parser
+
+        hash_duration, _ = _timed(_hash_file, path)
+        stream_duration, num_rows = _timed(
+            _consume, new_parser()._stream_datas()
+        )
+        build_duration, num_operations = _timed(
+            _consume, new_parser()._stream_operations_datas()
+        )
+        # The stored upload is the one cleaned by the next one
+        previous_upload_id = _store(new_parser())
+        store_duration, upload_id = _timed(_store, new_parser())
+        cleanup_duration, num_deleted = _timed(
+            _clean_old_operations, upload_id, parser_factory.filetype
+        )
+
+        return {
+            'date': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'database': url.split(':', 1)[0],
+            'filetype': filetype,
+            'format': file_format,
+            'bulk': bulk,
+            'lines': num_lines,
+            'companies': num_companies,
+            'file_size': os.path.getsize(path),
+            'rows': num_rows,
+            'operations': num_operations,
+            'previous_upload_id': previous_upload_id,
+            'deleted_operations': num_deleted,
+            'stages': {
+                'hash': hash_duration,
+                'stream': stream_duration,
+                'build': build_duration - stream_duration,
+                'insert': store_duration - build_duration,
+                'cleanup': cleanup_duration,
+            },
+            'operations_per_second': (
+                num_operations / store_duration if store_duration else None
+            ),
+        }
+    finally:
+        shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        '--filetype',
+        choices=sorted(FILENAMES.keys()),
+        default='general_ledger',
+    )
+    parser.add_argument('--format', choices=('csv', 'slk'), default='csv')
+    parser.add_argument('--lines', type=int, default=100000)
+    parser.add_argument('--companies', type=int, default=300)
+    parser.add_argument('--url', default='sqlite://')
+    parser.add_argument('--bulk', action='store_true')
+    parser.add_argument(
+        '--output',
+        help=u"Append the results as a json line to this file",
+    )
+    args = parser.parse_args()
+    results = run(
+        args.filetype, args.format, args.lines, args.companies, args.url,
+        bulk=args.bulk,
+    )
+    if args.output:
+        with open(args.output, 'a') as fbuf:
+            fbuf.write(json.dumps(results, sort_keys=True) + "\n")
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
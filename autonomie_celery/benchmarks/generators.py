@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+"""
+Synthetic accounting files and datas generators
+"""
+import calendar
+import datetime
+import io
+import random
+
+
+ANALYTICAL_BALANCE_HEADER = [
+    u"Compte analytique de l'entrepreneur",
+    u"Libellé",
+    u"Compte général",
+    u"Libellé du compte",
+    u"Débit",
+    u"Crédit",
+    u"Solde",
+]
+GENERAL_LEDGER_HEADER = [
+    u"Compte analytique de l'entrepreneur",
+    u"Compte général",
+    u"Date",
+    u"Journal",
+    u"Pièce",
+    u"Libellé",
+    u"Débit",
+    u"Crédit",
+]
+JOURNALS = [u"VE", u"AC", u"BQ", u"OD"]
+GENERAL_ACCOUNTS = [
+    u"10100000", u"40100000", u"41100000", u"42100000", u"44566000",
+    u"51200000", u"60100000", u"60400000", u"61300000", u"62600000",
+    u"64100000", u"64510000", u"70600000", u"70800000", u"75800000",
+]
+
+
+def _amount(rand):
+    """
+    Return a random amount with two decimals
+    """
+    return round(rand.uniform(0, 10000), 2)
+
+
+def analytical_balance_rows(num_lines, num_companies, seed=1):
+    """
+    Generate the rows of an analytical balance
+
+    :param int num_lines: The number of operation lines
+    :param int num_companies: The number of analytical accounts used
+    :returns: An iterator of rows (lists of cells)
+    """
+    rand = random.Random(seed)
+    yield ANALYTICAL_BALANCE_HEADER
+    for index in range(num_lines):
+        company_index = rand.randint(1, num_companies)
+        general_account = rand.choice(GENERAL_ACCOUNTS)
+        debit = _amount(rand)
+        credit = _amount(rand)
+        yield [
+            u"ANA%05d" % company_index,
+            u"Entrepreneur %s" % company_index,
+            general_account,
+            u"Compte %s" % general_account,
+            debit,
+            credit,
+            round(debit - credit, 2),
+        ]
+
+
+def general_ledger_rows(num_lines, num_companies, year, month, seed=1):
+    """
+    Generate the rows of a general ledger covering the months of the given
+    year until the given one
+
+    :param int num_lines: The number of operation lines
+    :param int num_companies: The number of analytical accounts used
+    :param int year: The ledger's year
+    :param int month: The ledger's last month
+    :returns: An iterator of rows (lists of cells)
+    """
+    rand = random.Random(seed)
+    yield GENERAL_LEDGER_HEADER
+    for index in range(num_lines):
+        company_index = rand.randint(1, num_companies)
+        general_account = rand.choice(GENERAL_ACCOUNTS)
+        op_month = rand.randint(1, month)
+        op_day = rand.randint(1, calendar.monthrange(year, op_month)[1])
+        amount = _amount(rand)
+        debit, credit = (amount, 0) if rand.random() < 0.5 else (0, amount)
+        yield [
+            u"ANA%05d" % company_index,
+            general_account,
+            u"%02d/%02d/%04d" % (op_day, op_month, year),
+            rand.choice(JOURNALS),
+            u"P%07d" % index,
+            u"Opération %s" % index,
+            debit,
+            credit,
+        ]
+
+
+def operation_datas(num_operations, num_companies, year, month, seed=1):
+    """
+    Generate the column values of accounting operations dated from january
+    to the given month
+
+    :param int num_operations: The number of operations
+    :param int num_companies: The number of analytical accounts used
+    :param int year: The operations' year
+    :param int month: The last month
+    :returns: An iterator of dicts (AccountingOperation column -> value)
+    """
+    rand = random.Random(seed)
+    for index in range(num_operations):
+        op_month = rand.randint(1, month)
+        op_day = rand.randint(1, calendar.monthrange(year, op_month)[1])
+        debit = _amount(rand)
+        credit = _amount(rand)
+        yield dict(
+            analytical_account=u"ANA%05d" % rand.randint(1, num_companies),
+            general_account=rand.choice(GENERAL_ACCOUNTS),
+            date=datetime.date(year, op_month, op_day),
+            label=u"Opération %s" % index,
+            debit=debit,
+            credit=credit,
+            balance=round(debit - credit, 2),
+        )
+
+
+def account_prefixes(num_types, seed=1):
+    """
+    Generate the account prefixes of measure types, some of them have several
+    prefixes or exclude sub-accounts
+
+    :param int num_types: The number of prefixes to generate
+    :rtype: list
+    """
+    rand = random.Random(seed)
+    result = []
+    for _ in range(num_types):
+        prefix = rand.choice(GENERAL_ACCOUNTS)[:rand.randint(1, 4)]
+        choice = rand.random()
+        if choice < 0.2:
+            prefix = u"{0},{1}".format(
+                prefix, rand.choice(GENERAL_ACCOUNTS)[:rand.randint(2, 4)]
+            )
+        elif choice < 0.4:
+            excluded = rand.choice(
+                [
+                    account for account in GENERAL_ACCOUNTS
+                    if account.startswith(prefix)
+                ]
+            )
+            prefix = u"{0},-{1}".format(prefix, excluded[:len(prefix) + 1])
+        result.append(prefix)
+    return result
+
+
+def _csv_value(value, quotechar):
+    """
+    Format a cell value for a csv file
+    """
+    if isinstance(value, (int, float)):
+        return u"%s" % value
+    return u"{0}{1}{0}".format(
+        quotechar, value.replace(quotechar, quotechar * 2)
+    )
+
+
+def write_csv_file(
+    path, rows, encoding="utf-8", delimiter=u",", quotechar=u'"'
+):
+    """
+    Write the given rows in a csv file
+
+    :param str path: The destination path
+    :param iter rows: Iterator of lists of cells
+    """
+    with io.open(path, 'w', encoding=encoding, newline='') as fbuf:
+        for row in rows:
+            fbuf.write(
+                delimiter.join(_csv_value(value, quotechar) for value in row)
+            )
+            fbuf.write(u"\r\n")
+    return path
+
+
+def _sylk_value(value):
+    """
+    Format a cell value for a SYLK K field
+    """
+    if isinstance(value, (int, float)):
+        return u"%s" % value
+    return u'"%s"' % value.replace(u";", u",")
+
+
+def write_sylk_file(path, rows, encoding="cp1252"):
+    """
+    Write the given rows in a SYLK file the way accounting softwares do (cells
+    written row after row)
+
+    :param str path: The destination path
+    :param iter rows: Iterator of lists of cells
+    """
+    with io.open(path, 'w', encoding=encoding, newline='') as fbuf:
+        fbuf.write(u"ID;PAutonomie\r\nP;PGeneral\r\nP;P0.00\r\n")
+        fbuf.write(u"F;P0;FG0G;X1\r\n")
+        for y, row in enumerate(rows, 1):
+            for x, value in enumerate(row, 1):
+                value = _sylk_value(value)
+                if x == 1:
+                    fbuf.write(u"C;Y%d;X%d;K%s\r\n" % (y, x, value))
+                else:
+                    fbuf.write(u"C;X%d;K%s\r\n" % (x, value))
+        fbuf.write(u"E\r\n")
+    return path
@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+"""
+Time the measure compilers on synthetic operations
+
+    python -m autonomie_celery.benchmarks.measure_compiler \
+        --operations 200000 --companies 300 --types 60 \
+        --backend python --backend sql --backend numpy \
+        --output results.json
+
+For each compiler (treasury, income_statement) and backend, a database is
+filled with the same operations and measure types, the measures are then
+compiled twice :
+
+    first : the grids and measures are created
+    again : nothing changed, no measure should be written
+
+Each compilation reports its operations/s, its number of sql queries, the
+growth of the resident set size during the compilation (memory_delta) and the
+peak memory of the process (max resident set size, it never decreases).
+
+The pool backend is the python one with --processes processes, it's only
+used above ProcessPoolMeasureEngine.min_operations operations.
+
+By default an in-memory SQLite database is used for each run, --url allows to
+use a MySQL stand-in (the needed tables are created if they don't exist and
+emptied before each run).
+"""
+import argparse
+import datetime
+import json
+import platform
+import sys
+import transaction
+
+from sqlalchemy import event
+
+from autonomie_base.models.base import DBSESSION
+from autonomie.models.company import Company
+from autonomie.models.accounting.operations import (
+    AccountingOperationUpload,
+    AccountingOperation,
+)
+from autonomie.models.accounting.treasury_measures import (
+    TreasuryMeasure,
+    TreasuryMeasureGrid,
+    TreasuryMeasureType,
+)
+from autonomie.models.accounting.income_statement_measures import (
+    IncomeStatementMeasure,
+    IncomeStatementMeasureGrid,
+    IncomeStatementMeasureType,
+    IncomeStatementMeasureTypeCategory,
+)
+from autonomie_celery.benchmarks.accounting_parser import setup_database
+from autonomie_celery.benchmarks.generators import (
+    account_prefixes,
+    operation_datas,
+)
+from autonomie_celery.tasks import accounting_measure_compute
+from autonomie_celery.tasks.accounting_measure_compute import (
+    compile_measures,
+)
+from autonomie_celery.tasks.utils import PhaseTimer
+
+
+YEAR = 2018
+MONTH = 6
+FILETYPES = {
+    'treasury': 'analytical_balance',
+    'income_statement': 'general_ledger',
+}
+MODELS = {
+    'treasury': (TreasuryMeasure, TreasuryMeasureGrid, TreasuryMeasureType),
+    'income_statement': (
+        IncomeStatementMeasure,
+        IncomeStatementMeasureGrid,
+        IncomeStatementMeasureType,
+        IncomeStatementMeasureTypeCategory,
+    ),
+}
+# Benchmarked backend -> (compile_measures backend, uses the process pool)
+BACKENDS = {
+    'python': ('python', False),
+    'sql': ('sql', False),
+    'numpy': ('numpy', False),
+    'pool': ('python', True),
+}
+NUM_CATEGORIES = 5
+
+
+class QueryCounter(object):
+    """
+    Count the statements executed through an engine
+    """
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self._on_execute)
+
+    def _on_execute(self, *args):
+        self.count += 1
+
+
+def _add_treasury_types(session, prefixes):
+    for index, prefix in enumerate(prefixes):
+        session.add(
+            TreasuryMeasureType(
+                label=u"Indicateur %s" % index,
+                account_prefix=prefix,
+                active=True,
+            )
+        )
+
+
+def _add_income_statement_types(session, prefixes, num_totals):
+    """
+    Add the income statement measure types and categories, the first total
+    sums up the categories, the next ones are formulas referencing the
+    previous total
+    """
+    categories = [
+        IncomeStatementMeasureTypeCategory(
+            label=u"Catégorie %s" % index, active=True
+        )
+        for index in range(NUM_CATEGORIES)
+    ]
+    session.add_all(categories)
+    for index, prefix in enumerate(prefixes):
+        session.add(
+            IncomeStatementMeasureType(
+                label=u"Indicateur %s" % index,
+                account_prefix=prefix,
+                active=True,
+                is_total=False,
+                category=categories[index % NUM_CATEGORIES],
+            )
+        )
+
+    for index in range(num_totals):
+        if index == 0:
+            total_type = 'categories'
+            account_prefix = u",".join(
+                category.label for category in categories
+            )
+        else:
+            total_type = 'complex_total'
+            account_prefix = u"{Total %s} - {Indicateur %s} / 2" % (
+                index - 1, index % len(prefixes)
+            )
+        session.add(
+            IncomeStatementMeasureType(
+                label=u"Total %s" % index,
+                account_prefix=account_prefix,
+                active=True,
+                is_total=True,
+                total_type=total_type,
+            )
+        )
+
+
+def fill_database(
+    url, compiler, num_operations, num_companies, num_types, num_totals,
+    seed=1
+):
+    """
+    Create the companies, the measure types, an upload and its operations
+
+    The measure tables (of all the compilers, they refer to the uploads and
+    companies) are emptied along with the other benchmark tables, so that the
+    types, categories and uploads of the previous runs don't accumulate
+
+    :returns: A 2-uple (engine, upload id)
+    """
+    DBSESSION.remove()
+    tables = set()
+    for models in MODELS.values():
+        for model in models:
+            tables.update(model.__mapper__.tables)
+    engine = setup_database(url, num_companies, tables=list(tables))
+
+    transaction.begin()
+    session = DBSESSION()
+    prefixes = account_prefixes(num_types, seed=seed)
+    if compiler == 'treasury':
+        _add_treasury_types(session, prefixes)
+    else:
+        _add_income_statement_types(session, prefixes, num_totals)
+
+    upload = AccountingOperationUpload(
+        filename=u"{0}_bench".format(FILETYPES[compiler]),
+        date=datetime.date(YEAR, MONTH, 30),
+        filetype=FILETYPES[compiler],
+    )
+    session.add(upload)
+    session.flush()
+    upload_id = upload.id
+
+    company_ids = dict(
+        session.query(Company.code_compta, Company.id).filter(
+            Company.code_compta != None
+        )
+    )
+    operations = []
+    for datas in operation_datas(
+        num_operations, num_companies, YEAR, MONTH, seed=seed
+    ):
+        datas['upload_id'] = upload_id
+        datas['company_id'] = company_ids.get(datas['analytical_account'])
+        operations.append(datas)
+    session.execute(AccountingOperation.__table__.insert(), operations)
+    transaction.commit()
+    return engine, upload_id
+
+
+def _compile(upload_id, backend, processes):
+    """
+    Compile the measures of the given upload in their own transaction
+
+    :returns: The number of handled grids
+    """
+    transaction.begin()
+    try:
+        upload = AccountingOperationUpload.get(upload_id)
+        grids = compile_measures(upload, backend=backend, processes=processes)
+        transaction.commit()
+    except:
+        transaction.abort()
+        raise
+    return len(grids)
+
+
+def run(
+    compiler, backend, num_operations, num_companies, num_types,
+    num_totals=3, processes=4, url='sqlite://'
+):
+    """
+    Fill a database and time the compilation of its measures
+
+    :rtype: dict
+    """
+    compiler_backend, use_pool = BACKENDS[backend]
+    processes = processes if use_pool else 1
+    engine, upload_id = fill_database(
+        url, compiler, num_operations, num_companies, num_types, num_totals
+    )
+    counter = QueryCounter(engine)
+    timer = PhaseTimer()
+
+    stages = {}
+    for stage in ('first', 'again'):
+        counter.count = 0
+        with timer.phase(stage, rows=num_operations) as phase:
+            num_grids = _compile(upload_id, compiler_backend, processes)
+        stages[stage] = dict(
+            phase.todict(),
+            queries=counter.count,
+            grids=num_grids,
+        )
+
+    return {
+        'date': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'database': url.split(':', 1)[0],
+        'compiler': compiler,
+        'backend': backend,
+        'processes': processes,
+        'operations': num_operations,
+        'companies': num_companies,
+        'types': num_types,
+        'totals': num_totals,
+        'stages': stages,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        '--compiler',
+        action='append',
+        choices=sorted(FILETYPES.keys()),
+        help=u"Defaults to all the compilers",
+    )
+    parser.add_argument(
+        '--backend',
+        action='append',
+        choices=sorted(BACKENDS.keys()),
+        help=u"Defaults to python",
+    )
+    parser.add_argument('--operations', type=int, default=100000)
+    parser.add_argument('--companies', type=int, default=300)
+    parser.add_argument('--types', type=int, default=40)
+    parser.add_argument(
+        '--totals',
+        type=int,
+        default=3,
+        help=u"Number of computed totals (income statement only)",
+    )
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--url', default='sqlite://')
+    parser.add_argument(
+        '--output',
+        help=u"Append the results as json lines to this file",
+    )
+    args = parser.parse_args()
+
+    results = []
+    for compiler in args.compiler or sorted(FILETYPES.keys()):
+        for backend in args.backend or ['python']:
+            if backend == 'numpy' and accounting_measure_compute.numpy is None:
+                sys.stderr.write(u"numpy is not installed, skipped\n")
+                continue
+            results.append(
+                run(
+                    compiler, backend, args.operations, args.companies,
+                    args.types, num_totals=args.totals,
+                    processes=args.processes, url=args.url,
+                )
+            )
+
+    if args.output:
+        with open(args.output, 'a') as fbuf:
+            for result in results:
+                fbuf.write(json.dumps(result, sort_keys=True) + "\n")
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+"""
+Compare the throughput of sylk_parser.SylkParser and our SylkReader
+
+    python -m autonomie_celery.benchmarks.sylk_reader --lines 200000
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from sylk_parser import SylkParser
+
+from autonomie_celery.sylk_reader import stream_sylk_file
+from autonomie_celery.benchmarks.generators import (
+    analytical_balance_rows,
+    write_sylk_file,
+)
+
+
+def _time_reader(reader_factory, path):
+    """
+    Build a reader for the given path and consume it
+
+    The rows fingerprint is a running md5 of the rows, it depends on their
+    order and on each of their cells
+
+    :returns: A 3-uple (duration, number of rows, rows fingerprint)
+    """
+    start = time.time()
+    num_rows = 0
+    fingerprint = hashlib.md5()
+    for row in reader_factory(path):
+        num_rows += 1
+        fingerprint.update(
+            (u"\x1f".join(u"%s" % cell for cell in row) + u"\x1e").encode(
+                'utf-8'
+            )
+        )
+    return time.time() - start, num_rows, fingerprint.hexdigest()
+
+
+def run(num_lines, num_companies):
+    """
+    Generate a SYLK file and parse it with both parsers
+
+    :rtype: dict
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        path = write_sylk_file(
+            os.path.join(directory, "analytical_balance_2018_01_31_bench.slk"),
+            analytical_balance_rows(num_lines, num_companies),
+        )
+        file_size = os.path.getsize(path)
+        results = {
+            'lines': num_lines,
+            'file_size': file_size,
+        }
+        for name, reader_factory in (
+            ('sylk_parser', lambda path: SylkParser(path, use_unicode=True)),
+            ('sylk_reader', stream_sylk_file),
+        ):
+            duration, num_rows, fingerprint = _time_reader(
+                reader_factory, path
+            )
+            results[name] = {
+                'duration': duration,
+                'rows': num_rows,
+                'rows_per_second': num_rows / duration if duration else None,
+                'mb_per_second': (
+                    file_size / 1048576.0 / duration if duration else None
+                ),
+                'fingerprint': fingerprint,
+            }
+        results['same_rows'] = (
+            results['sylk_parser']['fingerprint'] ==
+            results['sylk_reader']['fingerprint'] and
+            results['sylk_parser']['rows'] == results['sylk_reader']['rows']
+        )
+        return results
+    finally:
+        shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--lines', type=int, default=100000)
+    parser.add_argument('--companies', type=int, default=300)
+    args = parser.parse_args()
+    print(json.dumps(run(args.lines, args.companies), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+"""
+Worker level company cache
+
+The code_compta <-> company id index is loaded once per worker process and
+shared by the tasks it runs. Before being used, the index is checked against
+the companies' version (last update date and number of companies), it's
+reloaded when a company has been added, modified or removed.
+
+Since the update date is a day, a company modified on the day the index was
+loaded doesn't change the version : the index is also reloaded when it's older
+than max_age seconds.
+
+    from autonomie_celery.company_cache import get_company_index
+    company_id = get_company_index().get_company_id(code_compta)
+"""
+import time
+
+from sqlalchemy import func
+
+from autonomie_base.models.base import DBSESSION
+from autonomie.models.company import Company
+from autonomie_celery.tasks.utils import get_logger
+
+
+logger = get_logger(__name__)
+
+# Max number of seconds an index is used without being reloaded
+MAX_AGE = 300
+
+
+class CompanyIndex(object):
+    """
+    code_compta -> company id index (and the reverse one)
+
+    :param int max_age: Max number of seconds the index is used without being
+    reloaded
+    """
+    def __init__(self, max_age=MAX_AGE):
+        self.max_age = max_age
+        self.version = None
+        self.loaded_at = None
+        self.company_ids = {}
+        self.codes = {}
+
+    def _get_version(self):
+        """
+        Return a cheap fingerprint of the company table
+
+        :rtype: tuple
+        """
+        return DBSESSION().query(
+            func.max(Company.updated_at),
+            func.count(Company.id),
+        ).one()
+
+    def _load(self):
+        query = DBSESSION().query(Company.id, Company.code_compta)
+        query = query.filter(Company.code_compta != None)
+
+        self.company_ids = {}
+        self.codes = {}
+        for id_, code in query:
+            self.company_ids[code] = id_
+            self.codes[id_] = code
+
+    def refresh(self):
+        """
+        Reload the index if the companies changed since it was loaded or if
+        it's older than max_age
+
+        Should be called in an opened transaction
+
+        :returns: The index itself
+        """
+        now = time.time()
+        expired = (
+            self.loaded_at is None or now - self.loaded_at >= self.max_age
+        )
+        version = tuple(self._get_version())
+        if expired or version != self.version:
+            logger.info(u"Loading the company index")
+            self._load()
+            self.version = version
+            self.loaded_at = now
+        return self
+
+    def get_company_id(self, code_compta):
+        """
+        :param str code_compta: An analytical account
+        :returns: The id of the matching company or None
+        """
+        return self.company_ids.get(code_compta)
+
+    def get_code_compta(self, company_id):
+        """
+        :param int company_id: The id of a company
+        :returns: Its analytical account or None
+        """
+        return self.codes.get(company_id)
+
+
+COMPANY_INDEX = CompanyIndex()
+
+
+def get_company_index():
+    """
+    Return the worker's company index, up to date
+
+    :rtype: obj CompanyIndex
+    """
+    return COMPANY_INDEX.refresh()
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+"""
+Computed income statement totals
+
+Total measure types are not all built from general accounts, their
+total_type may be :
+
+    categories : account_prefix lists category labels (comma separated), the
+    total is the sum of the measures of these categories
+
+    complex_total : account_prefix is an arithmetic formula referencing
+    measure types or categories by label ("{Achats} + {Charges externes}")
+
+Complex totals may reference other totals, MeasureTotalGraph orders them
+(topological order) once and then computes the totals of each grid from the
+values of the measures built from the accounts.
+
+Formulas are evaluated through their syntax tree, only numbers, references,
+the four arithmetic operators and parentheses are allowed.
+"""
+import ast
+import operator
+
+from string import Formatter
+
+from autonomie_celery.tasks.utils import get_logger
+
+
+logger = get_logger(__name__)
+
+COMPUTED_TOTAL_TYPES = ('categories', 'complex_total')
+
+BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+}
+UNARY_OPERATORS = {
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+}
+
+
+class FormulaError(Exception):
+    """
+    Raised when a total's formula can't be evaluated
+    """
+    pass
+
+
+def _get_number(node):
+    """
+    Return the value of a number node or None if it's not a number
+    """
+    if hasattr(ast, 'Constant') and isinstance(node, ast.Constant):
+        value = node.value
+    elif isinstance(node, getattr(ast, 'Num', ())):
+        value = node.n
+    else:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    return value
+
+
+def _eval_node(node, variables):
+    """
+    Evaluate a formula's syntax tree node
+
+    :param obj node: An ast node
+    :param dict variables: The values of the variables
+    :rtype: float
+    """
+    if isinstance(node, ast.Expression):
+        return _eval_node(node.body, variables)
+
+    elif isinstance(node, ast.BinOp) and type(node.op) in BINARY_OPERATORS:
+        left = _eval_node(node.left, variables)
+        right = _eval_node(node.right, variables)
+        try:
+            return BINARY_OPERATORS[type(node.op)](left, right)
+        except ZeroDivisionError:
+            return 0
+
+    elif isinstance(node, ast.UnaryOp) and type(node.op) in UNARY_OPERATORS:
+        return UNARY_OPERATORS[type(node.op)](
+            _eval_node(node.operand, variables)
+        )
+
+    elif isinstance(node, ast.Name) and node.id in variables:
+        return variables[node.id]
+
+    value = _get_number(node)
+    if value is None:
+        raise FormulaError(
+            u"Unsupported expression : {0}".format(type(node).__name__)
+        )
+    return float(value)
+
+
+class Formula(object):
+    """
+    A compiled complex_total formula
+
+        formula = Formula(u"{Produits} - {Charges}")
+        formula.labels  # [u'Produits', u'Charges']
+        formula.evaluate({u'Produits': 10, u'Charges': 4})  # 6.0
+
+    :param str formula: The formula, references are enclosed in braces
+    """
+    def __init__(self, formula):
+        self.formula = formula
+        # Variable name -> referenced label
+        self.variables = {}
+        expression = []
+        names = {}
+        try:
+            for literal, label, _, _ in Formatter().parse(formula or u''):
+                expression.append(literal)
+                if label is not None:
+                    label = label.strip()
+                    if label not in names:
+                        names[label] = u"ref{0}".format(len(names))
+                        self.variables[names[label]] = label
+                    expression.append(u" {0} ".format(names[label]))
+            self.tree = ast.parse(u"".join(expression).strip(), mode='eval')
+        except (ValueError, SyntaxError) as err:
+            raise FormulaError(
+                u"Invalid formula {0} : {1}".format(formula, err)
+            )
+        # Invalid expressions are detected now rather than for each grid
+        _eval_node(self.tree, dict((name, 0) for name in self.variables))
+
+    @property
+    def labels(self):
+        return list(self.variables.values())
+
+    def evaluate(self, values):
+        """
+        Evaluate the formula
+
+        :param dict values: The referenced values by label (missing ones
+        are 0)
+        :rtype: float
+        """
+        return _eval_node(
+            self.tree,
+            dict(
+                (name, values.get(label, 0))
+                for name, label in self.variables.items()
+            )
+        )
+
+
+class MeasureTotalGraph(object):
+    """
+    Dependency graph of the computed total measure types
+
+        graph = MeasureTotalGraph(measure_types, total_types)
+        graph.evaluate(values)
+
+    :param list measure_types: The measure types built from the accounts
+    :param list total_types: The categories and complex_total measure types
+    """
+    def __init__(self, measure_types, total_types):
+        self.measure_types = list(measure_types)
+        # type id -> category label of the measures summed up by categories
+        self.categories = {}
+        self.type_ids = {}
+        # total type id -> category labels (categories totals)
+        self.category_labels = {}
+        # total type id -> Formula (complex totals)
+        self.formulas = {}
+        self.total_types = []
+        total_types = list(total_types)
+        if not total_types:
+            return
+
+        for measure_type in self.measure_types:
+            self.type_ids[measure_type.label] = measure_type.id
+            if not measure_type.is_total and measure_type.category:
+                self.categories[measure_type.id] = \
+                    measure_type.category.label
+
+        candidates = []
+        for measure_type in total_types:
+            if measure_type.total_type == 'categories':
+                labels = (measure_type.account_prefix or u'').split(',')
+                self.category_labels[measure_type.id] = [
+                    label.strip() for label in labels if label.strip()
+                ]
+            else:
+                try:
+                    self.formulas[measure_type.id] = Formula(
+                        measure_type.account_prefix
+                    )
+                except FormulaError as err:
+                    logger.error(
+                        u"The total {0} is ignored : {1}".format(
+                            measure_type.label, err
+                        )
+                    )
+                    continue
+            self.type_ids[measure_type.label] = measure_type.id
+            candidates.append(measure_type)
+
+        # Complex totals depend on the totals they reference
+        total_ids = set(measure_type.id for measure_type in candidates)
+        dependencies = {}
+        for measure_type in candidates:
+            formula = self.formulas.get(measure_type.id)
+            labels = formula.labels if formula is not None else ()
+            dependencies[measure_type.id] = set(
+                self.type_ids[label] for label in labels
+                if self.type_ids.get(label) in total_ids
+            )
+        self.total_types = self._sort(candidates, dependencies)
+
+    @staticmethod
+    def _sort(total_types, dependencies):
+        """
+        Sort the totals so that each one comes after the ones it references,
+        totals that are part of a cycle are dropped
+
+        :returns: The sorted measure types
+        :rtype: list
+        """
+        result = []
+        done = set()
+        remaining = list(total_types)
+        while remaining:
+            ready = [
+                measure_type for measure_type in remaining
+                if dependencies[measure_type.id] <= done
+            ]
+            if not ready:
+                logger.error(
+                    u"Circular references between the totals {0}, they're "
+                    u"ignored".format(
+                        u", ".join(
+                            measure_type.label for measure_type in remaining
+                        )
+                    )
+                )
+                break
+            for measure_type in ready:
+                result.append(measure_type)
+                done.add(measure_type.id)
+            remaining = [
+                measure_type for measure_type in remaining
+                if measure_type.id not in done
+            ]
+        return result
+
+    def evaluate(self, values):
+        """
+        Compute the totals of a grid
+
+        Formulas' references are resolved against the measure types' labels
+        first, then against the categories
+
+        :param dict values: {measure_type_id: value} of the grid, updated
+        with the totals
+        :returns: The values
+        """
+        if not self.total_types:
+            return values
+
+        category_values = {}
+        for type_id, value in values.items():
+            category = self.categories.get(type_id)
+            if category is not None:
+                category_values[category] = category_values.get(
+                    category, 0
+                ) + value
+
+        labelled = dict(category_values)
+        for label, type_id in self.type_ids.items():
+            labelled[label] = values.get(type_id, 0)
+
+        for measure_type in self.total_types:
+            labels = self.category_labels.get(measure_type.id)
+            if labels is not None:
+                value = sum(
+                    category_values.get(label, 0) for label in labels
+                )
+            else:
+                value = self.formulas[measure_type.id].evaluate(labelled)
+            values[measure_type.id] = value
+            labelled[measure_type.label] = value
+        return values
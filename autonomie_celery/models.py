@@ -34,10 +34,13 @@ from pyramid.security import (
 from sqlalchemy import (
     Integer,
     Column,
+    Date,
+    Float,
     ForeignKey,
     String,
     DateTime,
     Text,
+    Table,
 )
 from autonomie_base.models.types import (
     JsonEncodedList,
@@ -47,11 +50,16 @@ from autonomie_base.models.types import (
 )
 from autonomie_base.models.base import (
     DBBASE,
+    DBSESSION,
     default_table_args,
 )
 from sqlalchemy.orm import (
     relationship,
 )
+from autonomie.models.accounting.operations import (
+    AccountingOperation,
+    AccountingOperationUpload,
+)
 
 
 TIMEOUT = timedelta(seconds=10000)
@@ -204,6 +212,45 @@ class FileGenerationJob(Job):
         return res
 
 
+class MeasureBackfillJob(Job):
+    """
+    Store the progress of a measure recomputation over a range of uploads
+
+    The uploads to handle are listed when the job starts, the handled ones are
+    recorded with their measures so that an interrupted job can be resumed
+    """
+    __tablename__ = 'measure_backfill_job'
+    __table_args__ = default_table_args
+    __mapper_args__ = {'polymorphic_identity': 'measure_backfill'}
+    id = Column(Integer, ForeignKey('job.id'), primary_key=True)
+    # analytical_balance/general_ledger, None : both
+    filetype = Column(String(50), default=None)
+    start_date = Column(Date(), default=None)
+    end_date = Column(Date(), default=None)
+    upload_ids = Column(JsonEncodedList, default=None)
+    done_upload_ids = Column(JsonEncodedList, default=None)
+    messages = Column(JsonEncodedList, default=None)
+    error_messages = Column(JsonEncodedList, default=None)
+    label = u"Recalcul des indicateurs"
+
+    @property
+    def progress(self):
+        """
+        Return the number of handled uploads and the number of uploads
+
+        :rtype: tuple
+        """
+        return len(self.done_upload_ids or []), len(self.upload_ids or [])
+
+    def todict(self):
+        res = Job.todict(self)
+        res['label'] = self.label
+        res['messages'] = self.messages
+        res['error_messages'] = self.error_messages
+        res['done'], res['total'] = self.progress
+        return res
+
+
 class MailHistory(DBBASE):
     """
     Stores the history of mail sent by our application to any company
@@ -228,6 +275,114 @@ class MailHistory(DBBASE):
         return os.path.basename(self.filepath)
 
 
+class AccountingOperationUploadMetric(DBBASE):
+    """
+    Figures of a processing phase of an accounting file (parse, insert,
+    cleanup, compile ...)
+    """
+    __tablename__ = 'accounting_operation_upload_metric'
+    __table_args__ = default_table_args
+    id = Column(Integer, primary_key=True)
+    upload_id = Column(
+        ForeignKey('accounting_operation_upload.id', ondelete='cascade'),
+        nullable=False,
+    )
+    created_at = Column(
+        DateTime(),
+        default=datetime.now,
+    )
+    phase = Column(String(30), nullable=False)
+    # Wall and cpu time in seconds
+    wall = Column(Float, default=0)
+    cpu = Column(Float, default=0)
+    rows = Column(Integer, default=0)
+    # High-water mark of the worker process' resident set size in kB (it
+    # never decreases, see memory_delta for the phase's own usage)
+    peak_memory = Column(Integer, default=0)
+    # Largest growth of the resident set size during the phase in kB
+    memory_delta = Column(Integer, default=0)
+
+    @property
+    def rows_per_second(self):
+        if self.rows and self.wall:
+            return self.rows / self.wall
+        return None
+
+    def todict(self):
+        return dict(
+            upload_id=self.upload_id,
+            created_at=self.created_at.isoformat(),
+            phase=self.phase,
+            wall=self.wall,
+            cpu=self.cpu,
+            rows=self.rows,
+            rows_per_second=self.rows_per_second,
+            peak_memory=self.peak_memory,
+            memory_delta=self.memory_delta,
+        )
+
+    def __json__(self, request):
+        return self.todict()
+
+    @classmethod
+    def history(cls, phase=None, filetype=None):
+        """
+        Return the stored metrics ordered by date, e.g to graph the
+        ingestion throughput over time
+
+        :param str phase: Only return the metrics of this phase
+        :param str filetype: Only return the metrics of this type of files
+        """
+        query = DBSESSION().query(cls)
+        if phase is not None:
+            query = query.filter(cls.phase == phase)
+        if filetype is not None:
+            query = query.join(
+                AccountingOperationUpload,
+                AccountingOperationUpload.id == cls.upload_id,
+            ).filter(AccountingOperationUpload.filetype == filetype)
+        return query.order_by(cls.created_at, cls.id)
+
+
+def store_upload_metrics(upload_id, timer):
+    """
+    Store the figures collected by a PhaseTimer for the given upload
+
+    :param int upload_id: The id of an AccountingOperationUpload
+    :param obj timer: A autonomie_celery.tasks.utils.PhaseTimer instance
+    """
+    session = DBSESSION()
+    for phase in timer.phases.values():
+        session.add(
+            AccountingOperationUploadMetric(
+                upload_id=upload_id,
+                phase=phase.name,
+                wall=phase.wall,
+                cpu=phase.cpu,
+                rows=phase.rows,
+                peak_memory=phase.peak_memory,
+                memory_delta=phase.memory_delta,
+            )
+        )
+    session.flush()
+
+
+# Accounting operations are loaded here before being published in the
+# accounting_operation table (same columns, without foreign keys)
+ACCOUNTING_OPERATION_STAGING = Table(
+    'accounting_operation_staging',
+    DBBASE.metadata,
+    Column('id', Integer, primary_key=True),
+    Column('upload_id', Integer, nullable=False, index=True),
+    *[
+        Column(column.name, column.type)
+        for column in AccountingOperation.__table__.columns
+        if column.name not in ('id', 'upload_id')
+    ],
+    **default_table_args
+)
+
+
 def store_sent_mail(filepath, filedatas, company_id):
     """
     Stores a sent email in the history
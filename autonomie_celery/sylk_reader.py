@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+"""
+Incremental SYLK reader
+
+sylk_parser.SylkParser reads the whole file, stores the whole sheet and
+evaluates each cell value through eval before we get the first row.
+
+SylkReader reads the file by blocks and yields each row as soon as the
+following one is started, it gives the same rows as
+
+    SylkParser(file_path, use_unicode=True)
+
+for files written row after row (C records ordered by Y), which is the case of
+the files our accounting softwares produce. Quoted strings and plain numbers
+are converted without eval.
+"""
+import codecs
+import re
+import time
+
+from sylk_parser.sylk import SYLK
+
+
+SYLK_CHARSET = "cp1252"
+BLOCKSIZE = 65536
+
+LINE_SEPARATOR_RE = re.compile(u"[\r\n]+")
+FIELD_SEPARATOR_RE = re.compile(u"(?i);(?=[a-z])")
+INT_RE = re.compile(u"^[-+]?(0|[1-9][0-9]*)$")
+FLOAT_RE = re.compile(
+    u"^[-+]?([0-9]+\\.[0-9]*|\\.[0-9]+|[0-9]+(?=[eE]))([eE][-+]?[0-9]+)?$"
+)
+VOID_CELL = u' '
+
+
+class SylkError(Exception):
+    """
+    Raised when a SYLK file can't be streamed
+    """
+    pass
+
+
+class RowBuffer(object):
+    """
+    Replaces sylk_parser's Table : only the current row is kept, the previous
+    ones are stacked in finished_rows until they're consumed
+    """
+    def __init__(self):
+        self.row = None
+        self.row_number = 0
+        self.finished_rows = []
+
+    def __setitem__(self, xy_tuple, val):
+        """
+        Set a cell's value, rows are filled the same way sylk_parser's Table
+        does
+
+        :param tuple xy_tuple: The x,y coordinates as 2-uple
+        :param unicode val: The value to store in the grid
+        """
+        (x, y) = xy_tuple
+        if y < self.row_number or y < 1:
+            raise SylkError(
+                u"The cell ({0}, {1}) is set after the row {2}, the file "
+                u"is not written row after row".format(x, y, self.row_number)
+            )
+
+        elif y > self.row_number:
+            if self.row is not None:
+                self.finished_rows.append(self.row)
+            # Missing rows are created with the current width
+            for _ in range(self.row_number + 1, y):
+                self.finished_rows.append([VOID_CELL] * x)
+            self.row = [VOID_CELL] * x
+            self.row_number = y
+
+        if val not in (u'', u' '):
+            row = self.row
+            if len(row) < x:
+                row.extend([VOID_CELL] * (x - len(row)))
+            row[x - 1] = val
+
+    def pop_rows(self):
+        """
+        Return and forget the finished rows
+        """
+        result = self.finished_rows
+        self.finished_rows = []
+        return result
+
+    def close(self):
+        """
+        Finish the current row
+        """
+        if self.row is not None:
+            self.finished_rows.append(self.row)
+            self.row = None
+
+
+class SylkReader(SYLK):
+    """
+    Stream the rows of a SYLK file as lists of unicode cells
+
+        with open(file_path, 'rb') as fbuf:
+            for row in SylkReader(fbuf):
+                ...
+
+    :param obj fbuf: A file-like object opened in binary mode
+    :param str encoding: The file's encoding
+    """
+    def __init__(self, fbuf, encoding=SYLK_CHARSET, blocksize=BLOCKSIZE):
+        SYLK.__init__(self)
+        self.data = RowBuffer()
+        self.fbuf = fbuf
+        self.encoding = encoding
+        self.blocksize = blocksize
+
+    def _iter_lines(self):
+        """
+        Read the file by blocks and yield its lines
+        """
+        decoder = codecs.getincrementaldecoder(self.encoding)()
+        remaining = u''
+        while True:
+            block = self.fbuf.read(self.blocksize)
+            text = decoder.decode(block, final=not block)
+            lines = LINE_SEPARATOR_RE.split(remaining + text)
+            remaining = lines.pop()
+            for line in lines:
+                yield line
+            if not block:
+                break
+        yield remaining
+
+    def _to_text(self, val):
+        """
+        Convert a K field's value to the unicode string SylkParser would give
+        """
+        if val[0:1] == u'"':
+            if u'\\' not in val:
+                return val[1:-1].replace(u'"', u'""')
+        elif INT_RE.match(val):
+            return self._format_number(int(val))
+        elif FLOAT_RE.match(val):
+            return u"%s" % float(val)
+
+        # Unusual values are handled the way sylk_parser does
+        return self._format_number(eval(self.escape(val)))
+
+    def _format_number(self, val):
+        """
+        Format an evaluated value, integers may be date offsets
+
+        :rtype: unicode
+        """
+        if type(val) == int:
+            if self.currenttype == "date":
+                # value is offset in days from datebase
+                date = time.localtime(
+                    time.mktime(self.datebase) + float(val) * 24 * 60 * 60
+                )
+                val = time.strftime(self.date_output, date)
+        result = "%s" % val
+        if isinstance(result, bytes):
+            result = result.decode('utf-8')
+        return result
+
+    def _c_field(self, fields):
+        for f in fields[1:]:
+            ftd = f[0]
+            if ftd == u"X":
+                self.curx = int(f[1:])
+            elif ftd == u"Y":
+                self.cury = int(f[1:])
+            elif ftd == u"K":
+                self.data[(self.curx, self.cury)] = self._to_text(f[1:])
+
+    def parseline(self, line):
+        fields = FIELD_SEPARATOR_RE.split(line)
+        record_type = fields[0]
+        if record_type == u"C":
+            self._c_field(fields)
+        elif record_type == u"F":
+            self._f_field(fields)
+        elif record_type == u"P":
+            self._p_fields(fields)
+        elif record_type == u"ID":
+            self._id_field(fields)
+
+    def __iter__(self):
+        data = self.data
+        split = FIELD_SEPARATOR_RE.split
+        to_text = self._to_text
+        for line in self._iter_lines():
+            fields = split(line)
+            # C records are by far the most common ones, they're handled
+            # inline
+            if fields[0] == u"C":
+                for f in fields[1:]:
+                    ftd = f[0]
+                    if ftd == u"K":
+                        data[(self.curx, self.cury)] = to_text(f[1:])
+                    elif ftd == u"X":
+                        self.curx = int(f[1:])
+                    elif ftd == u"Y":
+                        self.cury = int(f[1:])
+                if data.finished_rows:
+                    for row in data.pop_rows():
+                        yield row
+            else:
+                self.parseline(line)
+        data.close()
+        for row in data.pop_rows():
+            yield row
+
+
+def stream_sylk_file(file_path, encoding=SYLK_CHARSET):
+    """
+    Stream the rows of the given SYLK file
+
+    :param str file_path: The path to the file
+    :param str encoding: The file's encoding
+    :returns: An iterator of lists of unicode cells
+    """
+    with open(file_path, 'rb') as fbuf:
+        for row in SylkReader(fbuf, encoding=encoding):
+            yield row
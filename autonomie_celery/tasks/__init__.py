@@ -45,20 +45,45 @@ def _add_userdatas_custom_headers(writer, query):
     return writer
 
 
-def _add_userdatas_code_compta(writer, userdatas):
+def _get_userdatas_code_compta_hook(query):
     """
-    Add code compta to exports (specific for userdatas exports)
+    Build the row hook adding code compta to exports (specific for userdatas
+    exports)
 
-    :param obj writer: The tabbed file writer
-    :param obj userdatas: The UserDatas instance we manage
+    The analytical accounts of each user are collected once for the whole
+    export
+
+    :param obj query: The query of the exported UserDatas
+    :returns: A hook_add_row function
     """
-    user_account = userdatas.user
-    if user_account:
-        datas = []
-        for company in user_account.companies:
-            datas.append(company.code_compta)
-        writer.add_extra_datas(datas)
-    return writer
+    from autonomie_base.models.base import DBSESSION
+    from autonomie.models.user.user import COMPANY_EMPLOYEE
+    from autonomie_celery.company_cache import get_company_index
+
+    company_index = get_company_index()
+    codes_by_account = {}
+    employees = DBSESSION().query(
+        COMPANY_EMPLOYEE.c.account_id,
+        COMPANY_EMPLOYEE.c.company_id,
+    ).order_by(COMPANY_EMPLOYEE.c.company_id)
+    for account_id, company_id in employees:
+        codes_by_account.setdefault(account_id, []).append(
+            company_index.get_code_compta(company_id)
+        )
+
+    def _add_userdatas_code_compta(writer, userdatas):
+        """
+        Add code compta to exports
+
+        :param obj writer: The tabbed file writer
+        :param obj userdatas: The UserDatas instance we manage
+        """
+        if userdatas.user_id:
+            datas = codes_by_account.get(userdatas.user_id, [])
+            writer.add_extra_datas(list(datas))
+        return writer
+
+    return _add_userdatas_code_compta
 
 
 def _add_invoice_custom_headers(writer, invoices):
@@ -137,7 +162,7 @@ def includeme(config):
         model=UserDatas,
         options={
             'hook_init': _add_userdatas_custom_headers,
-            'hook_add_row': _add_userdatas_code_compta,
+            'hook_add_row_factory': _get_userdatas_code_compta_hook,
             'foreign_key_name': 'userdatas_id',
         }
     )
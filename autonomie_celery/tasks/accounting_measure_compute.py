@@ -5,11 +5,41 @@
 #       * Miotte Julien <j.m@majerti.fr>;
 """
 Tasks used to compile treasury measures
+
+Three backends are available (autonomie.measure_compiler.backend setting) :
+
+    python : the upload's operations are loaded and summed up one by one
+
+    sql : the operations are summed up by the database (by company, general
+    account and month for income statements), the compiler then handles the
+    aggregates as operations
+
+    numpy : the operations are loaded as columns and summed up by grid and
+    measure type with numpy (if installed)
+
+With the python and sql backends, the values of big uploads can be computed
+by a process pool (autonomie.measure_compiler.processes setting), the
+operations are partitioned by company.
+
+The income statement totals built from categories or formulas are then
+computed from the grids' values (see autonomie_celery.measure_totals) and
+stored with the other measures.
 """
+import datetime
+import heapq
 import transaction
 
+from collections import OrderedDict
+
+from billiard import Pool
 from pyramid_celery import celery_app
-from sqlalchemy import or_
+from sqlalchemy import (
+    extract,
+    func,
+    or_,
+)
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.attributes import set_committed_value
 from autonomie_base.models.base import DBSESSION
 from autonomie.models.accounting.operations import (
     AccountingOperationUpload,
@@ -26,10 +56,136 @@ from autonomie.models.accounting.income_statement_measures import (
     IncomeStatementMeasureType,
 )
 
+from autonomie_celery.conf import get_setting
+from autonomie_celery.measure_totals import (
+    COMPUTED_TOTAL_TYPES,
+    MeasureTotalGraph,
+)
+from autonomie_celery.models import MeasureBackfillJob
 from autonomie_celery.tasks import utils
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 logger = utils.get_logger(__name__)
+# Number of decimals considered when checking if a measure's value changed
+VALUE_PRECISION = 2
+# Number of operations summed up between two heartbeats of the compilation
+HEARTBEAT_BATCH_SIZE = 10000
+
+
+class MeasureTypeIndex(object):
+    """
+    Index of measure types by account prefix
+
+    The prefixes of the measure types are stored in a trie, the types
+    matching a general account are then found in a single walk along the
+    account's characters and confirmed with their match method (so that the
+    result is always the one match gives). Results are cached by account.
+
+    :param list measure_types: The measure types to index
+    """
+    def __init__(self, measure_types):
+        self.measure_types = list(measure_types)
+        # Trie nodes : {char: node}, the positions of the types whose prefix
+        # ends at a node are stored under the None key
+        self.root = {}
+        # Types that can't be indexed (empty prefix ...)
+        self.unindexed = []
+        self.cache = {}
+        for position, measure_type in enumerate(self.measure_types):
+            prefixes = self._get_prefixes(measure_type)
+            if prefixes is None:
+                self.unindexed.append(position)
+            else:
+                for prefix in prefixes:
+                    self._add(prefix, position)
+
+    @staticmethod
+    def _get_prefixes(measure_type):
+        """
+        Return the prefixes an account should start with to match the given
+        type (exclusions are left to the match method)
+
+        :returns: A list of prefixes or None if any account may match
+        """
+        prefixes = []
+        for prefix in (measure_type.account_prefix or u'').split(','):
+            prefix = prefix.strip()
+            if prefix.startswith('-'):
+                continue
+            elif not prefix:
+                return None
+            prefixes.append(prefix)
+        return prefixes or None
+
+    def _add(self, prefix, position):
+        node = self.root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node.setdefault(None, []).append(position)
+
+    def _get_candidates(self, account):
+        """
+        Return the positions of the types whose prefixes match the account
+        """
+        result = set(self.unindexed)
+        node = self.root
+        result.update(node.get(None, ()))
+        for char in account:
+            node = node.get(char)
+            if node is None:
+                break
+            result.update(node.get(None, ()))
+        return sorted(result)
+
+    def get(self, account):
+        """
+        Return the measure types matching the given general account (in the
+        order they were provided)
+
+        :param str account: A general account
+        :rtype: list
+        """
+        result = self.cache.get(account)
+        if result is None:
+            if account is None:
+                candidates = self.measure_types
+            else:
+                candidates = [
+                    self.measure_types[position]
+                    for position in self._get_candidates(account)
+                ]
+            result = self.cache[account] = [
+                measure_type for measure_type in candidates
+                if measure_type.match(account)
+            ]
+        return result
+
+
+def _value_changed(old_value, new_value):
+    """
+    Check if a measure's value changed (amounts have two decimals)
+
+    :rtype: bool
+    """
+    if old_value is None:
+        return True
+    return round(old_value, VALUE_PRECISION) != round(
+        new_value, VALUE_PRECISION
+    )
+
+
+def _to_set(values):
+    """
+    Convert an optional list to a set
+    """
+    if values is None:
+        return None
+    return set(values)
 
 
 class BaseMeasureCompiler(object):
@@ -40,12 +196,28 @@ class BaseMeasureCompiler(object):
     measure_grid_class = None
     measure_class = None
 
-    def __init__(self, upload, operations):
+    def __init__(
+        self, upload, operations, company_ids=None, months=None,
+        type_cache=None, heartbeat=None
+    ):
         self.upload = upload
         self.operations = operations
+        # Restrict the compilation to some companies (and months), None : all
+        self.company_ids = _to_set(company_ids)
+        self.months = _to_set(months)
+        # Called regularly during long compilations (see compile_measures)
+        self.heartbeat = heartbeat
         self.session = DBSESSION()
 
-        self.measure_types = self._collect_measure_types()
+        if type_cache is None:
+            measure_types = self._collect_measure_types()
+            self.type_index = MeasureTypeIndex(measure_types)
+            self.total_graph = MeasureTotalGraph(
+                self.type_index.measure_types, self._collect_total_types()
+            )
+        else:
+            self.type_index, self.total_graph = type_cache
+        self.measure_types = self.type_index.measure_types
 
         self.grids = self.collect_existing_grids()
         self.measures = self.collect_existing_measures(self.grids)
@@ -53,6 +225,118 @@ class BaseMeasureCompiler(object):
     def _collect_measure_types(self):
         return self.measure_type_class.query().filter_by(active=True)
 
+    def beat(self):
+        """
+        Signal that the compilation is still running
+        """
+        if self.heartbeat is not None:
+            self.heartbeat()
+
+    def _collect_total_types(self):
+        """
+        Return the total measure types computed from the other measures
+        """
+        return []
+
+    def get_type_cache(self):
+        """
+        Return the measure types' index and totals graph so that they can be
+        shared with the compilers of the next uploads (see
+        backfill_measures_task)
+
+        The measure types are detached from the session, they're not
+        refreshed when the current transaction is committed
+
+        :returns: A 2-uple (MeasureTypeIndex, MeasureTotalGraph)
+        """
+        for measure_type in (
+            self.type_index.measure_types + self.total_graph.total_types
+        ):
+            self.session.expunge(measure_type)
+        return self.type_index, self.total_graph
+
+    @classmethod
+    def filter_operations(cls, query, company_ids=None, months=None):
+        """
+        Restrict an AccountingOperation query to the given companies
+
+        :param obj query: A query on AccountingOperation columns
+        :param list company_ids: Company ids or None for all companies
+        :param list months: Ignored, treasuries are not monthly
+        """
+        if company_ids is not None:
+            query = query.filter(
+                AccountingOperation.company_id.in_(list(company_ids))
+            )
+        return query
+
+    def is_in_scope(self, operation):
+        """
+        Should the given operation be compiled
+
+        :rtype: bool
+        """
+        if operation.company_id is None:
+            return False
+        return self.company_ids is None or \
+            operation.company_id in self.company_ids
+
+    @classmethod
+    def _get_group_columns(cls):
+        """
+        Return the columns the operations are grouped by in sql mode
+        """
+        return [
+            AccountingOperation.company_id,
+            AccountingOperation.general_account,
+        ]
+
+    @classmethod
+    def _build_aggregate(cls, upload, row):
+        """
+        Build a transient AccountingOperation from an aggregated row
+
+        :param obj upload: The AccountingOperationUpload
+        :param obj row: The sql result row
+        """
+        return AccountingOperation(
+            company_id=row.company_id,
+            general_account=row.general_account,
+            date=upload.date,
+            debit=row.debit or 0,
+            credit=row.credit or 0,
+            balance=row.balance or 0,
+        )
+
+    @classmethod
+    def aggregate_operations(cls, upload, company_ids=None, months=None):
+        """
+        Sum up the upload's operations in the database
+
+        The returned AccountingOperation instances are not attached to the
+        session, since total() is a linear combination of the amounts, the
+        total of an aggregate is the sum of the totals of its operations
+
+        :param obj upload: The AccountingOperationUpload
+        :param list company_ids: Only sum up the operations of these companies
+        :param list months: Only sum up the operations of these months
+        :returns: A list of transient AccountingOperation
+        """
+        group_columns = cls._get_group_columns()
+        query = DBSESSION().query(
+            *group_columns + [
+                func.sum(AccountingOperation.debit).label('debit'),
+                func.sum(AccountingOperation.credit).label('credit'),
+                func.sum(AccountingOperation.balance).label('balance'),
+            ]
+        ).filter(
+            AccountingOperation.upload_id == upload.id
+        ).filter(
+            AccountingOperation.company_id != None
+        ).group_by(*group_columns)
+        query = cls.filter_operations(query, company_ids, months)
+        return [cls._build_aggregate(upload, row) for row in query]
+
     def get_cache_key_from_grid(self, grid):
         """
         Build a cache key based on the given grid object
@@ -74,7 +358,9 @@ class BaseMeasureCompiler(object):
     def collect_existing_measures(self, grids):
         """
         Build the measures dict based on the given existing grids
-        Also reset all values to 0
+
+        Values are left untouched, store_values only writes the ones that
+        changed
 
         :param dict grids: The grid cache
 
@@ -87,7 +373,6 @@ class BaseMeasureCompiler(object):
             cache_key = self.get_cache_key_from_grid(grid)
             company_measures = result[cache_key] = {}
             for measure in grid.measures:
-                measure.value = 0
                 company_measures[measure.measure_type_id] = measure
 
         return result
@@ -104,28 +389,75 @@ class BaseMeasureCompiler(object):
             result = self.measures[key] = {}
         return result
 
-    def _get_new_measure(self, label, grid_id, measure_type_id=None):
+    def _get_new_measure(self, label, grid_id, measure_type_id=None, value=0):
         """
-        Build a new measure
+        Build a new measure (it's not added to the session)
         """
-        measure = self.measure_class(
+        return self.measure_class(
             label=label,
             grid_id=grid_id,
             measure_type_id=measure_type_id,
+            value=value,
+        )
+
+    def _update_measures(self, updates):
+        """
+        Write the new values of existing measures in a single batched UPDATE
+
+        :param list updates: List of 2-uples (measure, new value)
+        """
+        self.session.bulk_update_mappings(
+            self.measure_class,
+            [
+                {'id': measure.id, 'value': value}
+                for measure, value in updates
+            ]
+        )
+        # The instances are kept in sync without being marked as dirty
+        for measure, value in updates:
+            set_committed_value(measure, 'value', value)
+
+    def _insert_measures(self, measures):
+        """
+        Insert the given new measures in bulk
+
+        :param list measures: Measure instances
+        """
+        mapper = self.measure_class.__mapper__
+        # With joined table inheritance, the primary keys of the parent rows
+        # are needed to insert the child rows
+        return_defaults = (
+            mapper.inherits is not None and
+            mapper.local_table is not mapper.inherits.local_table
         )
-        self.session.add(measure)
-        self.session.flush()
-        return measure
+        self.session.bulk_save_objects(
+            measures, return_defaults=return_defaults
+        )
+
+    def _filter_grids(self, query):
+        """
+        Restrict the grids query to the grids of the upload's period
+
+        :param obj query: The grids query
+        """
+        return query
 
     def collect_existing_grids(self):
         """
-        Collect grids already built on the given upload
+        Collect the grids of the upload's period with their measures (loaded
+        in the same query)
 
         :rtype: dict that should allow to retrieve grid regarding an operation
         """
+        grid_class = self.measure_grid_class
+        query = grid_class.query().options(joinedload(grid_class.measures))
+        if self.company_ids is not None:
+            query = query.filter(
+                grid_class.company_id.in_(list(self.company_ids))
+            )
         # Stores grids : {'company1_id': <TreasuryMeasureGrid>}
         grids = {}
-        for grid in self.measure_grid_class.query():
+        for grid in self._filter_grids(query):
             key = self.get_cache_key_from_grid(grid)
             grids[key] = grid
         return grids
@@ -147,46 +479,127 @@ class BaseMeasureCompiler(object):
         key = self.get_cache_key_from_grid(new_grid)
         self.grids[key] = new_grid
 
-    def process_datas(self):
+    def compute_values(self, operations=None):
         """
-        Compile measures based on the given operations
+        Sum up the operations' totals by grid and measure type
+
+        :param list operations: The operations to handle (defaults to the
+        compiler's ones)
+        :returns: An OrderedDict {grid cache key: {measure_type_id: value}},
+        all the grids the operations refer to are present
+        :rtype: dict
         """
-        logger.debug("    + Processing datas")
-        for operation in self.operations:
-            if operation.company_id is None:
+        if operations is None:
+            operations = self.operations
+        result = OrderedDict()
+        for position, operation in enumerate(operations):
+            if position % HEARTBEAT_BATCH_SIZE == 0:
+                self.beat()
+            if not self.is_in_scope(operation):
                 continue
 
-            grid = self.get_grid(operation)
+            key = self.get_cache_key_from_operation(operation)
+            values = result.get(key)
+            if values is None:
+                values = result[key] = {}
+
+            measure_types = self.type_index.get(operation.general_account)
+            if measure_types:
+                total = operation.total()
+                for measure_type in measure_types:
+                    values[measure_type.id] = values.get(
+                        measure_type.id, 0
+                    ) + total
+        return result
+
+    def store_values(self, values):
+        """
+        Store computed values in the grids' measures, missing grids and
+        measures are created in bulk
+
+        :param dict values: The values as returned by compute_values
+        :returns: The grids cache
+        :rtype: dict
+        """
+        labels = dict(
+            (measure_type.id, measure_type.label)
+            for measure_type in (
+                self.type_index.measure_types + self.total_graph.total_types
+            )
+        )
+
+        # New grids are flushed together to get their ids
+        new_grids = []
+        for key in values:
+            grid = self.grids.get(key)
             if grid is None:
-                grid = self._get_new_grid(operation)
+                grid = self._get_new_grid(key)
                 self.store_grid(grid)
-                self.session.add(grid)
-                self.session.flush()
-            else:
+                new_grids.append(grid)
+            elif getattr(grid, 'date', None) != self.upload.date:
                 grid.date = self.upload.date
+        if new_grids:
+            self.session.add_all(new_grids)
+            self.session.flush()
+            self.beat()
 
-            company_measures = self.get_measures(operation)
-
-            matched = False
-            for measure_type in self.measure_types:
-                if measure_type.match(operation.general_account):
-                    measure = company_measures.get(measure_type.id)
-                    if measure is None:
-                        measure = self._get_new_measure(
-                            measure_type.label,
-                            grid.id,
-                            measure_type.id
-                        )
-                        company_measures[measure_type.id] = measure
+        # Existing measures of the period : only the changed values are
+        # written (measures no operation refers to anymore are set to 0)
+        updates = []
+        for key, company_measures in self.measures.items():
+            type_values = values.get(key, {})
+            for measure_type_id, measure in company_measures.items():
+                value = type_values.get(measure_type_id, 0)
+                if _value_changed(measure.value, value):
+                    updates.append((measure, value))
+        if updates:
+            self._update_measures(updates)
+            self.beat()
 
-                    measure.value += operation.total()
-                    matched = True
+        new_measures = []
+        for key, type_values in values.items():
+            grid = self.grids[key]
+            company_measures = self.measures.get(key)
+            if company_measures is None:
+                company_measures = self.measures[key] = {}
 
-            if matched:
-                self.session.merge(measure)
+            for measure_type_id, value in type_values.items():
+                if measure_type_id not in company_measures:
+                    measure = self._get_new_measure(
+                        labels[measure_type_id],
+                        grid.id,
+                        measure_type_id,
+                        value=value,
+                    )
+                    company_measures[measure_type_id] = measure
+                    new_measures.append(measure)
+        if new_measures:
+            self._insert_measures(new_measures)
 
+        logger.debug(
+            u"    + {0} new grids, {1} new measures, {2} updated "
+            u"measures".format(len(new_grids), len(new_measures), len(updates))
+        )
         return self.grids
 
+    def compute_totals(self, values):
+        """
+        Add the computed totals to the values of each grid
+
+        :param dict values: The values as returned by compute_values
+        :returns: The values
+        """
+        for type_values in values.values():
+            self.total_graph.evaluate(type_values)
+        return values
+
+    def process_datas(self):
+        """
+        Compile measures based on the given operations
+        """
+        logger.debug("    + Processing datas")
+        return self.store_values(self.compute_totals(self.compute_values()))
+
 
 class TreasuryMeasureCompiler(BaseMeasureCompiler):
     measure_type_class = TreasuryMeasureType
@@ -205,16 +618,18 @@ class TreasuryMeasureCompiler(BaseMeasureCompiler):
         """
         return grid.company_id
 
-    def _get_new_grid(self, operation):
+    def _filter_grids(self, query):
+        return query.filter(TreasuryMeasureGrid.date == self.upload.date)
+
+    def _get_new_grid(self, key):
         """
-        Build a new grid based on the given operation
+        Build a new grid
 
-        :param obj operation: The AccountingOperation from which we build
-        measure
+        :param int key: The grid's cache key (company_id)
         """
         return TreasuryMeasureGrid(
             date=self.upload.date,
-            company_id=operation.company_id,
+            company_id=key,
             upload=self.upload,
         )
 
@@ -235,6 +650,26 @@ class IncomeStatementMeasureCompiler(BaseMeasureCompiler):
             )
         )
 
+    def _collect_total_types(self):
+        return self.measure_type_class.query(
+        ).filter_by(
+            active=True, is_total=True
+        ).filter(
+            IncomeStatementMeasureType.total_type.in_(COMPUTED_TOTAL_TYPES)
+        ).all()
+
+    @classmethod
+    def _get_group_columns(cls):
+        return BaseMeasureCompiler._get_group_columns() + [
+            extract('month', AccountingOperation.date).label('month'),
+        ]
+
+    @classmethod
+    def _build_aggregate(cls, upload, row):
+        result = BaseMeasureCompiler._build_aggregate(upload, row)
+        result.date = datetime.date(upload.date.year, int(row.month), 1)
+        return result
+
     def get_cache_key_from_operation(self, operation):
         """
         Build a cache key based on the given operation object
@@ -247,21 +682,375 @@ class IncomeStatementMeasureCompiler(BaseMeasureCompiler):
         """
         return (grid.company_id, grid.month)
 
-    def _get_new_grid(self, operation):
+    def _filter_grids(self, query):
+        query = query.filter(
+            IncomeStatementMeasureGrid.year == self.upload.date.year
+        )
+        if self.months is not None:
+            query = query.filter(
+                IncomeStatementMeasureGrid.month.in_(list(self.months))
+            )
+        return query
+
+    @classmethod
+    def filter_operations(cls, query, company_ids=None, months=None):
+        query = BaseMeasureCompiler.filter_operations(
+            query, company_ids, months
+        )
+        if months is not None:
+            query = query.filter(
+                extract('month', AccountingOperation.date).in_(list(months))
+            )
+        return query
+
+    def is_in_scope(self, operation):
+        if not BaseMeasureCompiler.is_in_scope(self, operation):
+            return False
+        return self.months is None or operation.date.month in self.months
+
+    def _get_new_grid(self, key):
         """
-        Build a new grid based on the given operation
+        Build a new grid
 
-        :param obj operation: The AccountingOperation from which we build
-        measure
+        :param tuple key: The grid's cache key (company_id, month)
         """
+        company_id, month = key
         return IncomeStatementMeasureGrid(
             year=self.upload.date.year,
-            month=operation.date.month,
-            company_id=operation.company_id,
+            month=month,
+            company_id=company_id,
             upload=self.upload,
         )
 
 
+def _get_total_coefficients():
+    """
+    Return the (debit, credit, balance) coefficients of
+    AccountingOperation.total or None if it's not a linear combination of the
+    amounts
+
+    :rtype: tuple
+    """
+    try:
+        coefficients = tuple(
+            AccountingOperation(debit=debit, credit=credit, balance=balance)
+            .total()
+            for debit, credit, balance in ((1, 0, 0), (0, 1, 0), (0, 0, 1))
+        )
+        check = AccountingOperation(
+            debit=3.5, credit=-2.25, balance=7.0
+        ).total()
+    except Exception:
+        return None
+
+    expected = sum(
+        coefficient * amount
+        for coefficient, amount in zip(coefficients, (3.5, -2.25, 7.0))
+    )
+    if abs(check - expected) > 1e-9:
+        return None
+    return coefficients
+
+
+class NumpyMeasureEngine(object):
+    """
+    Compute the measure values of a compiler with numpy
+
+    The operations are turned into column arrays (grid index, account index,
+    amounts), the account -> measure types membership is stored as a sparse
+    (CSR) matrix and the values of all the grids are computed with a single
+    bincount. Values are added in the operations' order, the result is the
+    one BaseMeasureCompiler.compute_values returns.
+
+        engine = NumpyMeasureEngine(compiler)
+        compiler.store_values(engine.compute_values())
+
+    :param obj compiler: A BaseMeasureCompiler instance
+    """
+    def __init__(self, compiler):
+        self.compiler = compiler
+        self.coefficients = _get_total_coefficients()
+
+    @classmethod
+    def load_operations(
+        cls, upload, compiler_factory, company_ids=None, months=None
+    ):
+        """
+        Load the upload's operations as light rows (not ORM instances) if
+        the totals can be computed from the amounts
+
+        :param obj upload: The AccountingOperationUpload
+        :param class compiler_factory: The compiler class
+        :param list company_ids: Only load the operations of these companies
+        :param list months: Only load the operations of these months
+        :returns: A list of objects with the AccountingOperation's attributes
+        """
+        if _get_total_coefficients() is None:
+            query = AccountingOperation.query()
+        else:
+            query = DBSESSION().query(
+                AccountingOperation.company_id,
+                AccountingOperation.general_account,
+                AccountingOperation.date,
+                AccountingOperation.debit,
+                AccountingOperation.credit,
+                AccountingOperation.balance,
+            )
+        query = query.filter(AccountingOperation.upload_id == upload.id)
+        query = compiler_factory.filter_operations(query, company_ids, months)
+        return query.order_by(AccountingOperation.id).all()
+
+    def _get_totals(self, operations):
+        """
+        Return the totals of the given operations as an array
+
+        :param list operations: The operations
+        """
+        if self.coefficients is None:
+            return numpy.array(
+                [operation.total() for operation in operations],
+                dtype=float,
+            )
+        totals = None
+        for coefficient, name in zip(
+            self.coefficients, ('debit', 'credit', 'balance')
+        ):
+            if coefficient:
+                values = numpy.array(
+                    [getattr(operation, name) for operation in operations],
+                    dtype=float,
+                )
+                term = coefficient * values
+                totals = term if totals is None else totals + term
+        if totals is None:
+            totals = numpy.zeros(len(operations))
+        return totals
+
+    def _get_membership(self, accounts, positions):
+        """
+        Build the account -> measure type positions CSR matrix
+
+        :param dict accounts: {general account: account index}
+        :param dict positions: {measure_type_id: measure type position}
+        :returns: A 2-uple (row pointers, measure type positions) of arrays
+        """
+        pointers = [0]
+        type_positions = []
+        for account in sorted(accounts, key=accounts.get):
+            type_positions.extend(
+                positions[measure_type.id]
+                for measure_type in self.compiler.type_index.get(account)
+            )
+            pointers.append(len(type_positions))
+        return (
+            numpy.array(pointers, dtype=numpy.intp),
+            numpy.array(type_positions, dtype=numpy.intp),
+        )
+
+    def compute_values(self):
+        """
+        Sum up the operations' totals by grid and measure type
+
+        :returns: An OrderedDict {grid cache key: {measure_type_id: value}}
+        :rtype: dict
+        """
+        compiler = self.compiler
+        measure_types = compiler.type_index.measure_types
+        positions = dict(
+            (measure_type.id, position)
+            for position, measure_type in enumerate(measure_types)
+        )
+
+        operations = [
+            operation for operation in compiler.operations
+            if compiler.is_in_scope(operation)
+        ]
+        # Grid keys and accounts are numbered in their order of appearance
+        keys = OrderedDict()
+        key_indexes = [
+            keys.setdefault(key, len(keys)) for key in map(
+                compiler.get_cache_key_from_operation, operations
+            )
+        ]
+        accounts = {}
+        account_indexes = [
+            accounts.setdefault(operation.general_account, len(accounts))
+            for operation in operations
+        ]
+
+        result = OrderedDict((key, {}) for key in keys)
+        if not operations:
+            return result
+
+        pointers, type_positions = self._get_membership(accounts, positions)
+        account_indexes = numpy.array(account_indexes, dtype=numpy.intp)
+        starts = pointers[:-1][account_indexes]
+        counts = pointers[1:][account_indexes] - starts
+        num_matches = int(counts.sum())
+        if not num_matches:
+            return result
+
+        # One entry by (operation, matching measure type), in the
+        # operations' order
+        rows = numpy.repeat(numpy.arange(len(operations)), counts)
+        offsets = numpy.arange(num_matches) - numpy.repeat(
+            numpy.cumsum(counts) - counts, counts
+        )
+        matched_positions = type_positions[
+            numpy.repeat(starts, counts) + offsets
+        ]
+
+        num_types = len(measure_types)
+        bins = (
+            numpy.array(key_indexes, dtype=numpy.intp)[rows] * num_types +
+            matched_positions
+        )
+        size = len(keys) * num_types
+        totals = self._get_totals(operations)
+        sums = numpy.bincount(bins, weights=totals[rows], minlength=size)
+        matched = numpy.bincount(bins, minlength=size) > 0
+
+        key_list = list(keys)
+        for bin_index in numpy.flatnonzero(matched):
+            key_index, position = divmod(int(bin_index), num_types)
+            measure_type_id = measure_types[position].id
+            result[key_list[key_index]][measure_type_id] = float(
+                sums[bin_index]
+            )
+        return result
+
+
+# Engine used in the processes of the compilation pool (inherited on fork)
+_POOL_ENGINE = None
+
+
+def _init_pool_engine(engine):
+    global _POOL_ENGINE
+    _POOL_ENGINE = engine
+
+
+def _compute_partition_values(index):
+    """
+    Compute the measure values of a partition of the operations
+
+    :param int index: The index of the partition
+    :returns: An OrderedDict {grid cache key: {measure_type_id: value}}
+    """
+    engine = _POOL_ENGINE
+    operations = engine.operations
+    return engine.compiler.compute_values(
+        [operations[position] for position in engine.partitions[index]]
+    )
+
+
+class ProcessPoolMeasureEngine(object):
+    """
+    Compute the measure values of a compiler in a process pool
+
+    Companies are independent : the operations are partitioned by company
+    (partitions of similar sizes), each partition is handled by
+    BaseMeasureCompiler.compute_values in a forked process and the results
+    are merged in the parent process, the storage is left to the compiler.
+    Since the operations of a company keep their order, the values are the
+    ones the compiler computes on its own.
+
+        engine = ProcessPoolMeasureEngine(compiler, processes=4)
+        compiler.store_values(engine.compute_values())
+
+    The processes don't access the database, small uploads are handled in
+    the current process.
+
+    :param obj compiler: A BaseMeasureCompiler instance
+    :param int processes: The number of processes
+    """
+    # Under this number of operations, forking costs more than it saves
+    min_operations = 20000
+
+    def __init__(self, compiler, processes):
+        self.compiler = compiler
+        self.processes = processes
+        self.operations = list(compiler.operations)
+        self.partitions = []
+
+    def _get_partitions(self):
+        """
+        Split the operations in balanced partitions by company
+
+        :returns: A list of lists of operation positions (in the operations'
+        order)
+        """
+        by_company = OrderedDict()
+        for position, operation in enumerate(self.operations):
+            if self.compiler.is_in_scope(operation):
+                by_company.setdefault(operation.company_id, []).append(
+                    position
+                )
+
+        num_partitions = min(self.processes, len(by_company))
+        # (number of operations, partition index) heap, the biggest companies
+        # are dispatched first to the least loaded partition
+        heap = [(0, index) for index in range(num_partitions)]
+        partitions = [[] for _ in range(num_partitions)]
+        for positions in sorted(by_company.values(), key=len, reverse=True):
+            size, index = heapq.heappop(heap)
+            partitions[index].extend(positions)
+            heapq.heappush(heap, (size + len(positions), index))
+
+        for positions in partitions:
+            positions.sort()
+        return partitions
+
+    def _warm_type_index(self):
+        """
+        Match the accounts in the current process so that the forked ones
+        inherit the measure type index's cache
+        """
+        type_index = self.compiler.type_index
+        for account in set(
+            operation.general_account for operation in self.operations
+        ):
+            type_index.get(account)
+
+    def compute_values(self):
+        """
+        Sum up the operations' totals by grid and measure type
+
+        :returns: An OrderedDict {grid cache key: {measure_type_id: value}}
+        :rtype: dict
+        """
+        if self.processes < 2 or len(self.operations) < self.min_operations:
+            return self.compiler.compute_values(self.operations)
+
+        self.partitions = self._get_partitions()
+        if len(self.partitions) < 2:
+            return self.compiler.compute_values(self.operations)
+
+        self._warm_type_index()
+        logger.info(
+            u"  + Computing the measures of {0} operations with {1} "
+            u"processes".format(len(self.operations), len(self.partitions))
+        )
+        result = OrderedDict()
+        pool = Pool(
+            len(self.partitions),
+            initializer=_init_pool_engine,
+            initargs=(self,),
+        )
+        try:
+            for values in pool.imap(
+                _compute_partition_values, range(len(self.partitions))
+            ):
+                result.update(values)
+                self.compiler.beat()
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        return result
+
+
 def get_measure_compiler(data_type):
     """
     Retrieve the measure compilers to be used with this given type of datas
@@ -277,6 +1066,99 @@ def get_measure_compiler(data_type):
         return IncomeStatementMeasureCompiler
 
 
+def get_compiler_backend():
+    """
+    Return the configured measure compiler backend (python/sql/numpy)
+    """
+    return get_setting('autonomie.measure_compiler.backend', default='python')
+
+
+def get_compiler_processes():
+    """
+    Return the number of processes computing the measure values
+    """
+    return int(
+        get_setting('autonomie.measure_compiler.processes', default=1)
+    )
+
+
+def compile_measures(
+    upload, backend=None, company_ids=None, months=None, type_caches=None,
+    processes=None, heartbeat=None
+):
+    """
+    Compile the measures of the given upload
+
+    If company ids (and months) are provided, only the grids of these
+    companies (and months for income statements) are recomputed, the other
+    ones are left untouched
+
+    :param obj upload: The AccountingOperationUpload
+    :param str backend: python/sql/numpy (defaults to the configured one)
+    :param list company_ids: The affected companies (None : all)
+    :param list months: The affected months (None : all)
+    :param dict type_caches: Measure types shared between several calls
+    {compiler class: type cache}, filled on first use
+    :param int processes: The number of processes computing the values
+    (defaults to the configured one)
+    :param func heartbeat: Called without argument between the steps (and
+    operation batches) of the compilation
+    :returns: The grids that were handled
+    :rtype: dict
+    """
+    if company_ids is not None and not company_ids:
+        logger.info(u"  + No company is affected, nothing to compile")
+        return {}
+    if months is not None and not months:
+        months = None
+
+    backend = backend or get_compiler_backend()
+    if backend == 'numpy' and numpy is None:
+        logger.warn(u"numpy is not installed, using the python backend")
+        backend = 'python'
+
+    compiler_factory = get_measure_compiler(upload.filetype)
+    if backend == 'sql':
+        operations = compiler_factory.aggregate_operations(
+            upload, company_ids, months
+        )
+        logger.info(
+            u"  + {0} aggregated operations".format(len(operations))
+        )
+    elif backend == 'numpy':
+        operations = NumpyMeasureEngine.load_operations(
+            upload, compiler_factory, company_ids, months
+        )
+    elif company_ids is not None:
+        operations = compiler_factory.filter_operations(
+            AccountingOperation.query().filter_by(upload_id=upload.id),
+            company_ids,
+            months,
+        ).all()
+    else:
+        operations = upload.operations
+    type_cache = None
+    if type_caches is not None:
+        type_cache = type_caches.get(compiler_factory)
+    compiler = compiler_factory(
+        upload, operations, company_ids, months, type_cache=type_cache,
+        heartbeat=heartbeat,
+    )
+    if type_caches is not None and type_cache is None:
+        type_caches[compiler_factory] = compiler.get_type_cache()
+
+    if processes is None:
+        processes = get_compiler_processes()
+    if backend == 'numpy':
+        values = NumpyMeasureEngine(compiler).compute_values()
+    elif processes > 1:
+        values = ProcessPoolMeasureEngine(compiler, processes).compute_values()
+    else:
+        values = compiler.compute_values()
+    compiler.beat()
+    return compiler.store_values(compiler.compute_totals(values))
+
+
 @celery_app.task(bind=True)
 def compile_measures_task(self, upload_id):
     """
@@ -287,14 +1169,9 @@ def compile_measures_task(self, upload_id):
     )
     transaction.begin()
     upload = AccountingOperationUpload.get(upload_id)
-    operations = AccountingOperation.query().filter_by(
-        upload_id=upload_id
-    ).all()
 
-    compiler_factory = get_measure_compiler(upload.filetype)
     try:
-        compiler = compiler_factory(upload, operations)
-        grids = compiler.process_datas()
+        grids = compile_measures(upload)
         transaction.commit()
     except:
         logger.exception(u"Error while generating measures")
@@ -303,3 +1180,145 @@ def compile_measures_task(self, upload_id):
         logger.info(u"{0} measure grids were handled".format(len(grids)))
         logger.info(u"The transaction has been commited")
         logger.info(u"* Task SUCCEEDED !!!")
+
+
+def _get_backfill_job(job_id):
+    return DBSESSION().query(MeasureBackfillJob).filter(
+        MeasureBackfillJob.id == job_id
+    ).first()
+
+
+def _get_backfill_upload_ids(job):
+    """
+    List the uploads a backfill job should handle (in date order)
+
+    Only the uploads that still have operations are listed : compiling an
+    upload whose operations were cleaned would reset its measures
+
+    :param obj job: The MeasureBackfillJob
+    :rtype: list
+    """
+    query = DBSESSION().query(AccountingOperationUpload.id).filter(
+        AccountingOperationUpload.operations.any()
+    )
+    if job.filetype is not None:
+        query = query.filter(
+            AccountingOperationUpload.filetype == job.filetype
+        )
+    if job.start_date is not None:
+        query = query.filter(AccountingOperationUpload.date >= job.start_date)
+    if job.end_date is not None:
+        query = query.filter(AccountingOperationUpload.date <= job.end_date)
+    query = query.order_by(
+        AccountingOperationUpload.date, AccountingOperationUpload.id
+    )
+    return [entry[0] for entry in query]
+
+
+def _start_backfill_job(celery_request, job_id):
+    """
+    Start the given backfill job or resume it if it was interrupted
+
+    :returns: The ids of the uploads left to handle
+    :rtype: list
+    """
+    transaction.begin()
+    job = _get_backfill_job(job_id)
+    resume = job is not None and job.status in ('running', 'failed')
+    transaction.commit()
+
+    if not resume:
+        utils.start_job(celery_request, MeasureBackfillJob, job_id)
+
+    transaction.begin()
+    job = _get_backfill_job(job_id)
+    if resume:
+        logger.info(u" Resuming job {0}".format(job_id))
+        job.status = u"running"
+        job.jobid = celery_request.id
+
+    if job.upload_ids is None:
+        job.upload_ids = _get_backfill_upload_ids(job)
+        job.done_upload_ids = []
+    done = set(job.done_upload_ids or [])
+    result = [
+        upload_id for upload_id in job.upload_ids if upload_id not in done
+    ]
+    logger.info(
+        u" {0} uploads to handle, {1} already handled".format(
+            len(result), len(done)
+        )
+    )
+    transaction.commit()
+    return result
+
+
+def _record_backfill_progress(job_id, upload_id, message):
+    """
+    Record that an upload has been handled (in the upload's transaction)
+    """
+    job = _get_backfill_job(job_id)
+    job.done_upload_ids = (job.done_upload_ids or []) + [upload_id]
+    job.messages = (job.messages or []) + [message]
+    done, total = job.progress
+    logger.info(u" {0}/{1} : {2}".format(done, total, message))
+
+
+@celery_app.task(bind=True, acks_late=True)
+def backfill_measures_task(self, job_id, backend=None):
+    """
+    Recompile the measures of a range of uploads, e.g after the measure
+    types have been modified
+
+    The measure types are loaded once and shared by the compilations, each
+    upload is handled in its own transaction. Running the task again for an
+    interrupted or failed job resumes it where it stopped.
+
+    :param int job_id: The id of the MeasureBackfillJob
+    :param str backend: python/sql/numpy (defaults to the configured one)
+    """
+    logger.info(u"Launching the measure backfill job {0}".format(job_id))
+    upload_ids = _start_backfill_job(self.request, job_id)
+
+    type_caches = {}
+    for upload_id in upload_ids:
+        transaction.begin()
+        try:
+            upload = AccountingOperationUpload.get(upload_id)
+            has_operations = upload is not None and DBSESSION().query(
+                AccountingOperation.id
+            ).filter(AccountingOperation.upload_id == upload_id).first()
+            if not has_operations:
+                # The operations have been cleaned since the job started
+                message = (
+                    u"Import {0} ignoré : ses écritures ont été "
+                    u"supprimées".format(upload_id)
+                )
+            else:
+                grids = compile_measures(
+                    upload, backend=backend, type_caches=type_caches
+                )
+                message = (
+                    u"Import {0} du {1:%d/%m/%Y} : {2} tableaux "
+                    u"recalculés".format(upload_id, upload.date, len(grids))
+                )
+            _record_backfill_progress(job_id, upload_id, message)
+            transaction.commit()
+        except Exception as err:
+            transaction.abort()
+            logger.exception(
+                u"Error while compiling the measures of upload {0}".format(
+                    upload_id
+                )
+            )
+            utils.record_failure(
+                MeasureBackfillJob,
+                job_id,
+                u"Erreur lors du recalcul de l'import {0} : {1}".format(
+                    upload_id, err
+                ),
+            )
+            return
+
+    utils.record_completed(MeasureBackfillJob, job_id)
+    logger.info(u"* Task SUCCEEDED !!!")
@@ -21,36 +21,85 @@ Parses :
 
 """
 import datetime
+import io
+import json
 import os
 import re
+import time
 import transaction
 import hashlib
 
-from sylk_parser import SylkParser
+from collections import deque
+from decimal import Decimal
 
+from billiard import Pool
+from celery import chain
+from pyramid.settings import asbool
 from pyramid_celery import celery_app
+from sqlalchemy import (
+    func,
+    select,
+)
+from zope.sqlalchemy import mark_changed
 from autonomie_base.mail import send_mail
 from autonomie_base.utils import csv_tools, date as date_utils
 from autonomie_base.models.base import DBSESSION
 from autonomie_base.utils.math import convert_to_float
 from autonomie.models.config import get_admin_mail
-from autonomie.models.company import Company
 from autonomie.models.accounting.operations import (
     AccountingOperationUpload,
     AccountingOperation,
 )
+from autonomie_celery.company_cache import get_company_index
+from autonomie_celery.models import (
+    ACCOUNTING_OPERATION_STAGING,
+    store_upload_metrics,
+)
 from autonomie_celery.conf import (
     get_setting,
     get_registry,
     get_sysadmin_mail,
 )
+from autonomie_celery.sylk_reader import (
+    SylkError,
+    SylkReader,
+)
 from autonomie_celery.tasks import utils
 from autonomie_celery.tasks.accounting_measure_compute import (
-    get_measure_compiler
+    compile_measures,
 )
 
 
 logger = utils.get_logger(__name__)
+# Max number of old operations removed in a single DELETE statement
+CLEAN_BATCH_SIZE = 5000
+# A file whose processing shows no activity for this number of seconds is
+# considered stale (its worker was killed or its chain was lost)
+PROCESSING_TIMEOUT = 7200
+# Min number of seconds between two heartbeats of a running stage
+HEARTBEAT_INTERVAL = 60
+# Columns identifying an operation when comparing two uploads of a period
+FINGERPRINT_COLUMNS = (
+    'analytical_account',
+    'general_account',
+    'date',
+    'label',
+    'debit',
+    'credit',
+    'balance',
+    'company_id',
+)
+# Amounts as written in the accounting files : optional sign, digits
+# (optionally grouped by spaces) and decimal part (dot or comma)
+AMOUNT_REGEX = re.compile(
+    u"^[-+]?(?:[0-9][0-9 \u00a0]*(?:[.,][0-9]*)?|[.,][0-9]+)$",
+    re.UNICODE,
+)
+# First cell of the header lines
+HEADER_LABELS = (
+    u"Compte analytique de l'entrepreneur",
+    u"Numéro analytique",
+)
 FILENAME_ERROR = (
     u"Le fichier ne respecte pas la nomenclature de nom "
     u"supportée par Autonomie ex : \n"
@@ -78,34 +127,236 @@ def _get_path(directory):
     return os.path.join(_get_base_path(), directory)
 
 
-def _get_file_path_from_pool(pool_path):
+def _get_file_paths_from_pool(pool_path):
     """
-    Handle file remaining in the pool
+    Handle files remaining in the pool
 
     :param str pool_path: The pool path to look into
-    :returns: The name of the first file we find in the rep
-    :rtype: str
+    :returns: The paths of the files we find in the rep, the oldest first
+    :rtype: list
     """
-    result = None
+    result = []
     if os.path.isdir(pool_path):
-        files = os.listdir(pool_path)
-        for file_ in files:
+        for file_ in os.listdir(pool_path):
             path = os.path.join(pool_path, file_)
             if os.path.isfile(path):
-                result = path
-                break
+                result.append(path)
+    result.sort(key=lambda path: (os.path.getmtime(path), path))
     return result
 
 
-def _get_md5sum(file_path,  blocksize=65536):
+def _claim_file(file_path, claimed_at=None):
+    """
+    Atomically move a waiting file to the processing directory
+
+    The rename fails if another worker already claimed the file.
+
+    The modification time of a claimed file is its heartbeat (see
+    _touch_file), its access time keeps its arrival time in the pool : until
+    a stage touches the file (access time >= modification time), the file is
+    only queued behind the other files of its filetype
+
+    :param str file_path: The full path to the file in the pool
+    :param float claimed_at: The timestamp of the dispatch (defaults to now)
+    :returns: The new path of the file or None if it was already claimed
+    :rtype: str
+    """
+    if claimed_at is None:
+        claimed_at = time.time()
+    new_file_path = os.path.join(
+        _get_path('processing'), os.path.basename(file_path)
+    )
+    try:
+        os.rename(file_path, new_file_path)
+    except OSError:
+        logger.info(u"The file {0} was already claimed".format(file_path))
+        return None
+    try:
+        arrived_at = os.path.getmtime(new_file_path)
+        os.utime(new_file_path, (min(arrived_at, claimed_at - 1), claimed_at))
+    except OSError:
+        logger.warn(u"The file {0} could not be touched".format(file_path))
+    logger.info(
+        u"The file {0} has been moved to the processing directory".format(
+            file_path
+        )
+    )
+    return new_file_path
+
+
+def _unclaim_file(file_path, arrived_at):
+    """
+    Move a queued file back to the pool with its arrival time, so that it's
+    dispatched again in its arrival order
+
+    :param str file_path: The full path to the file in the processing
+    directory
+    :param float arrived_at: The arrival time of the file in the pool
+    """
+    pool_path = _get_path('pool')
+    if not os.path.isdir(pool_path):
+        os.makedirs(pool_path)
+    new_file_path = os.path.join(pool_path, os.path.basename(file_path))
+    try:
+        os.rename(file_path, new_file_path)
+        os.utime(new_file_path, (arrived_at, arrived_at))
+    except OSError:
+        logger.exception(
+            u"The file {0} could not be moved back to the pool".format(
+                file_path
+            )
+        )
+        return
+    logger.info(
+        u"The file {0} has been moved back to the pool".format(file_path)
+    )
+
+
+def _touch_file(file_path):
+    """
+    Update the modification time of a file being processed, it's the
+    heartbeat used by the pool dispatcher to detect stale files
+
+    :param str file_path: The full path to the file
+    """
+    try:
+        os.utime(file_path, None)
+    except OSError:
+        logger.warn(u"The file {0} could not be touched".format(file_path))
+
+
+def _get_heartbeat(file_path):
+    """
+    Build a function touching the given file at most every
+    HEARTBEAT_INTERVAL seconds
+
+    :param str file_path: The full path to the file being processed
+    :rtype: func
+    """
+    last_heartbeat = [time.time()]
+
+    def heartbeat():
+        now = time.time()
+        if now - last_heartbeat[0] >= HEARTBEAT_INTERVAL:
+            _touch_file(file_path)
+            last_heartbeat[0] = now
+    return heartbeat
+
+
+class HashingFile(object):
+    """
+    Wraps a file object opened in binary mode and feeds a md5 hash with the
+    bytes read through it, so that a file is hashed while it's parsed
+    """
+    def __init__(self, fbuf, blocksize=65536):
+        self.fbuf = fbuf
+        self.blocksize = blocksize
+        self.hash = hashlib.md5()
+
+    def read(self, size=-1):
+        datas = self.fbuf.read(size)
+        self.hash.update(datas)
+        return datas
+
+    def readline(self, size=-1):
+        datas = self.fbuf.readline(size)
+        self.hash.update(datas)
+        return datas
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    __next__ = next
+
+    def hexdigest(self):
+        """
+        Hash the datas the parser didn't read and return the md5 sum of the
+        whole file
+        """
+        for block in iter(lambda: self.read(self.blocksize), b""):
+            pass
+        return self.hash.hexdigest()
+
+
+def _find_csv_ranges(file_path, range_size, quotechar='"', blocksize=1048576):
     """
-    Return a md5 sum of the given file_path informations
+    Split a csv file in byte ranges of about range_size bytes ending on
+    record boundaries : line breaks found inside quoted values are skipped
+
+    The file's md5sum is computed along the way
+
+    :param str file_path: The path to the csv file
+    :param int range_size: The min size of a range
+    :returns: A 2-uple (list of (start, end) offsets, md5sum)
+    :rtype: tuple
     """
-    hash = hashlib.md5()
-    with open(file_path, "rb") as f:
-        for block in iter(lambda: f.read(blocksize), b""):
-            hash.update(block)
-    return hash.hexdigest()
+    quote = quotechar.encode('ascii')
+    md5 = hashlib.md5()
+    ranges = []
+    start = 0
+    offset = 0
+    in_quotes = False
+    with open(file_path, 'rb') as fbuf:
+        for block in iter(lambda: fbuf.read(blocksize), b""):
+            md5.update(block)
+            # Position in the block until which the quotes were counted
+            counted = 0
+            position = max(start + range_size - offset, 0)
+            while position < len(block):
+                newline = block.find(b"\n", position)
+                if newline == -1:
+                    break
+                in_quotes ^= block.count(quote, counted, newline) % 2 == 1
+                counted = newline
+                if in_quotes:
+                    position = newline + 1
+                else:
+                    end = offset + newline + 1
+                    ranges.append((start, end))
+                    start = end
+                    position = start + range_size - offset
+            in_quotes ^= block.count(quote, counted) % 2 == 1
+            offset += len(block)
+
+    if start < offset:
+        ranges.append((start, offset))
+    return ranges, md5.hexdigest()
+
+
+# Parser used in the processes of the parsing pool (inherited on fork)
+_RANGE_PARSER = None
+
+
+def _init_range_parser(parser):
+    global _RANGE_PARSER
+    _RANGE_PARSER = parser
+
+
+def _build_range_datas(byte_range):
+    """
+    Build the operations datas of a byte range of the parsed csv file
+
+    :param tuple byte_range: (start, end) offsets of complete records
+    :returns: A list of dicts (column name -> value)
+    """
+    parser = _RANGE_PARSER
+    start, end = byte_range
+    with open(parser.file_path, 'rb') as fbuf:
+        fbuf.seek(start)
+        datas = io.BytesIO(fbuf.read(end - start))
+
+    result = []
+    for line in parser._stream_csv(datas):
+        operation_datas = parser._build_operation_datas(line)
+        if operation_datas is not None:
+            result.append(operation_datas)
+    return result
 
 
 def _mv_file(file_path, queue='processed'):
@@ -125,16 +376,220 @@ def _mv_file(file_path, queue='processed'):
         raise Exception(u"File is missing {}".format(file_path))
 
 
-def _clean_old_operations(old_ids):
+def _get_old_upload_ids(upload_id, filetype):
+    """
+    Return the ids of the previous uploads of the given filetype
+
+    Uploads stored after the given one are left untouched : their own cleanup
+    will handle the given upload
+
+    :param int upload_id: The id of the new AccountingOperationUpload
+    :param str filetype: The filetype of the new upload
+    :rtype: list
+    """
+    query = DBSESSION().query(AccountingOperationUpload.id)
+    query = query.filter(AccountingOperationUpload.filetype == filetype)
+    query = query.filter(AccountingOperationUpload.id < upload_id)
+    return [entry[0] for entry in query]
+
+
+def _clean_old_operations(upload_id, filetype, batch_size=CLEAN_BATCH_SIZE):
+    """
+    Clean the AccountingOperation entries attached to the previous uploads of
+    the same filetype
+
+    Entries are deleted by batches of batch_size rows, each batch in its own
+    transaction, so that neither the memory usage nor the time the table is
+    locked depend on the table's history
+
+    :param int upload_id: The id of the new AccountingOperationUpload
+    :param str filetype: The filetype of the new upload
+    :param int batch_size: The max number of rows deleted by each statement
+    :returns: The number of deleted entries
+    :rtype: int
+    """
+    transaction.begin()
+    old_upload_ids = _get_old_upload_ids(upload_id, filetype)
+    transaction.commit()
+
+    deleted = 0
+    while old_upload_ids:
+        transaction.begin()
+        session = DBSESSION()
+        query = session.query(AccountingOperation.id).filter(
+            AccountingOperation.upload_id.in_(old_upload_ids)
+        ).limit(batch_size)
+        ids = [entry[0] for entry in query]
+        if ids:
+            session.execute(
+                AccountingOperation.__table__.delete().where(
+                    AccountingOperation.id.in_(ids)
+                )
+            )
+            mark_changed(session)
+        transaction.commit()
+
+        if not ids:
+            break
+        deleted += len(ids)
+        logger.debug(u"  + {0} old operations deleted".format(deleted))
+    return deleted
+
+
+def _get_operation_columns():
+    """
+    Return the names of the AccountingOperation columns filled by the parsers
+    """
+    return [
+        column.name for column in AccountingOperation.__table__.columns
+        if column.name != 'id'
+    ]
+
+
+def _create_staging_table():
     """
-    Clean old AccountingOperation entries
-    :param list old_ids: The ids of items to remove
+    Create the staging table if needed
+
+    It's called during the parse transaction : the DDL statement runs on its
+    own connection checked out from the engine, not on the session's one, so
+    that the implicit commit of DDL statements (MySQL) doesn't commit the
+    parse transaction
     """
-    logger.info(u"  + Cleaning {0} old operations".format(len(old_ids)))
-    op = AccountingOperation.__table__.delete().where(
-        AccountingOperation.id.in_(old_ids)
+    ACCOUNTING_OPERATION_STAGING.create(
+        bind=DBSESSION().get_bind(), checkfirst=True
+    )
+
+
+def _drop_staged_upload(upload_id):
+    """
+    Remove an upload whose staged operations could not be published with
+    these operations
+
+    Both are removed in the same transaction : the upload's md5sum doesn't
+    prevent the file from being loaded again
+
+    :param int upload_id: The id of the AccountingOperationUpload
+    """
+    upload_table = AccountingOperationUpload.__table__
+    transaction.begin()
+    session = DBSESSION()
+    session.execute(
+        ACCOUNTING_OPERATION_STAGING.delete().where(
+            ACCOUNTING_OPERATION_STAGING.c.upload_id == upload_id
+        )
+    )
+    session.execute(
+        upload_table.delete().where(upload_table.c.id == upload_id)
     )
-    op.execute()
+    mark_changed(session)
+    transaction.commit()
+
+
+def _publish_staged_operations(upload_id):
+    """
+    Copy the operations staged for the given upload in the
+    accounting_operation table
+
+    The copy and the cleaning of the staging table are done in a single short
+    transaction, the new upload's operations are never seen half-copied. The
+    operations of the previous uploads are then removed by batches with
+    _clean_old_operations
+
+    :param int upload_id: The id of the new AccountingOperationUpload
+    :returns: A 2-uple (number of published operations, duration of the
+    publish transaction)
+    :rtype: tuple
+    """
+    operation_table = AccountingOperation.__table__
+    staging_table = ACCOUNTING_OPERATION_STAGING
+    columns = _get_operation_columns()
+
+    transaction.begin()
+    session = DBSESSION()
+    start = time.time()
+    try:
+        result = session.execute(
+            operation_table.insert().from_select(
+                columns,
+                select(
+                    [staging_table.c[name] for name in columns]
+                ).where(
+                    staging_table.c.upload_id == upload_id
+                ).order_by(staging_table.c.id)
+            )
+        )
+        num_published = result.rowcount
+        session.execute(
+            staging_table.delete().where(
+                staging_table.c.upload_id == upload_id
+            )
+        )
+        mark_changed(session)
+        transaction.commit()
+    except:
+        transaction.abort()
+        raise
+    return num_published, time.time() - start
+
+
+def _get_parser_options():
+    """
+    Collect the parser options configured in the ini file
+
+    :rtype: dict
+    """
+    return {
+        'bulk': asbool(
+            get_setting(
+                'autonomie.accounting_parser.bulk_insert', default=False
+            )
+        ),
+        'incremental': asbool(
+            get_setting(
+                'autonomie.accounting_parser.incremental', default=False
+            )
+        ),
+        'processes': int(
+            get_setting('autonomie.accounting_parser.processes', default=1)
+        ),
+        'staging': asbool(
+            get_setting('autonomie.accounting_parser.staging', default=False)
+        ),
+    }
+
+
+# Max length of the FINGERPRINT_COLUMNS (None if not limited)
+FINGERPRINT_LENGTHS = tuple(
+    getattr(AccountingOperation.__table__.c[name].type, 'length', None)
+    for name in FINGERPRINT_COLUMNS
+)
+
+
+def _get_fingerprint(values):
+    """
+    Build a compact fingerprint of an operation's values, values coming from
+    the parsed file and from the database give the same fingerprint
+
+    Strings are truncated to their column's length, as the database stores
+    them
+
+    :param iter values: The values of the FINGERPRINT_COLUMNS
+    :rtype: str
+    """
+    parts = []
+    for value, length in zip(values, FINGERPRINT_LENGTHS):
+        if value is None:
+            value = u''
+        elif isinstance(value, (float, Decimal)):
+            value = u"%.2f" % value
+        elif isinstance(value, datetime.date):
+            value = u"%04d-%02d-%02d" % (value.year, value.month, value.day)
+        else:
+            value = u"%s" % value
+            if length is not None:
+                value = value[:length]
+        parts.append(value)
+    return hashlib.md5(u"\x1f".join(parts).encode('utf-8')).digest()
 
 
 class KnownError(Exception):
@@ -150,28 +605,55 @@ class AccountingDataParser(object):
     delimiter = ','
     encoding = 'utf-8'
 
+    # Number of operations held in memory before being written to the
+    # database
+    chunk_size = 1000
+    # Csv files bigger than that are parsed by a process pool (if the parser
+    # has more than one process)
+    parallel_min_size = 16 * 1048576
+    # Size of the byte ranges sent to the processes
+    parallel_range_size = 2 * 1048576
+
     # To be filled in subclasses
     _filename_re = None
     filetype = None
-
-    def __init__(self, file_path, force=False):
+    # Min number of cells of an operation line, index of the date cell and
+    # indexes of the amount cells
+    min_columns = None
+    date_index = None
+    amount_indexes = ()
+
+    def __init__(
+        self, file_path, force=False, bulk=False, incremental=False,
+        processes=1, staging=False
+    ):
         self.file_path = file_path
         self.force = force
+        self.bulk = bulk
+        self.incremental = incremental
+        self.processes = processes
+        self.staging = staging
+        # Were the operations stored in the staging table
+        self.staged = False
+        self.timer = utils.PhaseTimer()
+        self._last_heartbeat = time.time()
         self._file_datas = {}
         self._collect_main_file_infos()
         self.basename = self._file_datas['basename']
         self.company_id_cache = {}
+        self.num_operations = 0
+        self.missed_associations = 0
+        # Companies and months whose operations changed (None : all of them)
+        self.affected_company_ids = None
+        self.affected_months = None
         if hasattr(self, '_collect_specific_file_infos'):
             self._collect_specific_file_infos()
 
     def _load_company_id_cache(self):
-        query = DBSESSION().query(
-            Company.id, Company.code_compta
-        ).filter(
-            Company.code_compta != None
-        )
-        for id_, code in query:
-            self.company_id_cache[code] = id_
+        """
+        Use the worker's company index (only reloaded if companies changed)
+        """
+        self.company_id_cache = get_company_index().company_ids
 
     @classmethod
     def match(cls, filename):
@@ -186,7 +668,9 @@ class AccountingDataParser(object):
         """
         Collect main informations about the current file
 
-        basename extension (without the leading dot) md5sum
+        basename extension (without the leading dot)
+
+        The md5sum is computed while the file is streamed
         :returns: A dict containing collected datas
         :rtype: dict
         """
@@ -200,40 +684,55 @@ class AccountingDataParser(object):
 
         self._file_datas['basename'] = basename
         self._file_datas['extension'] = extension
-        self._file_datas['md5sum'] = _get_md5sum(self.file_path)
         self._file_datas['filetype'] = self.filetype
         return self._file_datas
 
-    def _stream_slk(self):
+    def _stream_slk(self, fbuf):
         """
         Stream the datas coming from a slk file
+        :param obj fbuf: The file object opened in binary mode
         :returns: An iterator for the sheet's lines
         """
-        return SylkParser(self.file_path, use_unicode=True)
+        try:
+            for line in SylkReader(fbuf):
+                yield line
+        except SylkError as err:
+            logger.error(u"%s" % err)
+            raise KnownError(
+                u"Le fichier SYLK n'a pas pu être lu : les cellules doivent "
+                u"être écrites ligne après ligne"
+            )
 
-    def _stream_csv(self):
+    def _stream_csv(self, fbuf):
         """
         Stream csv datas
+        :param obj fbuf: The file object opened in binary mode
         :returns: An iterator of sheet lines as lists
         """
-        with open(self.file_path) as fbuf:
-            for line in csv_tools.UnicodeReader(
-                fbuf, quotechar=self.quotechar, delimiter=self.delimiter,
-                encoding=self.encoding,
-            ):
-                yield line
+        for line in csv_tools.UnicodeReader(
+            fbuf, quotechar=self.quotechar, delimiter=self.delimiter,
+            encoding=self.encoding,
+        ):
+            yield line
 
     def _stream_datas(self):
         """
         Stream the datas coming from a slk file
+
+        The file is read only once : its md5sum is computed while the
+        datas are parsed and is available once the stream is exhausted
+
         :returns: An iterator for the sheets line
         """
         extension = self._file_datas['extension']
 
         func = getattr(self, "_stream_%s" % extension, None)
         if func is not None:
-            for line in func():
-                yield line
+            with open(self.file_path, 'rb') as fbuf:
+                hashing_file = HashingFile(fbuf)
+                for line in func(hashing_file):
+                    yield line
+                self._file_datas['md5sum'] = hashing_file.hexdigest()
 
     def _find_company_id(self, analytical_account):
         """
@@ -253,56 +752,350 @@ class AccountingDataParser(object):
         return AccountingOperationUpload(
             filename=os.path.basename(self.file_path),
             date=self._file_datas['date'],
-            md5sum=self._file_datas['md5sum'],
             filetype=self._file_datas['filetype'],
         )
 
-    def _build_operation(self, line_datas):
+    def _build_operation_datas(self, line_datas):
         """
-        Build an AccountingOperation with the given line datas
+        Build the column values of an AccountingOperation with the given line
+        datas
 
         :param list line_datas: List of datas found in the line
-        :returns: An instance of AccountingOperation
+        :returns: A dict (column name -> value) or None if the line should be
+        skipped
+        """
+        raise NotImplementedError(
+            u"_build_operation_datas should be implemented in subclasses"
+        )
+
+    def _use_process_pool(self):
+        """
+        Should the current file be parsed by a process pool
+
+        :rtype: bool
         """
-        raise NotImplemented(
-            u"_build_operation should be implemented in subclasses"
+        return (
+            self.processes > 1 and
+            self._file_datas['extension'] == 'csv' and
+            os.path.getsize(self.file_path) >= self.parallel_min_size
         )
 
-    def _build_operations(self):
+    def _stream_pool_datas(self):
         """
-        Build AccountingOperation based on the current file's datas
+        Split the csv file in byte ranges parsed by a process pool
+
+        The datas are yielded in the file's order, the md5sum is computed
+        while the ranges are searched for. Only 2 ranges per process are
+        submitted at a time so that the parsed ranges waiting to be inserted
+        don't pile up in memory
+
+        :returns: An iterator of dicts (column name -> value)
+        """
+        with self.timer.phase('hash'):
+            ranges, md5sum = _find_csv_ranges(
+                self.file_path, self.parallel_range_size, self.quotechar
+            )
+        logger.info(
+            u"  + Parsing {0} byte ranges with {1} processes".format(
+                len(ranges), self.processes
+            )
+        )
+        pool = Pool(
+            self.processes,
+            initializer=_init_range_parser,
+            initargs=(self,),
+        )
+        window = 2 * self.processes
+        pending = deque()
+        try:
+            for byte_range in ranges:
+                pending.append(
+                    pool.apply_async(_build_range_datas, (byte_range,))
+                )
+                if len(pending) >= window:
+                    for datas in pending.popleft().get():
+                        yield datas
+            while pending:
+                for datas in pending.popleft().get():
+                    yield datas
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        self._file_datas['md5sum'] = md5sum
+
+    def _stream_built_datas(self):
+        """
+        Stream the column values built from each line of the current file
+        (None for the lines that should be skipped)
+        """
+        if self._use_process_pool():
+            return self._stream_pool_datas()
+        else:
+            return (
+                self._build_operation_datas(line)
+                for line in self._stream_datas()
+            )
+
+    def _stream_operations_datas(self):
+        """
+        Stream the column values of the operations found in the current file
+
+        Operations and missed associations (lines where we didn't find any
+        matching company) are counted along the way
 
-        :returns: A 2-uple with operations and number of missed associations
-        :rtype: tuple (list, int)
+        :returns: An iterator of dicts (column name -> value)
         """
-        operations = []
-        missed_associations = 0
-        for line in self._stream_datas():
-            operation = self._build_operation(line)
-            if operation is not None:
-                operations.append(operation)
-                if operation.company_id is None:
-                    missed_associations += 1
-        return operations, missed_associations
+        for datas in self._stream_built_datas():
+            if datas is not None:
+                self.num_operations += 1
+                if datas['company_id'] is None:
+                    self.missed_associations += 1
+                yield datas
+
+    def _stream_operations_chunks(self):
+        """
+        Group the streamed operations datas in lists of chunk_size items
+
+        :returns: An iterator of lists of dicts
+        """
+        chunk = []
+        for datas in self._stream_operations_datas():
+            chunk.append(datas)
+            if len(chunk) >= self.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def _heartbeat(self):
+        """
+        Touch the parsed file regularly so that a long parsing isn't taken
+        for a stale one
+        """
+        now = time.time()
+        if now - self._last_heartbeat >= HEARTBEAT_INTERVAL:
+            _touch_file(self.file_path)
+            self._last_heartbeat = now
+
+    def _insert_chunk(self, upload_id, chunk):
+        """
+        Write a chunk of operations in the database
+
+        In staging mode, the rows are written in the staging table. In bulk
+        mode, the rows are sent through a single executemany statement
+        bypassing the ORM's unit of work, else AccountingOperation instances
+        are flushed and then expunged so that the session doesn't grow with
+        the file's size
+
+        :param int upload_id: The id of the new AccountingOperationUpload
+        :param list chunk: List of dicts describing the operations
+        """
+        self._heartbeat()
+        with self.timer.phase('insert', rows=len(chunk)):
+            session = DBSESSION()
+            if self.staged:
+                for datas in chunk:
+                    datas['upload_id'] = upload_id
+                session.execute(ACCOUNTING_OPERATION_STAGING.insert(), chunk)
+                mark_changed(session)
+            elif self.bulk:
+                for datas in chunk:
+                    datas['upload_id'] = upload_id
+                session.execute(AccountingOperation.__table__.insert(), chunk)
+                mark_changed(session)
+            else:
+                operations = [
+                    AccountingOperation(upload_id=upload_id, **datas)
+                    for datas in chunk
+                ]
+                session.add_all(operations)
+                session.flush()
+                for operation in operations:
+                    session.expunge(operation)
+
+    def _store_operations(self, upload_id):
+        """
+        Stream the current file's operations to the database chunk by chunk
+
+        :param int upload_id: The id of the new AccountingOperationUpload
+        :returns: The number of stored operations
+        :rtype: int
+        """
+        start = time.time()
+        for chunk in self._stream_operations_chunks():
+            self._insert_chunk(upload_id, chunk)
+
+        duration = time.time() - start
+        logger.info(
+            u"  + {0} rows stored in {1:.2f}s ({2:.0f} rows/s)".format(
+                self.num_operations,
+                duration,
+                self.num_operations / duration if duration else 0,
+            )
+        )
+        return self.num_operations
+
+    def _get_previous_upload(self):
+        """
+        Return the last upload of the same filetype if it's about the same
+        period (its operations are then the ones currently used)
+
+        :returns: An AccountingOperationUpload instance or None
+        """
+        query = AccountingOperationUpload.query().filter_by(
+            filetype=self.filetype,
+        )
+        upload = query.order_by(AccountingOperationUpload.id.desc()).first()
+        if upload is not None and upload.date == self._file_datas['date']:
+            return upload
+        return None
+
+    def _load_fingerprints(self, upload_id):
+        """
+        Load the fingerprints of the operations stored for the given upload
+
+        :param int upload_id: The id of an AccountingOperationUpload
+        :returns: A dict {fingerprint: [(id, company_id, date), ...]}
+        :rtype: dict
+        """
+        columns = [
+            getattr(AccountingOperation, name) for name in FINGERPRINT_COLUMNS
+        ]
+        query = DBSESSION().query(AccountingOperation.id, *columns).filter(
+            AccountingOperation.upload_id == upload_id
+        )
+        result = {}
+        for row in query:
+            fingerprint = _get_fingerprint(row[1:])
+            result.setdefault(fingerprint, []).append(
+                (row.id, row.company_id, row.date)
+            )
+        return result
+
+    def _record_affected(self, company_id, date):
+        """
+        Record that the operations of the given company (and month) changed
+        """
+        if company_id is not None:
+            self.affected_company_ids.add(company_id)
+            if date is not None:
+                self.affected_months.add(date.month)
+
+    def _delete_operations(self, ids):
+        """
+        Delete the given operations by batches
+
+        :param list ids: AccountingOperation ids
+        """
+        session = DBSESSION()
+        for index in range(0, len(ids), CLEAN_BATCH_SIZE):
+            session.execute(
+                AccountingOperation.__table__.delete().where(
+                    AccountingOperation.id.in_(
+                        ids[index:index + CLEAN_BATCH_SIZE]
+                    )
+                )
+            )
+        mark_changed(session)
+
+    def _store_operations_delta(self, upload_id):
+        """
+        Compare the current file with the operations stored for the given
+        upload of the same period : only new lines are inserted and only
+        vanished ones are deleted
+
+        The companies and months whose operations changed are recorded in
+        affected_company_ids and affected_months
+
+        :param int upload_id: The id of the previous AccountingOperationUpload
+        :returns: The number of operations found in the file
+        :rtype: int
+        """
+        start = time.time()
+        self.affected_company_ids = set()
+        self.affected_months = set()
+        existing = self._load_fingerprints(upload_id)
+
+        num_inserted = 0
+        chunk = []
+        for datas in self._stream_operations_datas():
+            fingerprint = _get_fingerprint(
+                datas.get(name) for name in FINGERPRINT_COLUMNS
+            )
+            matching = existing.get(fingerprint)
+            if matching:
+                matching.pop()
+            else:
+                self._record_affected(datas['company_id'], datas.get('date'))
+                chunk.append(datas)
+                if len(chunk) >= self.chunk_size:
+                    self._insert_chunk(upload_id, chunk)
+                    num_inserted += len(chunk)
+                    chunk = []
+        if chunk:
+            self._insert_chunk(upload_id, chunk)
+            num_inserted += len(chunk)
+
+        vanished_ids = []
+        # Old datas are only replaced if the new file provided some
+        if self.num_operations:
+            for entries in existing.values():
+                for id_, company_id, date in entries:
+                    vanished_ids.append(id_)
+                    self._record_affected(company_id, date)
+            self._delete_operations(vanished_ids)
+
+        logger.info(
+            u"  + {0} new rows, {1} removed rows, {2} unchanged rows in "
+            u"{3:.2f}s".format(
+                num_inserted,
+                len(vanished_ids),
+                self.num_operations - num_inserted,
+                time.time() - start,
+            )
+        )
+        return self.num_operations
 
-    def _already_loaded(self):
+    def _check_staged_operations(self, upload_id):
+        """
+        Check the operations staged for the given upload before they're
+        published
+
+        :param int upload_id: The id of the new AccountingOperationUpload
+        """
+        table = ACCOUNTING_OPERATION_STAGING
+        num_staged = DBSESSION().execute(
+            select([func.count(table.c.id)]).where(
+                table.c.upload_id == upload_id
+            )
+        ).scalar()
+        if num_staged != self.num_operations:
+            logger.error(
+                u"{0} operations staged, {1} expected".format(
+                    num_staged, self.num_operations
+                )
+            )
+            raise KnownError(
+                u"Les écritures du fichier n'ont pas pu être toutes "
+                u"enregistrées : {0}".format(self.file_path)
+            )
+
+    def _already_loaded(self, upload_id=None):
         """
         Check if the current file has already been loaded
 
+        :param int upload_id: The id of the upload we're currently storing
         :rtype: bool
         """
         query = DBSESSION().query(AccountingOperationUpload.id)
         query = query.filter_by(md5sum=self._file_datas['md5sum'])
+        if upload_id is not None:
+            query = query.filter(AccountingOperationUpload.id != upload_id)
         return query.count() > 0
 
-    def _get_existing_operation_ids(self):
-        """
-        Return ids of the operations already stored in database
-        """
-        return [
-            entry[0] for entry in DBSESSION().query(AccountingOperation.id)
-        ]
-
     def _get_num_val(self, line, index):
         """
         Retreieve the numeric value found at index in the line_datas list
@@ -315,44 +1108,158 @@ class AccountingDataParser(object):
             result = line[index].strip() or 0
         return result
 
+    @staticmethod
+    def _is_valid_amount(value):
+        """
+        Check an amount cell is a number (convert_to_float silently converts
+        invalid values)
+
+        :param value: A value returned by _get_num_val
+        :rtype: bool
+        """
+        if isinstance(value, (int, float, Decimal)):
+            return True
+        return AMOUNT_REGEX.match(value.strip()) is not None
+
+    def validate(self, max_samples=20):
+        """
+        Check the current file without writing anything in the database
+
+        The file is streamed, only the counters and the first max_samples
+        errors of each kind are kept in memory
+
+        :param int max_samples: The max number of examples of each error
+        :returns: A report (lines, operations, incomplete lines, unmatched
+        analytical accounts, invalid dates and amounts ...)
+        :rtype: dict
+        """
+        start = time.time()
+        company_ids = get_company_index().company_ids
+
+        def new_entry():
+            return {'count': 0, 'samples': []}
+
+        def add_error(entry, sample):
+            entry['count'] += 1
+            if len(entry['samples']) < max_samples:
+                entry['samples'].append(sample)
+
+        report = {
+            'filename': os.path.basename(self.file_path),
+            'filetype': self.filetype,
+            'lines': 0,
+            'operations': 0,
+            'incomplete_lines': new_entry(),
+            'unmatched_lines': 0,
+            'unmatched_accounts': {},
+            'invalid_dates': new_entry(),
+            'invalid_amounts': new_entry(),
+        }
+        unmatched_accounts = report['unmatched_accounts']
+
+        for number, line in enumerate(self._stream_datas(), 1):
+            report['lines'] += 1
+            if len(line) < self.min_columns:
+                if any(cell.strip() for cell in line):
+                    add_error(report['incomplete_lines'], number)
+                continue
+            if line[0].strip() in HEADER_LABELS:
+                continue
+
+            # Lines without a valid date are skipped by the parser
+            if self.date_index is not None:
+                value = line[self.date_index].strip()
+                if not date_utils.str_to_date(value):
+                    add_error(report['invalid_dates'], (number, value))
+                    continue
+
+            report['operations'] += 1
+            analytical_account = line[0].strip()
+            if analytical_account not in company_ids:
+                report['unmatched_lines'] += 1
+                if analytical_account in unmatched_accounts:
+                    unmatched_accounts[analytical_account] += 1
+                elif len(unmatched_accounts) < max_samples:
+                    unmatched_accounts[analytical_account] = 1
+
+            for index in self.amount_indexes:
+                value = self._get_num_val(line, index)
+                if not self._is_valid_amount(value):
+                    add_error(report['invalid_amounts'], (number, value))
+
+        report['md5sum'] = self._file_datas.get('md5sum')
+        report['already_loaded'] = self._already_loaded()
+        report['valid'] = not (
+            report['incomplete_lines']['count'] or
+            report['invalid_dates']['count'] or
+            report['invalid_amounts']['count']
+        )
+        report['duration'] = time.time() - start
+        return report
+
     def process_file(self):
         """
         Process file parsing
 
-        :returns: The new AccountingOperationUpload instance and the number of
+        The file is stored while it's hashed, the already loaded check is done
+        once the md5sum is known : the current transaction should then be
+        aborted on KnownError
+
+        In incremental mode, if an upload of the same period exists, it's
+        updated with the differences between its operations and the file's
+        ones
+
+        In staging mode, new operations are stored in the staging table and
+        should then be published
+
+        :returns: The AccountingOperationUpload's id, the number of
         missed associations (lines where we didn't found any matching company)
-        :rtype: 2-uple
+        and the number of operations found in the file
+        :rtype: 3-uple
         """
-        if self.force or not self._already_loaded():
-            self._load_company_id_cache()
-            old_ids = self._get_existing_operation_ids()
-            upload_object = self._build_operation_upload_object()
-            operations, missed_associations = self._build_operations()
+        self._load_company_id_cache()
+        upload_object = None
+        if self.incremental:
+            upload_object = self._get_previous_upload()
+
+        if upload_object is not None:
             logger.info(
-                u"Storing {0} new operations in database".format(
-                    len(operations)
+                u"Updating the operations of the upload {0}".format(
+                    upload_object.id
                 )
             )
-            logger.info(
-                "  + {0} operations were not associated to an existing "
-                "company".format(missed_associations)
-            )
-            if operations:
-                upload_object.operations = operations
-            else:
-                old_ids = []
-
+            upload_object.filename = os.path.basename(self.file_path)
+            num_operations = self._store_operations_delta(upload_object.id)
+            already_loaded = self._already_loaded()
+        else:
+            upload_object = self._build_operation_upload_object()
             DBSESSION().add(upload_object)
             DBSESSION().flush()
 
-            return upload_object.id, missed_associations, old_ids
+            if self.staging:
+                _create_staging_table()
+                self.staged = True
 
-        else:
+            logger.info(u"Storing new operations in database")
+            num_operations = self._store_operations(upload_object.id)
+            if self.staged:
+                self._check_staged_operations(upload_object.id)
+            already_loaded = self._already_loaded(upload_object.id)
+
+        if not self.force and already_loaded:
             logger.error(u"File {0} already loaded".format(self.file_path))
             raise KnownError(
                 u"Ce fichier a déjà été traité : {0}".format(self.file_path)
             )
 
+        upload_object.md5sum = self._file_datas['md5sum']
+        DBSESSION().flush()
+        logger.info(
+            "  + {0} operations were not associated to an existing "
+            "company".format(self.missed_associations)
+        )
+        return upload_object.id, self.missed_associations, num_operations
+
 
 class GeneralLedgerParser(AccountingDataParser):
     _filename_re = re.compile(
@@ -363,6 +1270,9 @@ class GeneralLedgerParser(AccountingDataParser):
         re.IGNORECASE
     )
     filetype = 'general_ledger'
+    min_columns = 6
+    date_index = 2
+    amount_indexes = (6, 7)
 
     def _collect_specific_file_infos(self):
         """
@@ -379,19 +1289,16 @@ class GeneralLedgerParser(AccountingDataParser):
         )
         return self._file_datas
 
-    def _build_operation(self, line_datas):
+    def _build_operation_datas(self, line_datas):
         """
-        Build an AccountingOperation object
+        Build the column values of an AccountingOperation
 
         :param list line_datas: List of datas found in the line
-        :returns: An instance of AccountingOperation
+        :returns: A dict (column name -> value)
         """
         result = None
-        if len(line_datas) >= 6:
-            if line_datas[0].strip() not in (
-                u"Compte analytique de l'entrepreneur",
-                u"Numéro analytique",
-            ):
+        if len(line_datas) >= self.min_columns:
+            if line_datas[0].strip() not in HEADER_LABELS:
                 analytical_account = line_datas[0].strip()
                 general_account = line_datas[1].strip()
                 date = date_utils.str_to_date(line_datas[2].strip())
@@ -405,7 +1312,7 @@ class GeneralLedgerParser(AccountingDataParser):
                 credit = self._get_num_val(line_datas, index=7)
                 balance = 0
                 company_id = self._find_company_id(analytical_account)
-                result = AccountingOperation(
+                result = dict(
                     analytical_account=analytical_account,
                     general_account=general_account,
                     date=date,
@@ -433,6 +1340,8 @@ class AnalyticalBalanceParser(AccountingDataParser):
         re.IGNORECASE
     )
     filetype = 'analytical_balance'
+    min_columns = 5
+    amount_indexes = (4, 5, 6)
 
     def _collect_specific_file_infos(self):
         """
@@ -452,19 +1361,16 @@ class AnalyticalBalanceParser(AccountingDataParser):
 
         return self._file_datas
 
-    def _build_operation(self, line_datas):
+    def _build_operation_datas(self, line_datas):
         """
-        Build an AccountingOperation object
+        Build the column values of an AccountingOperation
 
         :param list line_datas: List of datas found in the line
-        :returns: An instance of AccountingOperation
+        :returns: A dict (column name -> value)
         """
         result = None
-        if len(line_datas) >= 5:
-            if line_datas[0] not in (
-                u"Compte analytique de l'entrepreneur",
-                u"Numéro analytique",
-            ):
+        if len(line_datas) >= self.min_columns:
+            if line_datas[0] not in HEADER_LABELS:
                 analytical_account = line_datas[0].strip()
                 general_account = line_datas[2].strip()
                 label = line_datas[3].strip()
@@ -472,7 +1378,7 @@ class AnalyticalBalanceParser(AccountingDataParser):
                 credit = self._get_num_val(line_datas, index=5)
                 balance = self._get_num_val(line_datas, index=6)
                 company_id = self._find_company_id(analytical_account)
-                result = AccountingOperation(
+                result = dict(
                     analytical_account=analytical_account,
                     general_account=general_account,
                     label=label,
@@ -511,6 +1417,9 @@ MAIL_SUCCESS_BODY = u"""Le fichier {0} a été traité avec succès.
 Autonomie : {2}
 
 Les indicateurs ont été générés depuis ces écritures.
+
+Durée des traitements :
+{3}
 """
 
 
@@ -554,7 +1463,9 @@ def send_unknown_error(request, mail_addresses, filename, err):
             logger.exception("send_success error")
 
 
-def send_success(request, mail_addresses, filename, new_entries, missing):
+def send_success(
+    request, mail_addresses, filename, new_entries, missing, timer
+):
     if mail_addresses:
         try:
             subject = MAIL_SUCCESS_SUBJECT.format(filename)
@@ -562,6 +1473,7 @@ def send_success(request, mail_addresses, filename, new_entries, missing):
                 filename,
                 new_entries,
                 missing,
+                timer.format(),
             )
             send_mail(
                 request,
@@ -573,6 +1485,28 @@ def send_success(request, mail_addresses, filename, new_entries, missing):
             logger.exception("send_success error")
 
 
+def _record_upload_metrics(upload_id, timer):
+    """
+    Log the figures of the processing phases and store them alongside the
+    upload
+
+    :param int upload_id: The id of the AccountingOperationUpload
+    :param obj timer: The PhaseTimer used during the processing
+    """
+    logger.info(
+        u"Upload metrics : {0}".format(
+            json.dumps({'upload_id': upload_id, 'phases': timer.todict()})
+        )
+    )
+    transaction.begin()
+    try:
+        store_upload_metrics(upload_id, timer)
+        transaction.commit()
+    except:
+        transaction.abort()
+        logger.exception(u"Error while storing the upload metrics")
+
+
 def _get_parser_factory(filename):
     """
     Find out which type of file we handle and return the associated parser
@@ -589,15 +1523,124 @@ def _get_parser_factory(filename):
     return result
 
 
-def _move_file_to_processing(waiting_file):
+def validate_accounting_file(file_path, max_samples=20):
     """
-    MOve the waiting file to the processing queue
+    Check an accounting file without writing anything in the database, fast
+    enough to be called synchronously (e.g : from the upload form)
 
-    :param str waiting_file: The full path to the file to process
+    :param str file_path: The path to the file
+    :param int max_samples: The max number of examples of each error
+    :returns: A report dict (see AccountingDataParser.validate)
+    :raises KnownError: If the filename or the extension is not supported
     """
-    logger.info(u" + Moving the file to the processing directory")
-    file_to_parse = _mv_file(waiting_file, "processing")
-    return file_to_parse
+    parser_factory = _get_parser_factory(os.path.basename(file_path))
+    if parser_factory is None:
+        raise KnownError(FILENAME_ERROR)
+    return parser_factory(file_path).validate(max_samples)
+
+
+def _get_filetype(filename):
+    """
+    Return the filetype of the given filename or None if it's unknown
+
+    :param str filename: The filename of the file to parse
+    :rtype: str
+    """
+    parser_factory = _get_parser_factory(filename)
+    if parser_factory is None:
+        return None
+    return parser_factory.filetype
+
+
+def _get_processing_timeout():
+    """
+    Return the number of seconds after which an inactive file of the
+    processing directory is considered stale
+
+    :rtype: int
+    """
+    return int(
+        get_setting(
+            'autonomie.accounting_parser.processing_timeout',
+            default=PROCESSING_TIMEOUT,
+        )
+    )
+
+
+def _get_processing_files():
+    """
+    Collect the files of the processing directory by filetype
+
+    :returns: {filetype: [(path, mtime, atime)]}, unknown files are under
+    None
+    :rtype: dict
+    """
+    result = {}
+    processing_path = _get_path('processing')
+    if os.path.isdir(processing_path):
+        for filename in os.listdir(processing_path):
+            path = os.path.join(processing_path, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # The file has just been released
+                continue
+            result.setdefault(_get_filetype(filename), []).append(
+                (path, stat.st_mtime, stat.st_atime)
+            )
+    return result
+
+
+STALE_FILE_ERROR = (
+    u"Le traitement de ce fichier a été interrompu (aucune activité depuis "
+    u"{0} minutes), veuillez le déposer à nouveau"
+)
+
+
+def _get_busy_filetypes(request):
+    """
+    Collect the filetypes of the files currently in the processing directory
+
+    Running stages touch their file (see _touch_file). When all the files of
+    a filetype have been inactive for longer than the processing timeout,
+    their worker died or their chain was lost :
+
+        - the files whose processing had started are moved to the error
+          directory and reported
+        - the files still queued behind them are moved back to the pool
+
+    so that the filetype is no longer blocked
+
+    :param obj request: The celery request used to send the error mails
+    :rtype: set
+    """
+    timeout = _get_processing_timeout()
+    now = time.time()
+    result = set()
+    for filetype, files in _get_processing_files().items():
+        last_activity = max(mtime for _, mtime, _ in files)
+        if now - last_activity < timeout:
+            if filetype is not None:
+                result.add(filetype)
+            continue
+
+        for path, mtime, atime in files:
+            filename = os.path.basename(path)
+            if atime < mtime:
+                # Claimed but never touched by a stage (see _claim_file)
+                _unclaim_file(path, atime)
+                continue
+            logger.error(
+                u"The file {0} has been inactive for more than {1} seconds, "
+                u"its processing is abandoned".format(filename, timeout)
+            )
+            _report_failure(
+                request,
+                filename,
+                KnownError(STALE_FILE_ERROR.format(timeout // 60)),
+                path,
+            )
+    return result
 
 
 def _get_recipients_addresses(request):
@@ -620,139 +1663,443 @@ def _get_recipients_addresses(request):
 
 
 @celery_app.task(bind=True)
-def handle_pool_task(self, force=False):
+def handle_pool_task(self, force=False, paths=None):
     """
-    Parse the files present in the configured file pool
+    Dispatch the files present in the configured file pool
+
+    Every waiting file is claimed (moved to the processing directory) and
+    handled by its own parse/clean/compile/notify sequence. The files of the
+    same filetype are handled one after the other in their arrival order (the
+    whole sequence of a file is done before the next file is parsed), while
+    different filetypes are handled in parallel. A filetype that still has a
+    file in the processing directory is left in the pool until the next run,
+    unless this file is stale (see _get_busy_filetypes).
+
+    When paths is provided (pool watcher), only those files are claimed, the
+    other ones may still be written. The files of a filetype are not claimed
+    past an older waiting file that is not in paths, so that they're still
+    handled in their arrival order.
+
+    :param bool force: Should we parse the files even if they were already
+    loaded
+    :param list paths: The paths of the files to dispatch (defaults to all
+    the waiting files)
+    :returns: The number of dispatched files
+    :rtype: int
     """
-    pool_path = _get_path('pool')
-    waiting_file = _get_file_path_from_pool(pool_path)
+    # Stale files are released first, their queued files are then listed
+    # with the waiting ones
+    busy_filetypes = _get_busy_filetypes(self.request)
+    waiting_files = _get_file_paths_from_pool(_get_path('pool'))
+    if not waiting_files:
+        return 0
+
+    if busy_filetypes:
+        logger.info(
+            u"Files are still being processed for the following filetypes : "
+            u"{0}".format(", ".join(busy_filetypes))
+        )
 
-    if waiting_file is None:
-        return
+    if paths is not None:
+        paths = set(os.path.normpath(path) for path in paths)
+
+    claimed_at = time.time()
+
+    files_by_filetype = {}
+    unknown_files = []
+    for waiting_file in waiting_files:
+        filetype = _get_filetype(os.path.basename(waiting_file))
+        if filetype in busy_filetypes:
+            continue
+        if paths is not None and os.path.normpath(waiting_file) not in paths:
+            if filetype is not None:
+                busy_filetypes.add(filetype)
+            continue
+        file_to_parse = _claim_file(waiting_file, claimed_at)
+        if file_to_parse is None:
+            # Claimed by a concurrent run : the next files of the filetype
+            # are left to the next run to keep them after this one
+            if filetype is not None:
+                busy_filetypes.add(filetype)
+            continue
+        if filetype is None:
+            unknown_files.append(file_to_parse)
+        else:
+            files_by_filetype.setdefault(filetype, []).append(file_to_parse)
 
-    else:
-        file_to_parse = _move_file_to_processing(waiting_file)
-        logger.info(u"Parsing an accounting file : %s" % file_to_parse)
+    for filetype, files_to_parse in files_by_filetype.items():
+        logger.info(u"Dispatching {0} {1} file(s)".format(
+            len(files_to_parse), filetype
+        ))
+        chain(
+            *[
+                task for path in files_to_parse
+                for task in _get_file_tasks(path, force)
+            ]
+        ).delay()
+
+    for file_to_parse in unknown_files:
+        chain(*_get_file_tasks(file_to_parse, force)).delay()
+
+    return len(unknown_files) + sum(
+        len(files_to_parse) for files_to_parse in files_by_filetype.values()
+    )
 
-        mail_addresses = _get_recipients_addresses(self.request)
-        filename = os.path.basename(file_to_parse)
-        parser_factory = _get_parser_factory(filename)
-        if parser_factory is None:
-            err = Exception(
-                u"Type de fichier inconnu, le nom du fichier ne "
-                u"respecte pas les nomenclatures de nommage des "
-                u"fichiers de trésorerie"
-            )
-            send_error(self.request, mail_addresses, filename, err)
-            logger.error(u"Incorrect file type : %s" % filename)
-            _mv_file(file_to_parse, "error")
-            return False
+
+def _sorted_or_none(values):
+    """
+    Convert an optional set to a json serializable list
+
+    :param set values: The values or None
+    :rtype: list or None
+    """
+    if values is None:
+        return None
+    return sorted(values)
+
+
+def _get_payload_timer(payload):
+    """
+    Return a PhaseTimer initialized with the phases recorded by the previous
+    stages
+    """
+    return utils.PhaseTimer.from_dicts(payload['phases'])
+
+
+def _is_superseded(upload_id, filetype):
+    """
+    Check if operations of the same filetype and the same period were stored
+    after the given upload (their own measure compilation will then be the
+    last one)
+
+    :rtype: bool
+    """
+    upload = AccountingOperationUpload.get(upload_id)
+    query = DBSESSION().query(AccountingOperationUpload.id).filter(
+        AccountingOperationUpload.filetype == filetype,
+        AccountingOperationUpload.date == upload.date,
+        AccountingOperationUpload.id > upload_id,
+        AccountingOperationUpload.operations.any(),
+    )
+    return query.count() > 0
+
+
+def _get_file_tasks(file_to_parse, force=False):
+    """
+    Build the signatures of the stages handling a file (parse, cleanup,
+    compile, notify), each stage receives the payload returned by the
+    previous one
+
+    :param str file_to_parse: The full path to the claimed file
+    :param bool force: Should we parse the file even if it was already loaded
+    :rtype: list
+    """
+    return [
+        parse_file_task.si(file_to_parse, force),
+        clean_operations_task.s(),
+        compile_upload_measures_task.s(),
+        notify_upload_task.s(),
+    ]
+
+
+def _release_file(payload):
+    """
+    Move the file of a payload to the processed directory
+    """
+    try:
+        if os.path.isfile(payload['file_path']):
+            _mv_file(payload['file_path'])
+            logger.info(u"File has been moved to processed directory")
+    except Exception:
+        logger.exception(
+            u"The file {0} could not be moved".format(payload['file_path'])
+        )
+
+
+def _report_failure(request, filename, err, file_path=None):
+    """
+    Send the error mail of a failed stage and move its file to the error
+    directory
+
+    Nothing is raised : the chain goes on with the next files of the same
+    filetype
+
+    :param obj request: The celery request
+    :param str filename: The name of the file
+    :param obj err: The exception that made the stage fail
+    :param str file_path: The path of the file to move
+    """
+    try:
+        mail_addresses = _get_recipients_addresses(request)
+        if mail_addresses:
+            if isinstance(err, KnownError):
+                send_error(request, mail_addresses, filename, err)
+            else:
+                send_unknown_error(request, mail_addresses, filename, err)
+            logger.error(
+                u"An error mail has been sent to {0}".format(mail_addresses)
+            )
+    except Exception:
+        logger.exception(u"The error mail could not be sent")
+
+    if file_path is not None and os.path.isfile(file_path):
         try:
-            parser = parser_factory(file_to_parse, force)
+            _mv_file(file_path, 'error')
+            logger.error(u"File has been moved to error directory")
+        except Exception:
+            logger.exception(
+                u"The file {0} could not be moved".format(file_path)
+            )
+
 
-            transaction.begin()
-            logger.info(u"  + Storing accounting operations in database")
-            upload_object_id, missed_associations, old_ids = \
+@celery_app.task(bind=True)
+def parse_file_task(self, file_to_parse, force=False):
+    """
+    Parse a file that has been claimed in the processing directory and store
+    its operations
+
+    The file is left in the processing directory until the following stages
+    (cleanup, compile, notify) are done, so that no other file of the same
+    filetype is dispatched in the meantime
+
+    :param str file_to_parse: The full path to the file to parse
+    :param bool force: Should we parse the file even if it was already loaded
+    :returns: The datas passed to the following stages or None on failure
+    :rtype: dict
+    """
+    logger.info(u"Parsing an accounting file : %s" % file_to_parse)
+
+    filename = os.path.basename(file_to_parse)
+    parser_factory = _get_parser_factory(filename)
+    if parser_factory is None:
+        err = KnownError(
+            u"Type de fichier inconnu, le nom du fichier ne "
+            u"respecte pas les nomenclatures de nommage des "
+            u"fichiers de trésorerie"
+        )
+        logger.error(u"Incorrect file type : %s" % filename)
+        _report_failure(self.request, filename, err, file_to_parse)
+        return None
+    try:
+        _touch_file(file_to_parse)
+        parser = parser_factory(
+            file_to_parse, force, **_get_parser_options()
+        )
+        timer = parser.timer
+
+        transaction.begin()
+        logger.info(u"  + Storing accounting operations in database")
+        with timer.phase('parse') as phase:
+            upload_object_id, missed_associations, num_stored = \
                 parser.process_file()
-            logger.debug(u"  + File was processed")
-            transaction.commit()
-        except KnownError as err:
-            transaction.abort()
-            logger.exception(u"KnownError : %s" % err.message)
-            logger.exception(u"* FAILED : transaction has been rollbacked")
-            if mail_addresses:
-                send_error(self.request, mail_addresses, filename, err)
-                logger.error(
-                    u"An error mail has been sent to {0}".format(mail_addresses)
-                )
-            _mv_file(file_to_parse, 'error')
-            logger.error(u"File has been moved to error directory")
-            return False
+            phase.rows = num_stored
+        logger.debug(u"  + File was processed")
+        transaction.commit()
+    except KnownError as err:
+        transaction.abort()
+        logger.exception(u"KnownError : %s" % err.message)
+        logger.exception(u"* FAILED : transaction has been rollbacked")
+        _report_failure(self.request, filename, err, file_to_parse)
+        return None
+
+    except Exception as err:
+        transaction.abort()
+        logger.exception(u"Unkown Error")
+        logger.exception(u"* FAILED : transaction has been rollbacked")
+        _report_failure(self.request, filename, err, file_to_parse)
+        return None
+
+    logger.info(u"Accounting operations where successfully stored")
+    payload = {
+        'upload_id': upload_object_id,
+        'file_path': file_to_parse,
+        'filename': filename,
+        'filetype': parser.filetype,
+        'num_stored': num_stored,
+        'missed_associations': missed_associations,
+        'staged': parser.staged,
+        'affected_company_ids': _sorted_or_none(parser.affected_company_ids),
+        'affected_months': _sorted_or_none(parser.affected_months),
+        'phases': timer.todict(),
+    }
+    return payload
+
+
+@celery_app.task(bind=True, max_retries=3, default_retry_delay=60)
+def clean_operations_task(self, payload):
+    """
+    Publish the staged operations of an upload and remove the operations of
+    the previous uploads of the same filetype
 
-        except Exception as err:
-            transaction.abort()
-            logger.exception(u"Unkown Error")
-            logger.exception(u"* FAILED : transaction has been rollbacked")
-            if mail_addresses:
-                send_unknown_error(self.request, mail_addresses, filename, err)
-                logger.error(
-                    u"An error mail has been sent to {0}".format(mail_addresses)
+    :param dict payload: The datas returned by the parsing stage
+    :returns: The payload
+    """
+    if payload is None:
+        return None
+
+    upload_id = payload['upload_id']
+    filetype = payload['filetype']
+    timer = _get_payload_timer(payload)
+    _touch_file(payload['file_path'])
+
+    # Old datas are only replaced if the new file provided some
+    if not payload['num_stored']:
+        return payload
+
+    published = False
+    try:
+        if payload['staged']:
+            logger.info(u"  + Publishing the staged operations")
+            with timer.phase('publish') as phase:
+                num_published, duration = _publish_staged_operations(
+                    upload_id
                 )
-            _mv_file(file_to_parse, 'error')
-            logger.error(u"File has been moved to error directory")
-            return False
-
-        else:
-            logger.info(u"Accounting operations where successfully stored")
-            _mv_file(file_to_parse)
-            logger.info(u"File has been moved to processed directory")
+                phase.rows = num_published
+            published = True
+            logger.info(
+                u" * {0} operations published, the publish transaction "
+                u"lasted {1:.3f}s".format(num_published, duration)
+            )
 
-        if old_ids:
-            transaction.begin()
-            logger.info("  + Cleaning %s old operations" % len(old_ids))
+        logger.info(u"  + Cleaning old {0} operations".format(filetype))
+        with timer.phase('cleanup') as phase:
+            num_deleted = _clean_old_operations(upload_id, filetype)
+            phase.rows = num_deleted
+        logger.info(
+            u" * {0} old operations cleaned successfully".format(num_deleted)
+        )
+    except Exception as err:
+        transaction.abort()
+        if self.request.retries < self.max_retries:
+            logger.exception(u"Error while cleaning operations, retrying")
+            raise self.retry(exc=err)
+
+        logger.exception(u"Error while cleaning operations")
+        if payload['staged'] and not published:
             try:
-                _clean_old_operations(old_ids)
-                transaction.commit()
-            except:
+                _drop_staged_upload(upload_id)
+            except Exception:
                 transaction.abort()
-                logger.exception(u"Error while cleaning old operations")
-            else:
-                logger.info(u" * Old datas cleaned successfully")
+                logger.exception(u"The staged upload could not be dropped")
+            # The operations were not published, there's nothing to compile
+            _report_failure(
+                self.request, payload['filename'], err, payload['file_path']
+            )
+            return None
 
-        transaction.begin()
-        logger.info(u" + Compiling the measures")
-        # On rafraichit l'objet car nous sommes dans une nouvelle transaction
-        # on évite ainsi le problème de "is not bound to a Session"
-        upload_object = AccountingOperationUpload.get(upload_object_id)
-        num_operations = len(upload_object.operations)
+    payload['phases'] = timer.todict()
+    return payload
 
-        logger.debug(" + Retrieved the upload object %s" % upload_object.date)
-        logger.debug(" + %s operations" % num_operations)
 
-        measure_compiler_factory = get_measure_compiler(parser.filetype)
+@celery_app.task(bind=True, max_retries=3, default_retry_delay=60)
+def compile_upload_measures_task(self, payload):
+    """
+    Compile the measures of an upload
 
-        try:
-            measure_compiler = measure_compiler_factory(
-                upload_object, upload_object.operations
+    :param dict payload: The datas returned by the previous stage
+    :returns: The payload
+    """
+    if payload is None:
+        return None
+
+    upload_id = payload['upload_id']
+    filetype = payload['filetype']
+    timer = _get_payload_timer(payload)
+    _touch_file(payload['file_path'])
+
+    transaction.begin()
+    try:
+        if _is_superseded(upload_id, filetype):
+            logger.info(
+                u" + The measures of upload {0} will be compiled with a more "
+                u"recent upload".format(upload_id)
             )
-            measure_compiler.process_datas()
-            transaction.commit()
-        except KnownError as err:
             transaction.abort()
-            logger.exception(u"KnownError : %s" % err.message)
-            if mail_addresses:
-                send_error(self.request, mail_addresses, filename, err)
-                logger.error(
-                    u"An error mail has been sent to {0}".format(mail_addresses)
-                )
-            logger.exception(u"* FAILED : transaction has been rollbacked")
-            return False
+            payload['superseded'] = True
+            return payload
 
-        except Exception as err:
-            transaction.abort()
-            logger.exception(u"Unkown Error")
-            if mail_addresses:
-                send_unknown_error(self.request, mail_addresses, filename, err)
-                logger.error(
-                    u"An error mail has been sent to {0}".format(mail_addresses)
-                )
-            logger.exception(u"* FAILED : transaction has been rollbacked")
-            return False
+        logger.info(u" + Compiling the measures")
+        upload_object = AccountingOperationUpload.get(upload_id)
+        num_operations = DBSESSION().query(
+            func.count(AccountingOperation.id)
+        ).filter(AccountingOperation.upload_id == upload_id).scalar()
 
-        else:
-            logger.info(u"Measure computing transaction has been commited")
-            logger.info(u"* SUCCEEDED !!!")
-
-            if mail_addresses:
-                send_success(
-                    self.request,
-                    mail_addresses,
-                    filename,
-                    num_operations,
-                    missed_associations,
-                )
-                logger.info(
-                    u"A success email has been sent to {0}".format(
-                        mail_addresses
-                    )
+        logger.debug(" + Retrieved the upload object %s" % upload_object.date)
+        logger.debug(" + %s operations" % num_operations)
+
+        company_ids = payload.get('affected_company_ids')
+        if company_ids is not None:
+            logger.info(
+                u" + Only compiling the measures of {0} companies".format(
+                    len(company_ids)
                 )
+            )
+        with timer.phase('compile', rows=num_operations):
+            compile_measures(
+                upload_object,
+                company_ids=company_ids,
+                months=payload.get('affected_months'),
+                heartbeat=_get_heartbeat(payload['file_path']),
+            )
+        transaction.commit()
+    except KnownError as err:
+        transaction.abort()
+        logger.exception(u"KnownError : %s" % err.message)
+        logger.exception(u"* FAILED : transaction has been rollbacked")
+        _report_failure(
+            self.request, payload['filename'], err, payload['file_path']
+        )
+        return None
+
+    except Exception as err:
+        transaction.abort()
+        if self.request.retries < self.max_retries:
+            logger.exception(u"Error while compiling measures, retrying")
+            raise self.retry(exc=err)
+
+        logger.exception(u"Unkown Error")
+        logger.exception(u"* FAILED : transaction has been rollbacked")
+        _report_failure(
+            self.request, payload['filename'], err, payload['file_path']
+        )
+        return None
+
+    logger.info(u"Measure computing transaction has been commited")
+    payload['num_operations'] = num_operations
+    payload['phases'] = timer.todict()
+    return payload
+
+
+@celery_app.task(bind=True)
+def notify_upload_task(self, payload):
+    """
+    Store the processing metrics of an upload and send the success mail
+
+    :param dict payload: The datas returned by the previous stage
+    """
+    if payload is None:
+        return False
+
+    logger.info(u"* SUCCEEDED !!!")
+    timer = _get_payload_timer(payload)
+    with timer.phase('move'):
+        _release_file(payload)
+    _record_upload_metrics(payload['upload_id'], timer)
+
+    try:
+        mail_addresses = _get_recipients_addresses(self.request)
+        if mail_addresses:
+            send_success(
+                self.request,
+                mail_addresses,
+                payload['filename'],
+                payload.get('num_operations', payload['num_stored']),
+                payload['missed_associations'],
+                timer,
+            )
+            logger.info(
+                u"A success email has been sent to {0}".format(mail_addresses)
+            )
+    except Exception:
+        logger.exception(u"The success mail could not be sent")
+    return True
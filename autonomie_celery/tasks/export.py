@@ -194,10 +194,16 @@ def _write_file_on_disk(tmpdir, model_type, ids, filename, extension):
     if 'hook_init' in config:
         writer = config['hook_init'](writer, query)
 
+    hook_add_row = config.get('hook_add_row')
+    if 'hook_add_row_factory' in config:
+        # The hook is built for this export (e.g : with datas collected once
+        # from the query)
+        hook_add_row = config['hook_add_row_factory'](query)
+
     for item in query:
         writer.add_row(item)
-        if 'hook_add_row' in config:
-            config['hook_add_row'](writer, item)
+        if hook_add_row is not None:
+            hook_add_row(writer, item)
 
     filepath = _get_tmp_filepath(tmpdir, filename, extension)
     logger.debug(" + Writing file to %s" % filepath)
@@ -3,9 +3,12 @@
 #       * TJEBBES Gaston <g.t@majerti.fr>
 #       * Arezki Feth <f.a@majerti.fr>;
 #       * Miotte Julien <j.m@majerti.fr>;
+import resource
 import time
 import transaction
 
+from collections import OrderedDict
+from contextlib import contextmanager
 from sqlalchemy.orm.exc import NoResultFound
 from celery.utils.log import get_task_logger
 
@@ -147,6 +150,156 @@ def record_completed(job_model, job_id, **kwargs):
     logger.info(u"* Task marked as COMPLETED")
 
 
+def _get_cpu_time():
+    """
+    Return the cpu time (user + system) used by the current process
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _get_peak_memory():
+    """
+    Return the max resident set size of the current process (in kB), it's
+    the process' high-water mark : it never decreases
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _get_memory():
+    """
+    Return the current resident set size of the current process (in kB)
+
+    Where /proc is not available, the max resident set size is returned
+    """
+    try:
+        with open('/proc/self/statm') as fbuf:
+            pages = int(fbuf.read().split()[1])
+    except (IOError, OSError, IndexError, ValueError):
+        return _get_peak_memory()
+    return pages * resource.getpagesize() // 1024
+
+
+class Phase(object):
+    """
+    Wall time, cpu time, handled rows and memory of a task's phase
+
+    memory_delta is the largest growth of the resident set size (in kB)
+    during one run of the phase, peak_memory is the high-water mark of the
+    process at the end of the phase (it includes the previous phases and
+    tasks run by the same worker process)
+    """
+    def __init__(self, name):
+        self.name = name
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.rows = 0
+        self.peak_memory = 0
+        self.memory_delta = 0
+
+    @property
+    def rows_per_second(self):
+        if self.rows and self.wall:
+            return self.rows / self.wall
+        return None
+
+    def todict(self):
+        return dict(
+            phase=self.name,
+            wall=self.wall,
+            cpu=self.cpu,
+            rows=self.rows,
+            rows_per_second=self.rows_per_second,
+            peak_memory=self.peak_memory,
+            memory_delta=self.memory_delta,
+        )
+
+
+class PhaseTimer(object):
+    """
+    Collect the figures of the phases of a task
+
+        timer = PhaseTimer()
+        with timer.phase('parse') as phase:
+            phase.rows = parse()
+
+    A phase can be entered several times, its figures are then summed up.
+    The time spent in nested phases is not counted in the enclosing one.
+    """
+    def __init__(self):
+        self.phases = OrderedDict()
+        # Wall and cpu time spent in the nested phases of the running ones
+        self._stack = []
+
+    @contextmanager
+    def phase(self, name, rows=0):
+        """
+        Time the enclosed block as the given phase
+
+        :param str name: The phase's name
+        :param int rows: The number of rows handled in the block
+        """
+        phase = self.phases.get(name)
+        if phase is None:
+            phase = self.phases[name] = Phase(name)
+
+        start_wall = time.time()
+        start_cpu = _get_cpu_time()
+        start_memory = _get_memory()
+        self._stack.append([0.0, 0.0])
+        try:
+            yield phase
+        finally:
+            wall = time.time() - start_wall
+            cpu = _get_cpu_time() - start_cpu
+            nested_wall, nested_cpu = self._stack.pop()
+            phase.wall += wall - nested_wall
+            phase.cpu += cpu - nested_cpu
+            phase.rows += rows
+            phase.peak_memory = max(phase.peak_memory, _get_peak_memory())
+            phase.memory_delta = max(
+                phase.memory_delta, _get_memory() - start_memory
+            )
+            if self._stack:
+                self._stack[-1][0] += wall
+                self._stack[-1][1] += cpu
+
+    @classmethod
+    def from_dicts(cls, phases):
+        """
+        Build a timer with the phases exported by another one (through
+        todict), e.g : in the previous task of a chain
+        """
+        timer = cls()
+        for datas in phases:
+            phase = timer.phases[datas['phase']] = Phase(datas['phase'])
+            phase.wall = datas['wall']
+            phase.cpu = datas['cpu']
+            phase.rows = datas['rows']
+            phase.peak_memory = datas['peak_memory']
+            phase.memory_delta = datas.get('memory_delta', 0)
+        return timer
+
+    def todict(self):
+        return [phase.todict() for phase in self.phases.values()]
+
+    def format(self):
+        """
+        Return a human readable summary of the phases
+
+        :rtype: unicode
+        """
+        lines = []
+        for phase in self.phases.values():
+            line = u"{0} : {1:.2f}s (cpu {2:.2f}s)".format(
+                phase.name, phase.wall, phase.cpu
+            )
+            if phase.rows_per_second:
+                line += u", {0:.0f} lignes/s".format(phase.rows_per_second)
+            lines.append(line)
+        return u"\n".join(lines)
+
+
 def check_alive():
     """
     Check the redis service is available
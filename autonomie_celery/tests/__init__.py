@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+"""
+Tests of the accounting files processing
+
+The optimized implementations are checked against the ones they replace
+
+    py.test autonomie_celery/tests
+"""
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+import random
+
+import pytest
+import transaction
+
+from zope.sqlalchemy import mark_changed
+
+from autonomie_base.models.base import DBSESSION
+from autonomie.models.company import Company
+from autonomie.models.accounting.operations import (
+    AccountingOperationUpload,
+    AccountingOperation,
+)
+from autonomie_celery.benchmarks.accounting_parser import setup_database
+from autonomie_celery.benchmarks.generators import operation_datas
+from autonomie_celery.benchmarks.measure_compiler import (
+    FILETYPES,
+    MONTH,
+    YEAR,
+    fill_database,
+)
+
+
+@pytest.fixture
+def dbsession():
+    """
+    An in-memory SQLite database with the accounting tables and 10 companies
+    (analytical accounts ANA00001 to ANA00010)
+    """
+    DBSESSION.remove()
+    setup_database('sqlite://', 10)
+    yield DBSESSION
+    transaction.abort()
+    DBSESSION.remove()
+
+
+def _add_operations(upload_id, num_operations, seed):
+    """
+    Add operations with negative amounts, accounts matching no measure type
+    and operations without company to the given upload
+    """
+    rand = random.Random(seed)
+    transaction.begin()
+    session = DBSESSION()
+    company_ids = [row.id for row in session.query(Company.id)]
+    operations = []
+    for datas in operation_datas(num_operations, 10, YEAR, MONTH, seed=seed):
+        datas[rand.choice(('debit', 'credit'))] *= -1
+        datas['balance'] = round(datas['debit'] - datas['credit'], 2)
+        if rand.random() < 0.3:
+            datas['general_account'] = u"99900000"
+        datas['upload_id'] = upload_id
+        datas['company_id'] = rand.choice(company_ids + [None])
+        operations.append(datas)
+    session.execute(AccountingOperation.__table__.insert(), operations)
+    mark_changed(session)
+    transaction.commit()
+
+
+@pytest.fixture(params=sorted(FILETYPES))
+def measure_upload(request):
+    """
+    An upload with its operations and the measure types of a compiler
+    (treasury or income_statement), in an in-memory SQLite database
+    """
+    DBSESSION.remove()
+    _, upload_id = fill_database(
+        'sqlite://', request.param, 600, 10, 30, 3, seed=11
+    )
+    _add_operations(upload_id, 400, seed=12)
+    transaction.begin()
+    yield AccountingOperationUpload.get(upload_id)
+    transaction.abort()
+    DBSESSION.remove()
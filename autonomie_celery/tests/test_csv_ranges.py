@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+"""
+The byte ranges of _find_csv_ranges give the same rows as parsing the whole
+file
+"""
+import hashlib
+import io
+import os
+
+from autonomie_base.utils import csv_tools
+from autonomie_celery.benchmarks.generators import (
+    general_ledger_rows,
+    write_csv_file,
+)
+from autonomie_celery.tasks.accounting_parser import _find_csv_ranges
+
+
+def _read_rows(fbuf):
+    return list(
+        csv_tools.UnicodeReader(
+            fbuf, quotechar='"', delimiter=',', encoding='utf-8',
+        )
+    )
+
+
+def _write_file(tmpdir):
+    rows = list(general_ledger_rows(300, 20, 2018, 6, seed=2))
+    # Quoted values with line breaks and quotes
+    for index in range(1, len(rows), 7):
+        rows[index][5] = u"Opération\r\nsur \"deux\"\nlignes %s" % index
+    path = os.path.join(str(tmpdir), u"general_ledger_2018_06_test.csv")
+    return write_csv_file(path, rows)
+
+
+def _read_range_rows(path, ranges):
+    result = []
+    with open(path, 'rb') as fbuf:
+        for start, end in ranges:
+            fbuf.seek(start)
+            result.extend(_read_rows(io.BytesIO(fbuf.read(end - start))))
+    return result
+
+
+def test_ranges_rows(tmpdir):
+    path = _write_file(tmpdir)
+    with open(path, 'rb') as fbuf:
+        expected = _read_rows(fbuf)
+
+    for range_size, blocksize in ((1, 64), (500, 128), (4096, 1048576)):
+        ranges, _ = _find_csv_ranges(
+            path, range_size, quotechar='"', blocksize=blocksize
+        )
+        assert _read_range_rows(path, ranges) == expected
+
+
+def test_ranges_bounds(tmpdir):
+    path = _write_file(tmpdir)
+    ranges, _ = _find_csv_ranges(path, 1000, blocksize=256)
+    assert len(ranges) > 1
+    assert ranges[0][0] == 0
+    assert ranges[-1][1] == os.path.getsize(path)
+    for (_, end), (start, _) in zip(ranges, ranges[1:]):
+        assert end == start
+
+
+def test_ranges_md5sum(tmpdir):
+    path = _write_file(tmpdir)
+    with open(path, 'rb') as fbuf:
+        expected = hashlib.md5(fbuf.read()).hexdigest()
+    _, md5sum = _find_csv_ranges(path, 1000, blocksize=256)
+    assert md5sum == expected
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+"""
+The measure engines give the same values as
+BaseMeasureCompiler.compute_values
+"""
+import pytest
+
+from autonomie_base.models.base import DBSESSION
+from autonomie.models.company import Company
+from autonomie.models.accounting.operations import AccountingOperation
+from autonomie_celery.tasks.accounting_measure_compute import (
+    NumpyMeasureEngine,
+    ProcessPoolMeasureEngine,
+    get_measure_compiler,
+    numpy,
+)
+
+
+def _get_scope(scoped):
+    """
+    Return the (company ids, months) the compilation is restricted to
+    """
+    if not scoped:
+        return None, None
+    company_ids = sorted(
+        row.id for row in DBSESSION().query(Company.id)
+    )[:3]
+    return company_ids, [2, 5]
+
+
+def _get_compiler(upload, company_ids=None, months=None, operations=None):
+    compiler_factory = get_measure_compiler(upload.filetype)
+    if operations is None:
+        operations = compiler_factory.filter_operations(
+            AccountingOperation.query().filter_by(upload_id=upload.id),
+            company_ids,
+            months,
+        ).order_by(AccountingOperation.id).all()
+    return compiler_factory(upload, operations, company_ids, months)
+
+
+def _assert_same_values(values, expected):
+    assert sorted(values) == sorted(expected)
+    for key, type_values in expected.items():
+        assert sorted(values[key]) == sorted(type_values)
+        for measure_type_id, value in type_values.items():
+            assert values[key][measure_type_id] == pytest.approx(value)
+
+
+@pytest.mark.skipif(numpy is None, reason=u"numpy is not installed")
+@pytest.mark.parametrize('scoped', [False, True])
+def test_numpy_engine(measure_upload, scoped):
+    company_ids, months = _get_scope(scoped)
+    compiler = _get_compiler(measure_upload, company_ids, months)
+    expected = compiler.compute_values()
+    assert len(expected) > 1
+
+    numpy_compiler = _get_compiler(
+        measure_upload,
+        company_ids,
+        months,
+        NumpyMeasureEngine.load_operations(
+            measure_upload, type(compiler), company_ids, months
+        ),
+    )
+    values = NumpyMeasureEngine(numpy_compiler).compute_values()
+    # The grids are listed in the operations' order
+    assert list(values) == list(expected)
+    _assert_same_values(values, expected)
+    _assert_same_values(
+        numpy_compiler.compute_totals(values),
+        compiler.compute_totals(expected),
+    )
+
+
+@pytest.mark.parametrize('scoped', [False, True])
+def test_pool_engine(measure_upload, scoped):
+    company_ids, months = _get_scope(scoped)
+    compiler = _get_compiler(measure_upload, company_ids, months)
+    expected = compiler.compute_values()
+
+    engine = ProcessPoolMeasureEngine(compiler, processes=4)
+    # Forked even for a small upload
+    engine.min_operations = 1
+    values = engine.compute_values()
+    # The values of several partitions have been merged
+    assert len(engine.partitions) > 1
+    _assert_same_values(values, expected)
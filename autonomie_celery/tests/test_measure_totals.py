@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+"""
+Formula and MeasureTotalGraph give the same totals as formatting the formulas
+and evaluating them with eval until nothing changes
+"""
+import pytest
+
+from autonomie_celery.measure_totals import (
+    Formula,
+    FormulaError,
+    MeasureTotalGraph,
+)
+
+
+class Category(object):
+    def __init__(self, label):
+        self.label = label
+
+
+class MeasureType(object):
+    def __init__(
+        self, id, label, account_prefix=u"", category=None, total_type=None
+    ):
+        self.id = id
+        self.label = label
+        self.account_prefix = account_prefix
+        self.category = category
+        self.is_total = total_type is not None
+        self.total_type = total_type
+
+
+VALUES = {
+    u"Produits": 1200.5,
+    u"Charges externes": 300.25,
+    u"Salaires": -150,
+    u"Achats": 0,
+}
+FORMULAS = [
+    u"{Produits} - {Charges externes}",
+    u"{Produits} - ({Charges externes} + {Salaires}) * 2",
+    u"-{Salaires} / 4 + 1.5",
+    u"{ Produits } * 10 / 100",
+    u"{Produits} / {Charges externes}",
+    u"12",
+    u"{Inconnu} + {Produits}",
+]
+
+
+def _eval_formula(formula, values):
+    """
+    Evaluate a formula the naive way
+    """
+    expression = formula
+    for label in Formula(formula).labels:
+        for written in (u"{%s}" % label, u"{ %s }" % label):
+            expression = expression.replace(
+                written, u"(%r)" % float(values.get(label, 0))
+            )
+    return float(eval(expression))
+
+
+def test_formula_against_eval():
+    for formula in FORMULAS:
+        assert Formula(formula).evaluate(VALUES) == pytest.approx(
+            _eval_formula(formula, VALUES)
+        )
+
+
+def test_formula_division_by_zero():
+    assert Formula(u"{Produits} / {Achats}").evaluate(VALUES) == 0
+
+
+@pytest.mark.parametrize('formula', [
+    u"__import__('os')",
+    u"{Produits} ** 2",
+    u"{Produits}.real",
+    u"{Produits} +",
+    u"[{Produits}]",
+    u"{Produits",
+])
+def test_formula_invalid(formula):
+    with pytest.raises(FormulaError):
+        Formula(formula)
+
+
+def _reference_totals(measure_types, total_types, values):
+    """
+    Compute the totals by evaluating all of them until nothing changes
+    """
+    values = dict(values)
+    category_values = {}
+    for measure_type in measure_types:
+        if measure_type.category is not None:
+            label = measure_type.category.label
+            category_values[label] = category_values.get(label, 0) + \
+                values.get(measure_type.id, 0)
+
+    for _ in range(len(total_types) + 1):
+        labelled = dict(category_values)
+        for measure_type in measure_types + total_types:
+            labelled[measure_type.label] = values.get(measure_type.id, 0)
+        for measure_type in total_types:
+            if measure_type.total_type == 'categories':
+                values[measure_type.id] = sum(
+                    category_values.get(label.strip(), 0)
+                    for label in measure_type.account_prefix.split(',')
+                )
+            else:
+                values[measure_type.id] = _eval_formula(
+                    measure_type.account_prefix, labelled
+                )
+    return values
+
+
+def _get_types():
+    products = Category(u"Produits")
+    charges = Category(u"Charges")
+    measure_types = [
+        MeasureType(1, u"Ventes", u"70", category=products),
+        MeasureType(2, u"Subventions", u"74", category=products),
+        MeasureType(3, u"Achats", u"60", category=charges),
+        MeasureType(4, u"Salaires", u"64", category=charges),
+    ]
+    # Totals referencing the following ones
+    total_types = [
+        MeasureType(
+            10, u"Résultat net", u"{Résultat} - {Impôts}",
+            total_type='complex_total',
+        ),
+        MeasureType(
+            11, u"Impôts", u"{Résultat} * 0.25", total_type='complex_total'
+        ),
+        MeasureType(
+            12, u"Résultat", u"{Total produits} - {Charges}",
+            total_type='complex_total',
+        ),
+        MeasureType(
+            13, u"Total produits", u"Produits", total_type='categories'
+        ),
+        MeasureType(
+            14, u"Marge", u"{Ventes} / ({Ventes} + {Achats})",
+            total_type='complex_total',
+        ),
+    ]
+    return measure_types, total_types
+
+
+def test_graph_against_reference():
+    measure_types, total_types = _get_types()
+    values = {1: 1000.0, 2: 200.0, 3: -400.0, 4: -300.0}
+    graph = MeasureTotalGraph(measure_types, total_types)
+
+    expected = _reference_totals(measure_types, total_types, values)
+    result = graph.evaluate(dict(values))
+    assert sorted(result) == sorted(expected)
+    for type_id, value in expected.items():
+        assert result[type_id] == pytest.approx(value)
+
+
+def test_graph_order():
+    measure_types, total_types = _get_types()
+    graph = MeasureTotalGraph(measure_types, total_types)
+    order = [measure_type.id for measure_type in graph.total_types]
+    assert sorted(order) == [10, 11, 12, 13, 14]
+    assert order.index(13) < order.index(12) < order.index(11) < \
+        order.index(10)
+
+
+def test_graph_cycle():
+    measure_types, total_types = _get_types()
+    total_types.extend([
+        MeasureType(20, u"A", u"{B} + 1", total_type='complex_total'),
+        MeasureType(21, u"B", u"{A} + 1", total_type='complex_total'),
+        MeasureType(22, u"C", u"{A} + {Ventes}", total_type='complex_total'),
+        MeasureType(
+            23, u"Invalide", u"{Ventes} **", total_type='complex_total'
+        ),
+    ])
+    graph = MeasureTotalGraph(measure_types, total_types)
+    order = [measure_type.id for measure_type in graph.total_types]
+    assert sorted(order) == [10, 11, 12, 13, 14]
+
+    values = {1: 1000.0, 2: 200.0, 3: -400.0, 4: -300.0}
+    result = graph.evaluate(dict(values))
+    for type_id in (20, 21, 22, 23):
+        assert type_id not in result
+
+
+def test_graph_without_totals():
+    measure_types, _ = _get_types()
+    graph = MeasureTotalGraph(measure_types, [])
+    values = {1: 1.0}
+    assert graph.evaluate(values) == {1: 1.0}
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+"""
+MeasureTypeIndex gives the same types as calling match on each type
+"""
+from autonomie.models.accounting.treasury_measures import (
+    TreasuryMeasureType,
+)
+from autonomie_celery.benchmarks.generators import (
+    GENERAL_ACCOUNTS,
+    account_prefixes,
+)
+from autonomie_celery.tasks.accounting_measure_compute import (
+    MeasureTypeIndex,
+)
+
+
+EDGE_PREFIXES = [
+    u"6",
+    u" 7 ",
+    u"6,-603",
+    u"60,-6041,-6042",
+    u"-6",
+    u"41,",
+    u"",
+]
+EDGE_ACCOUNTS = [
+    u"",
+    u"6",
+    u"60",
+    u"6041",
+    u"60410000",
+    u"A6000",
+    u" 70600000",
+]
+
+
+def _get_measure_types(prefixes):
+    return [
+        TreasuryMeasureType(
+            label=u"Indicateur %s" % index,
+            account_prefix=prefix,
+            active=True,
+        )
+        for index, prefix in enumerate(prefixes)
+    ]
+
+
+def _match(measure_types, account):
+    return [
+        measure_type for measure_type in measure_types
+        if measure_type.match(account)
+    ]
+
+
+def test_generated_prefixes():
+    measure_types = _get_measure_types(account_prefixes(80, seed=3))
+    index = MeasureTypeIndex(measure_types)
+    for account in GENERAL_ACCOUNTS + EDGE_ACCOUNTS:
+        assert index.get(account) == _match(measure_types, account)
+
+
+def test_edge_prefixes():
+    measure_types = _get_measure_types(EDGE_PREFIXES)
+    index = MeasureTypeIndex(measure_types)
+    for account in GENERAL_ACCOUNTS + EDGE_ACCOUNTS:
+        assert index.get(account) == _match(measure_types, account)
+
+
+def test_cached_result():
+    measure_types = _get_measure_types([u"6", u"60"])
+    index = MeasureTypeIndex(measure_types)
+    assert index.get(u"60100000") is index.get(u"60100000")
+    assert index.get(u"70600000") == []
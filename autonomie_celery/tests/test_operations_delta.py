@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+"""
+The incremental mode leaves the same operations as the full reload it
+replaces (old operations deleted, all the file's operations inserted)
+"""
+import datetime
+
+from collections import Counter
+from decimal import Decimal
+
+from autonomie.models.accounting.operations import AccountingOperation
+from autonomie_celery.benchmarks.generators import operation_datas
+from autonomie_celery.tasks.accounting_parser import (
+    FINGERPRINT_COLUMNS,
+    GeneralLedgerParser,
+    _get_fingerprint,
+)
+
+
+class DeltaParser(GeneralLedgerParser):
+    """
+    A parser whose database and file are lists of operation datas
+    """
+    chunk_size = 7
+
+    def __init__(self, stored, lines):
+        self.stored = stored
+        self.lines = lines
+        self.num_operations = 0
+        self.inserted = []
+        self.deleted = []
+
+    def _load_fingerprints(self, upload_id):
+        result = {}
+        for id_, datas in sorted(self.stored.items()):
+            fingerprint = _get_fingerprint(
+                datas.get(name) for name in FINGERPRINT_COLUMNS
+            )
+            result.setdefault(fingerprint, []).append(
+                (id_, datas['company_id'], datas['date'])
+            )
+        return result
+
+    def _stream_operations_datas(self):
+        for datas in self.lines:
+            self.num_operations += 1
+            yield dict(datas)
+
+    def _insert_chunk(self, upload_id, chunk):
+        self.inserted.extend(chunk)
+
+    def _delete_operations(self, ids):
+        self.deleted.extend(ids)
+
+
+def _get_operations(num_operations, seed):
+    result = []
+    for datas in operation_datas(num_operations, 10, 2018, 6, seed=seed):
+        datas['company_id'] = int(datas['analytical_account'][3:])
+        result.append(datas)
+    return result
+
+
+def _fingerprints(operations):
+    return Counter(
+        _get_fingerprint(datas.get(name) for name in FINGERPRINT_COLUMNS)
+        for datas in operations
+    )
+
+
+def _apply_delta(stored, lines):
+    """
+    Run the delta and return the parser and the operations left in the
+    database
+    """
+    parser = DeltaParser(stored, lines)
+    parser._store_operations_delta(1)
+    result = [
+        datas for id_, datas in stored.items() if id_ not in parser.deleted
+    ]
+    return parser, result + parser.inserted
+
+
+def test_fingerprint_database_values():
+    date = datetime.date(2018, 6, 2)
+    file_values = [
+        u"ANA00001", u"60100000", date, u"Achat", 12.5, 0.0, 0.0, 1,
+    ]
+    db_values = [
+        u"ANA00001", u"60100000", date, u"Achat",
+        Decimal("12.50"), Decimal("0"), 0.0, 1,
+    ]
+    assert _get_fingerprint(file_values) == _get_fingerprint(db_values)
+    db_values[4] = 12.51
+    assert _get_fingerprint(file_values) != _get_fingerprint(db_values)
+
+
+def test_fingerprint_truncated_values():
+    length = AccountingOperation.__table__.c.label.type.length
+    date = datetime.date(2018, 6, 2)
+    label = u"Libellé " * length
+    file_values = [
+        u"ANA00001", u"60100000", date, label, 12.5, 0.0, 0.0, 1,
+    ]
+    db_values = list(file_values)
+    db_values[3] = label[:length]
+    assert _get_fingerprint(file_values) == _get_fingerprint(db_values)
+
+
+def test_delta_changed_lines():
+    old_lines = _get_operations(200, seed=6)
+    new_lines = list(old_lines)
+    # Changed, removed, added and duplicated lines
+    new_lines[3] = dict(new_lines[3], debit=new_lines[3]['debit'] + 1)
+    del new_lines[10]
+    new_lines.extend(_get_operations(5, seed=7))
+    new_lines.append(dict(new_lines[20]))
+
+    stored = dict(enumerate(old_lines, 1))
+    parser, result = _apply_delta(stored, new_lines)
+
+    assert _fingerprints(result) == _fingerprints(new_lines)
+    assert len(parser.inserted) == 7
+    assert len(parser.deleted) == 2
+    changed = [new_lines[3], old_lines[3], old_lines[10], new_lines[-1]]
+    changed.extend(new_lines[-6:-1])
+    assert parser.affected_company_ids == set(
+        datas['company_id'] for datas in changed
+    )
+    assert parser.affected_months == set(
+        datas['date'].month for datas in changed
+    )
+
+
+def test_delta_same_file():
+    lines = _get_operations(100, seed=8)
+    parser, result = _apply_delta(dict(enumerate(lines, 1)), lines)
+    assert _fingerprints(result) == _fingerprints(lines)
+    assert parser.inserted == []
+    assert parser.deleted == []
+    assert parser.affected_company_ids == set()
+
+
+def test_delta_empty_file():
+    lines = _get_operations(10, seed=9)
+    parser, result = _apply_delta(dict(enumerate(lines, 1)), [])
+    # Old datas are only replaced if the new file provided some
+    assert parser.deleted == []
+    assert _fingerprints(result) == _fingerprints(lines)
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+"""
+The files of a filetype are dispatched one at a time in their arrival order,
+even when two dispatch runs see the same pool or when a stale file is
+released
+"""
+import os
+import time
+
+import pytest
+
+from autonomie_celery.tasks import accounting_parser
+
+
+LEDGER_FILES = [
+    u"general_ledger_2018_06_%s.csv" % index for index in range(1, 4)
+]
+BALANCE_FILE = u"analytical_balance_2018_06_30_1.csv"
+
+
+class Pool(object):
+    """
+    Pool, processing and error directories in a temporary directory, the
+    dispatched chains are recorded instead of being sent
+    """
+    def __init__(self, base_path):
+        self.base_path = base_path
+        self.chains = []
+        for directory in ('pool', 'processing', 'processed', 'error'):
+            os.mkdir(self.path(directory))
+
+    def path(self, directory, filename=None):
+        result = os.path.join(self.base_path, directory)
+        if filename is not None:
+            result = os.path.join(result, filename)
+        return result
+
+    def add(self, filename, arrived_at):
+        path = self.path('pool', filename)
+        with open(path, 'w') as fbuf:
+            fbuf.write(filename)
+        os.utime(path, (arrived_at, arrived_at))
+        return path
+
+    def listdir(self, directory):
+        return sorted(os.listdir(self.path(directory)))
+
+    def chain(self, *paths):
+        return RecordedChain(self.chains, paths)
+
+
+class RecordedChain(object):
+    def __init__(self, chains, paths):
+        self.chains = chains
+        self.paths = paths
+
+    def delay(self):
+        self.chains.append([os.path.basename(path) for path in self.paths])
+
+
+@pytest.fixture
+def pool(tmpdir, monkeypatch):
+    result = Pool(str(tmpdir))
+    monkeypatch.setattr(accounting_parser, '_get_path', result.path)
+    monkeypatch.setattr(
+        accounting_parser, '_get_processing_timeout', lambda: 60
+    )
+    monkeypatch.setattr(
+        accounting_parser, '_get_recipients_addresses', lambda request: []
+    )
+    monkeypatch.setattr(
+        accounting_parser,
+        '_get_file_tasks',
+        lambda file_to_parse, force=False: [file_to_parse],
+    )
+    monkeypatch.setattr(accounting_parser, 'chain', result.chain)
+    return result
+
+
+def test_concurrent_runs(pool, monkeypatch):
+    now = time.time()
+    for index, filename in enumerate(LEDGER_FILES):
+        pool.add(filename, now - 100 + index)
+    pool.add(BALANCE_FILE, now - 10)
+
+    # A watcher run claims the first ledger file while the periodic run is
+    # dispatching the same pool
+    claim_file = accounting_parser._claim_file
+    claims = []
+
+    def concurrent_claim_file(file_path, claimed_at=None):
+        if not claims:
+            claims.append(file_path)
+            accounting_parser.handle_pool_task(
+                paths=[pool.path('pool', LEDGER_FILES[0])]
+            )
+        return claim_file(file_path, claimed_at)
+
+    monkeypatch.setattr(
+        accounting_parser, '_claim_file', concurrent_claim_file
+    )
+    assert accounting_parser.handle_pool_task() == 1
+
+    assert pool.chains == [[LEDGER_FILES[0]], [BALANCE_FILE]]
+    assert pool.listdir('pool') == LEDGER_FILES[1:]
+    assert pool.listdir('processing') == sorted(
+        [LEDGER_FILES[0], BALANCE_FILE]
+    )
+
+
+def test_stale_file(pool):
+    now = time.time()
+    for index, filename in enumerate(LEDGER_FILES):
+        accounting_parser._claim_file(
+            pool.add(filename, now - 7200 + index), now - 3600
+        )
+    # The first file's stage touched it before its worker died
+    started_path = pool.path('processing', LEDGER_FILES[0])
+    os.utime(started_path, (now - 3500, now - 3500))
+    new_file = u"general_ledger_2018_07_1.csv"
+    pool.add(new_file, now - 10)
+
+    assert accounting_parser.handle_pool_task() == 3
+
+    assert pool.listdir('error') == [LEDGER_FILES[0]]
+    # The queued files are dispatched again before the new one
+    assert pool.chains == [LEDGER_FILES[1:] + [new_file]]
+    assert pool.listdir('pool') == []
+
+
+def test_busy_filetype(pool):
+    now = time.time()
+    accounting_parser._claim_file(pool.add(LEDGER_FILES[0], now - 100))
+    pool.add(LEDGER_FILES[1], now - 50)
+
+    assert accounting_parser.handle_pool_task() == 0
+    assert pool.chains == []
+    assert pool.listdir('pool') == [LEDGER_FILES[1]]
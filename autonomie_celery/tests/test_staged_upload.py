@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+"""
+An upload whose staged operations can't be published is removed with them,
+the file can then be loaded again
+"""
+import datetime
+
+import pytest
+import transaction
+
+from sqlalchemy import (
+    func,
+    select,
+)
+from zope.sqlalchemy import mark_changed
+
+from autonomie.models.accounting.operations import AccountingOperationUpload
+from autonomie_celery.models import ACCOUNTING_OPERATION_STAGING
+from autonomie_celery.tasks import accounting_parser
+
+
+MD5SUM = u"0cc175b9c0f1b6a831c399e269772661"
+
+
+@pytest.fixture
+def upload_id(dbsession):
+    transaction.begin()
+    session = dbsession()
+    upload = AccountingOperationUpload(
+        filename=u"general_ledger_2018_06_test.csv",
+        date=datetime.date(2018, 6, 1),
+        filetype='general_ledger',
+        md5sum=MD5SUM,
+    )
+    session.add(upload)
+    session.flush()
+    result = upload.id
+
+    accounting_parser._create_staging_table()
+    session.execute(
+        ACCOUNTING_OPERATION_STAGING.insert(),
+        [
+            dict(
+                upload_id=result,
+                analytical_account=u"ANA%05d" % index,
+                general_account=u"60100000",
+                date=datetime.date(2018, 6, index),
+                label=u"Achat",
+                debit=10 * index,
+                credit=0,
+                balance=0,
+                company_id=index,
+            )
+            for index in range(1, 4)
+        ]
+    )
+    mark_changed(session)
+    transaction.commit()
+    return result
+
+
+def _count_staged(session, upload_id):
+    table = ACCOUNTING_OPERATION_STAGING
+    return session.execute(
+        select([func.count(table.c.id)]).where(
+            table.c.upload_id == upload_id
+        )
+    ).scalar()
+
+
+def _count_uploads(session):
+    return session.query(AccountingOperationUpload).filter_by(
+        md5sum=MD5SUM
+    ).count()
+
+
+def test_drop_staged_upload(dbsession, upload_id):
+    assert _count_staged(dbsession(), upload_id) == 3
+    accounting_parser._drop_staged_upload(upload_id)
+
+    transaction.begin()
+    assert _count_staged(dbsession(), upload_id) == 0
+    assert _count_uploads(dbsession()) == 0
+
+
+def test_publish_failure(dbsession, upload_id, monkeypatch):
+    def publish_staged_operations(upload_id):
+        raise Exception(u"The staged operations could not be copied")
+
+    reports = []
+
+    def report_failure(request, filename, err, file_path=None):
+        reports.append(filename)
+
+    monkeypatch.setattr(
+        accounting_parser,
+        '_publish_staged_operations',
+        publish_staged_operations,
+    )
+    monkeypatch.setattr(accounting_parser, '_report_failure', report_failure)
+    monkeypatch.setattr(
+        accounting_parser.clean_operations_task, 'max_retries', 0
+    )
+
+    payload = {
+        'upload_id': upload_id,
+        'file_path': u"/tmp/general_ledger_2018_06_test.csv",
+        'filename': u"general_ledger_2018_06_test.csv",
+        'filetype': 'general_ledger',
+        'num_stored': 3,
+        'missed_associations': 0,
+        'staged': True,
+        'affected_company_ids': None,
+        'affected_months': None,
+        'phases': [],
+    }
+    assert accounting_parser.clean_operations_task(payload) is None
+    assert reports == [u"general_ledger_2018_06_test.csv"]
+
+    transaction.begin()
+    assert _count_staged(dbsession(), upload_id) == 0
+    assert _count_uploads(dbsession()) == 0
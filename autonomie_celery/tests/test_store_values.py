@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+"""
+store_values only writes the measures whose value changed (in a batched
+UPDATE), creates the missing grids and measures and only loads the grids of
+the compiled scope
+"""
+import re
+
+import pytest
+import transaction
+
+from sqlalchemy import event
+from zope.sqlalchemy import mark_changed
+
+from autonomie_base.models.base import DBSESSION
+from autonomie.models.company import Company
+from autonomie.models.accounting.operations import (
+    AccountingOperationUpload,
+    AccountingOperation,
+)
+from autonomie_celery.tasks.accounting_measure_compute import (
+    compile_measures,
+    get_measure_compiler,
+)
+
+
+class StatementRecorder(object):
+    """
+    Record the statements executed on the measure tables
+    """
+    def __init__(self, engine, measure_class):
+        self.engine = engine
+        self.table_regex = re.compile(
+            u"\\b(?:{0})\\b".format(
+                u"|".join(
+                    table.name for table in measure_class.__mapper__.tables
+                )
+            )
+        )
+        self.statements = []
+        event.listen(engine, 'before_cursor_execute', self._on_execute)
+
+    def _on_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        if self.table_regex.search(statement) is not None:
+            self.statements.append(statement.split(None, 1)[0].upper())
+
+    def remove(self):
+        event.remove(self.engine, 'before_cursor_execute', self._on_execute)
+
+    def count(self, verb):
+        return self.statements.count(verb)
+
+
+def _get_company_ids():
+    return sorted(row.id for row in DBSESSION().query(Company.id))
+
+
+def _get_company_id(key):
+    """
+    Return the company id of a grid's cache key
+    """
+    if isinstance(key, tuple):
+        return key[0]
+    return key
+
+
+def _get_compiler(upload, company_ids=None, months=None):
+    compiler_factory = get_measure_compiler(upload.filetype)
+    operations = compiler_factory.filter_operations(
+        AccountingOperation.query().filter_by(upload_id=upload.id),
+        company_ids,
+        months,
+    ).order_by(AccountingOperation.id).all()
+    return compiler_factory(upload, operations, company_ids, months)
+
+
+def _compile(upload_id, company_ids=None, months=None):
+    """
+    Compile the measures of the given upload in their own transaction
+
+    :returns: The upload (in a new transaction)
+    """
+    transaction.begin()
+    upload = AccountingOperationUpload.get(upload_id)
+    compile_measures(
+        upload,
+        backend='python',
+        company_ids=company_ids,
+        months=months,
+        processes=1,
+    )
+    transaction.commit()
+    transaction.begin()
+    return AccountingOperationUpload.get(upload_id)
+
+
+def _get_stored_values(upload):
+    """
+    Return the stored measures' values of the upload's period
+    {grid cache key: {measure_type_id: value}}
+    """
+    compiler = _get_compiler(upload)
+    return dict(
+        (
+            key,
+            dict(
+                (measure_type_id, float(measure.value))
+                for measure_type_id, measure in company_measures.items()
+            )
+        )
+        for key, company_measures in compiler.measures.items()
+    )
+
+
+def _get_expected_values(upload):
+    compiler = _get_compiler(upload)
+    return compiler.compute_totals(compiler.compute_values())
+
+
+def _assert_stored(stored, expected):
+    assert sorted(stored) == sorted(expected)
+    for key, type_values in stored.items():
+        for measure_type_id, value in type_values.items():
+            assert value == pytest.approx(
+                expected[key].get(measure_type_id, 0), abs=0.01
+            )
+        # Every computed value has its measure
+        assert set(expected[key]) <= set(type_values)
+
+
+def _change_operations(upload_id, company_id):
+    """
+    Change the amounts of the operations of a company
+    """
+    transaction.begin()
+    table = AccountingOperation.__table__
+    session = DBSESSION()
+    session.execute(
+        table.update().where(
+            table.c.upload_id == upload_id
+        ).where(
+            table.c.company_id == company_id
+        ).values(
+            debit=table.c.debit + 100,
+            credit=table.c.credit - 40,
+            balance=table.c.balance + 140,
+        )
+    )
+    mark_changed(session)
+    transaction.commit()
+
+
+def test_unchanged_values(measure_upload):
+    upload_id = measure_upload.id
+    upload = _compile(upload_id)
+    _assert_stored(_get_stored_values(upload), _get_expected_values(upload))
+
+    recorder = StatementRecorder(
+        DBSESSION().get_bind(),
+        get_measure_compiler(upload.filetype).measure_class,
+    )
+    try:
+        _compile(upload_id)
+    finally:
+        recorder.remove()
+    assert recorder.count('SELECT') > 0
+    assert recorder.count('INSERT') == 0
+    assert recorder.count('UPDATE') == 0
+
+
+def test_changed_and_new_values(measure_upload):
+    upload_id = measure_upload.id
+    company_ids = _get_company_ids()
+    # The grids of the other companies don't exist yet
+    _compile(upload_id, company_ids=company_ids[:5])
+    _change_operations(upload_id, company_ids[0])
+    _change_operations(upload_id, company_ids[1])
+
+    recorder = StatementRecorder(
+        DBSESSION().get_bind(),
+        get_measure_compiler(measure_upload.filetype).measure_class,
+    )
+    try:
+        upload = _compile(upload_id)
+    finally:
+        recorder.remove()
+    # Changed values are written in a single batched UPDATE
+    assert recorder.count('UPDATE') == 1
+    assert recorder.count('INSERT') > 0
+    _assert_stored(_get_stored_values(upload), _get_expected_values(upload))
+
+
+def test_scoped_grids(measure_upload):
+    upload_id = measure_upload.id
+    company_ids = _get_company_ids()
+    upload = _compile(upload_id)
+    before = _get_stored_values(upload)
+
+    _change_operations(upload_id, company_ids[0])
+    _change_operations(upload_id, company_ids[1])
+    transaction.begin()
+    upload = AccountingOperationUpload.get(upload_id)
+    compiler = _get_compiler(upload, company_ids[:1], [2])
+    assert compiler.grids
+    # Only the grids in scope are loaded
+    assert sorted(compiler.grids) == sorted(
+        key for key in before
+        if _get_company_id(key) == company_ids[0] and
+        (not isinstance(key, tuple) or key[1] == 2)
+    )
+    assert sorted(compiler.measures) == sorted(compiler.grids)
+    compiler.store_values(
+        compiler.compute_totals(compiler.compute_values())
+    )
+    transaction.commit()
+
+    transaction.begin()
+    upload = AccountingOperationUpload.get(upload_id)
+    after = _get_stored_values(upload)
+    expected = _get_expected_values(upload)
+    for key, type_values in after.items():
+        if key in compiler.grids:
+            _assert_stored({key: type_values}, {key: expected[key]})
+        else:
+            # Out of scope grids are left untouched
+            assert type_values == before[key]
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+"""
+SylkReader gives the same rows as sylk_parser's SylkParser
+"""
+import io
+import os
+
+import pytest
+
+from sylk_parser import SylkParser
+
+from autonomie_celery.benchmarks.generators import (
+    analytical_balance_rows,
+    write_sylk_file,
+)
+from autonomie_celery.sylk_reader import (
+    SylkError,
+    SylkReader,
+    stream_sylk_file,
+)
+
+
+def _parse(path):
+    return [list(row) for row in SylkParser(path, use_unicode=True)]
+
+
+def test_generated_file(tmpdir):
+    path = os.path.join(str(tmpdir), u"analytical_balance.slk")
+    write_sylk_file(path, analytical_balance_rows(500, 20, seed=4))
+    assert list(stream_sylk_file(path)) == _parse(path)
+
+
+def test_small_blocks(tmpdir):
+    path = os.path.join(str(tmpdir), u"analytical_balance.slk")
+    write_sylk_file(path, analytical_balance_rows(50, 5, seed=5))
+    with open(path, 'rb') as fbuf:
+        rows = list(SylkReader(fbuf, blocksize=7))
+    assert rows == _parse(path)
+
+
+def test_edge_values(tmpdir):
+    rows = [
+        [u"Compte", u"Libellé", u"Montant"],
+        [u"ANA00001", u"", 0],
+        [u"ANA00002", u"Dû à l'été", -12.5],
+        [u"ANA00003", u"Avec \"guillemets\"", 1000000],
+        [u"ANA00004", u" ", 0.1],
+    ]
+    path = os.path.join(str(tmpdir), u"edge.slk")
+    write_sylk_file(path, rows)
+    assert list(stream_sylk_file(path)) == _parse(path)
+
+
+def test_unordered_file(tmpdir):
+    path = os.path.join(str(tmpdir), u"unordered.slk")
+    with io.open(path, 'w', encoding="cp1252", newline='') as fbuf:
+        fbuf.write(u"ID;PTest\r\n")
+        fbuf.write(u"C;Y2;X1;K\"B\"\r\nC;Y1;X1;K\"A\"\r\n")
+        fbuf.write(u"E\r\n")
+    with pytest.raises(SylkError):
+        list(stream_sylk_file(path))
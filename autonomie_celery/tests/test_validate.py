@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+"""
+validate_accounting_file reports the malformed lines of a file without
+writing anything, the lines the parser skips aren't counted as operations
+"""
+import os
+
+import pytest
+
+from autonomie_celery.benchmarks.generators import (
+    general_ledger_rows,
+    write_csv_file,
+)
+from autonomie_celery.tasks.accounting_parser import (
+    KnownError,
+    validate_accounting_file,
+)
+
+
+FILENAME = u"general_ledger_2018_06_test.csv"
+VALID_AMOUNTS = [u"1 234,56", u"-12.5", u"+3", u",5", u"12.", u""]
+INVALID_AMOUNTS = [u"12,5,0", u"abc", u"1.2.3", u"--5", u"12 €"]
+
+
+def _line(analytical_account=u"ANA00001", date=u"02/06/2018", debit=0,
+          credit=0):
+    return [
+        analytical_account, u"60100000", date, u"HA", u"P0000001",
+        u"Achat", debit, credit,
+    ]
+
+
+def _write_file(tmpdir, rows):
+    return write_csv_file(os.path.join(str(tmpdir), FILENAME), rows)
+
+
+def test_valid_file(tmpdir, dbsession):
+    rows = list(general_ledger_rows(50, 10, 2018, 6, seed=13))
+    rows.extend(_line(debit=amount) for amount in VALID_AMOUNTS)
+    report = validate_accounting_file(_write_file(tmpdir, rows))
+
+    assert report['valid']
+    assert report['lines'] == len(rows)
+    assert report['operations'] == len(rows) - 1
+    assert report['unmatched_lines'] == 0
+    assert report['invalid_amounts']['count'] == 0
+    assert not report['already_loaded']
+
+
+def test_malformed_lines(tmpdir, dbsession):
+    rows = list(general_ledger_rows(20, 10, 2018, 6, seed=14))
+    rows.extend([
+        # Empty lines and repeated headers are skipped silently
+        [u""],
+        rows[0],
+        # Incomplete line
+        [u"ANA00001", u"60100000", u"02/06/2018"],
+        # Skipped by the parser : its amounts aren't checked
+        _line(date=u"pas une date", debit=u"abc"),
+        _line(date=u"", credit=u"abc"),
+        # Unknown analytical account
+        _line(analytical_account=u"ANA99999"),
+    ])
+    rows.extend(_line(debit=amount) for amount in INVALID_AMOUNTS)
+    rows.append(_line(debit=u"abc", credit=u"--1"))
+    report = validate_accounting_file(_write_file(tmpdir, rows))
+
+    assert not report['valid']
+    assert report['lines'] == len(rows)
+    assert report['operations'] == 20 + 1 + len(INVALID_AMOUNTS) + 1
+    assert report['incomplete_lines'] == {'count': 1, 'samples': [24]}
+    assert report['invalid_dates'] == {
+        'count': 2,
+        'samples': [(25, u"pas une date"), (26, u"")],
+    }
+    assert report['unmatched_lines'] == 1
+    assert report['unmatched_accounts'] == {u"ANA99999": 1}
+    assert report['invalid_amounts']['count'] == len(INVALID_AMOUNTS) + 2
+    assert report['invalid_amounts']['samples'] == [
+        (28 + index, amount) for index, amount in enumerate(INVALID_AMOUNTS)
+    ] + [(33, u"abc"), (33, u"--1")]
+
+
+def test_max_samples(tmpdir, dbsession):
+    rows = list(general_ledger_rows(10, 10, 2018, 6, seed=15))
+    rows.extend(
+        _line(analytical_account=u"ANA9%04d" % index, debit=u"abc")
+        for index in range(30)
+    )
+    report = validate_accounting_file(
+        _write_file(tmpdir, rows), max_samples=5
+    )
+
+    assert report['invalid_amounts']['count'] == 30
+    assert report['invalid_amounts']['samples'] == [
+        (index, u"abc") for index in range(12, 17)
+    ]
+    assert report['unmatched_lines'] == 30
+    assert report['unmatched_accounts'] == dict(
+        (u"ANA9%04d" % index, 1) for index in range(5)
+    )
+
+
+def test_unknown_filename(tmpdir):
+    path = write_csv_file(
+        os.path.join(str(tmpdir), u"grand_livre.csv"), [_line()]
+    )
+    with pytest.raises(KnownError):
+        validate_accounting_file(path)
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+"""
+Accounting pool watcher
+
+Watches the accounting files pool (autonomie.parsing_pool_parent/pool) and
+launches the parsing as soon as a file has been completely written
+
+    autonomie-celery-pool-watcher development.ini
+
+A file is complete when inotify sends a close-write (or moved-to) event for it
+or, when pyinotify is not installed or autonomie.pool_watcher.polling is set
+(e.g : NFS mounted pool), when its size didn't change between two scans.
+
+Files left in the pool (the dispatcher keeps them while a file of the same
+filetype is being processed) are dispatched again every retry_delay seconds.
+
+When the watcher runs, the [celerybeat:accounting_parser] entry can be removed
+from the ini file.
+"""
+import logging
+import os
+import sys
+import time
+
+from pyramid.paster import (
+    bootstrap,
+    setup_logging,
+)
+from pyramid.settings import asbool
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+
+logger = logging.getLogger(__name__)
+
+# Delay between two scans of the pool directory (seconds)
+POLL_INTERVAL = 2
+# Delay before a file still present in the pool is dispatched again (seconds)
+RETRY_DELAY = 30
+
+
+class PoolWatcher(object):
+    """
+    Watch a pool directory and call dispatch when complete files are found
+
+    :param str pool_path: The directory to watch
+    :param func dispatch: Called with the list of the ready paths
+    :param bool polling: Don't use inotify
+    """
+    def __init__(
+        self, pool_path, dispatch, polling=False, interval=POLL_INTERVAL,
+        retry_delay=RETRY_DELAY
+    ):
+        self.pool_path = pool_path
+        self.dispatch = dispatch
+        self.polling = polling or pyinotify is None
+        self.interval = interval
+        self.retry_delay = retry_delay
+        # Sizes of the files found during the last scan
+        self.sizes = {}
+        # Last dispatch time by file path
+        self.dispatched = {}
+
+    def _list_files(self):
+        """
+        Return the size of the files currently in the pool
+
+        :rtype: dict
+        """
+        result = {}
+        for filename in os.listdir(self.pool_path):
+            path = os.path.join(self.pool_path, filename)
+            try:
+                if os.path.isfile(path):
+                    result[path] = os.path.getsize(path)
+            except OSError:
+                # The file has been claimed in the meantime
+                continue
+        return result
+
+    def _launch(self, paths):
+        """
+        Launch the dispatch for the given paths
+        """
+        now = time.time()
+        for path in paths:
+            self.dispatched[path] = now
+        logger.info(u"Files ready in the pool : {0}".format(", ".join(paths)))
+        self.dispatch(paths)
+
+    def scan(self):
+        """
+        Scan the pool and dispatch the files whose size is stable and that were
+        not dispatched for retry_delay seconds
+        """
+        now = time.time()
+        sizes = self._list_files()
+        ready = [
+            path for path, size in sizes.items()
+            if self.sizes.get(path) == size and
+            now - self.dispatched.get(path, 0) >= self.retry_delay
+        ]
+        self.sizes = sizes
+        self.dispatched = dict(
+            (path, timestamp) for path, timestamp in self.dispatched.items()
+            if path in sizes
+        )
+        if ready:
+            self._launch(ready)
+
+    def on_event(self, event):
+        """
+        Handle an inotify event : the file has been completely written
+        """
+        self._launch([event.pathname])
+
+    def _run_inotify(self):
+        watch_manager = pyinotify.WatchManager()
+        watch_manager.add_watch(
+            self.pool_path,
+            pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO,
+        )
+        notifier = pyinotify.Notifier(
+            watch_manager, default_proc_fun=self.on_event
+        )
+        # The scan only handles files left in the pool, we don't need to do it
+        # often
+        timeout = self.retry_delay * 1000
+        try:
+            while True:
+                if notifier.check_events(timeout=timeout):
+                    notifier.read_events()
+                    notifier.process_events()
+                self.scan()
+        finally:
+            notifier.stop()
+
+    def _run_polling(self):
+        while True:
+            self.scan()
+            time.sleep(self.interval)
+
+    def run(self):
+        if self.polling:
+            logger.info(u"Polling {0}".format(self.pool_path))
+            self._run_polling()
+        else:
+            logger.info(u"Watching {0} with inotify".format(self.pool_path))
+            self._run_inotify()
+
+
+def _dispatch(paths):
+    """
+    Launch the pool dispatcher task for the given files
+
+    :param list paths: The paths of the files that are completely written
+    """
+    from autonomie_celery.tasks.accounting_parser import handle_pool_task
+    handle_pool_task.delay(paths=paths)
+
+
+def main(argv=sys.argv):
+    if len(argv) != 2:
+        print(u"Usage : {0} <config_uri>".format(os.path.basename(argv[0])))
+        sys.exit(1)
+
+    setup_logging(argv[1])
+    env = bootstrap(argv[1])
+    settings = env['registry'].settings
+    watcher = PoolWatcher(
+        os.path.join(settings['autonomie.parsing_pool_parent'], 'pool'),
+        _dispatch,
+        polling=asbool(settings.get('autonomie.pool_watcher.polling', False)),
+        interval=int(
+            settings.get('autonomie.pool_watcher.interval', POLL_INTERVAL)
+        ),
+    )
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        env['closer']()
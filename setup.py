@@ -17,7 +17,10 @@ entry_points = {
     "paste.app_factory": [
         "worker = autonomie_celery:worker",
         "scheduler = autonomie_celery:scheduler",
-    ]
+    ],
+    "console_scripts": [
+        "autonomie-celery-pool-watcher = autonomie_celery.watcher:main",
+    ],
 }
 
 setup(name='autonomie_celery',